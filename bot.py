@@ -1,6 +1,6 @@
 import os
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, Message, CallbackQuery, BotCommandScope
 from telegram.constants import ParseMode
@@ -10,6 +10,10 @@ from google.generativeai import types
 import re
 import aiohttp
 from database import Database
+from member_index import MemberIndex, normalize_search_term, normalize_text, significant_terms
+from cache import TTLCache
+from rate_limit import TokenBucket, AdmissionController, AdmissionRejected
+from document_text import can_extract, iter_chunks, iter_text
 import json
 import asyncio
 from typing import List, Dict, Any, Optional, Tuple
@@ -17,14 +21,17 @@ import telegram
 import replicate
 import mimetypes
 import tempfile
-import io
-import base64
 import pathlib
 import time
-from collections import defaultdict
+import hashlib
+import itertools
+import contextlib
+from collections import deque, OrderedDict
 import sqlite3
-from llm_provider import generate_response
-import openai
+from llm_provider import (
+    generate_response, stream_response, get_openai_client, get_gemini_model, close_clients,
+    prompt_cache_stats, estimate_tokens, get_prompt_budget,
+)
 import httpx
 
 # Загрузка переменных окружения
@@ -42,8 +49,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)  # Устанавливаем уровень логирования на DEBUG
 
-# Инициализация Gemini
-vision_model = genai.GenerativeModel('gemini-pro-vision')  # Модель для работы с изображениями и документами
 
 # Шаблоны для поиска
 SEARCH_PATTERNS = [
@@ -62,14 +67,37 @@ WEB_SEARCH_PATTERNS = [
 # Шаблон для генерации фото
 PHOTO_PATTERN = r"брат фото (.*?)$"
 
-# Словарь соответствия различных вариаций специализаций
-SPECIALIZATION_MAPPING = {
-    'маркетинг': ['маркетинг', 'маркетолог', 'marketing', 'smm', 'контент', 'таргет', 'реклама'],
-    'разработка': ['разработчик', 'программист', 'developer', 'кодер', 'backend', 'frontend'],
-    'дизайн': ['дизайнер', 'designer', 'ui/ux', 'графический', 'веб-дизайн'],
-    'продакт': ['продакт', 'product manager', 'product owner', 'менеджер продукта'],
-    'проджект': ['project manager', 'проджект', 'менеджер проекта', 'пм']
+# Шаблон для анализа файла (файл во вложении или в сообщении, на которое отвечают)
+FILE_PATTERN = r"брат изучи файл\s*(.*)$"
+
+# Потоковая выдача ответов: заглушка редактируется по мере генерации
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') != '0'
+# Минимальный интервал между редактированиями сообщения (лимиты Telegram)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Кэш ответов на повторяющиеся вопросы (FAQ)
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '21600'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '512'))
+# Вопросы, ответ на которые зависит от собеседника или хода диалога, не кэшируются
+PERSONAL_QUESTION_PATTERN = re.compile(
+    r"(?<!\w)(я|мне|меня|мной|мой|моя|мое|моё|мои|моих|моим|мы|нам|нас|наш|наша|наше|наши|"
+    r"обо мне|про меня|ты помнишь|помнишь|выше|ранее|раньше|до этого|предыдущ\w*|продолжи\w*|"
+    r"это|этот|эта|эти|этого|этом|тот|там|тут|он|она|они|его|ее|её|их|еще|ещё|"
+    r"сегодня|вчера|завтра|сейчас)(?!\w)",
+    re.IGNORECASE
+)
+# Служебные слова, не влияющие на смысл вопроса
+QUESTION_FILLER_WORDS = {'брат', 'пожалуйста', 'плиз', 'подскажи', 'скажи', 'расскажи', 'а', 'ну', 'слушай'}
+
+# Заголовки саммари в промпте по уровню сжатия
+SUMMARY_TIER_TITLES = {
+    0: "Краткое содержание блока",
+    1: "Краткое содержание сессии",
+    2: "Краткое содержание всей истории",
 }
+# Сколько участников, подходящих к сообщению, попадает в промпт
+ROSTER_TOP_K = int(os.getenv('ROSTER_TOP_K', '8'))
 
 # Системный промпт для бота
 SYSTEM_PROMPT = """
@@ -305,21 +333,67 @@ def format_response(text: str) -> str:
     return result.strip()
 
 class PerplexityAPI:
-    def __init__(self, api_key):
+    """Клиент Perplexity поверх одной долгоживущей сессии aiohttp.
+
+    Результаты кэшируются по нормализованному запросу, а одинаковые запросы,
+    пришедшие одновременно, объединяются в один вызов API.
+    """
+
+    def __init__(self, api_key, timeout: float = 30, cache_ttl: float = 300, cache_size: int = 256):
         self.api_key = api_key
         if not self.api_key:
             raise ValueError("PERPLEXITY_API_KEY не установлен в переменных окружения")
         self.base_url = "https://api.perplexity.ai/chat/completions"
-        
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.inflight: Dict[str, asyncio.Task] = {}  # Запросы, ожидающие ответа API
+
+    async def start(self):
+        """Создаёт сессию с пулом соединений (keep-alive, кэш DNS)"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+            )
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return ' '.join(re.findall(r'\w+', query.lower().replace('ё', 'е')))
+
     async def search(self, query):
-        if not query:
+        if not query or not query.strip():
             raise ValueError("Поисковый запрос не может быть пустым")
-            
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
+        key = self.normalize_query(query) or query.strip()
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info(f"Perplexity: ответ из кэша для запроса '{key}'")
+            return cached
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._request(query))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._on_done(key, t))
+        else:
+            logger.info(f"Perplexity: запрос '{key}' уже выполняется, ждём его результат")
+        # shield: отмена одного ожидающего не прерывает запрос для остальных
+        return await asyncio.shield(task)
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.cache.set(key, task.result())
+
+    async def _request(self, query):
         data = {
             "model": "sonar",
             "messages": [
@@ -346,19 +420,22 @@ class PerplexityAPI:
             "max_tokens": 1024
         }
         
+        await self.start()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, headers=headers, json=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        response_text = result['choices'][0]['message']['content']
-                        # Очищаем текст от специальных символов разметки
-                        response_text = re.sub(r'[*_#`]', '', response_text)
-                        return response_text
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Perplexity API error: Status {response.status}, Response: {error_text}")
-                        raise Exception(f"Ошибка API: {response.status}")
+            async with self.session.post(self.base_url, json=data) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    response_text = result['choices'][0]['message']['content']
+                    # Очищаем текст от специальных символов разметки
+                    response_text = re.sub(r'[*_#`]', '', response_text)
+                    return response_text
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Perplexity API error: Status {response.status}, Response: {error_text}")
+                    raise Exception(f"Ошибка API: {response.status}")
+        except asyncio.TimeoutError:
+            logger.error(f"Perplexity API: превышен таймаут запроса ({self.timeout.total} с)")
+            raise Exception("Превышено время ожидания ответа API")
         except aiohttp.ClientError as e:
             logger.error(f"Network error during Perplexity API request: {e}")
             raise Exception("Ошибка сети при запросе к API")
@@ -367,157 +444,501 @@ class PerplexityAPI:
             raise
 
 class ConversationContext:
-    def __init__(self, db):
+    """Кэш последних сообщений активных пользователей поверх таблицы message_context.
+
+    Для каждого пользователя в памяти хранится ограниченный хвост диалога,
+    который пополняется при каждой записи. В базу за историей идём только
+    при промахе кэша, поэтому стоимость сообщения не зависит от длины истории.
+    """
+
+    def __init__(self, db, max_context_length: int = 50, max_users: int = 1000):
         self.db = db  # SQLite database
-        self.contexts = {}  # Кэш для активных контекстов
-        self.max_context_length = 10
-        self.max_tokens = 2000
-        
-    async def add_message(self, user_id: int, role: str, content: str):
-        """Добавить сообщение в контекст пользователя"""
-        message = {
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        }
-        self.contexts[user_id] = self.contexts.get(user_id, []) + [message]
-        
-        if len(self.contexts[user_id]) > self.max_context_length:
-            await self._summarize_context(user_id)
-    
-    async def _summarize_context(self, user_id: int):
-        """Сжать контекст, создав краткое содержание предыдущих сообщений"""
-        try:
-            logger.info(f"🔄 Начинаю суммаризацию контекста для пользователя {user_id}")
-            
-            # Получаем текущий контекст из базы данных
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT role, content, timestamp 
-                    FROM message_context 
-                    WHERE user_id = ? 
-                    ORDER BY timestamp ASC
-                """, (user_id,))
-                messages = cursor.fetchall()
-                
-            if not messages:
-                logger.info("❌ Контекст пуст, нечего суммаризировать")
-                return
-                
-            logger.info(f"📊 Текущая длина контекста: {len(messages)} сообщений")
-            
-            # Формируем промпт для сжатия контекста
-            summary_prompt = "Сделай краткую выжимку из этого диалога, сохранив ключевые моменты и важные детали:\n\n"
-            messages_to_summarize = messages[:-5]  # Оставляем последние 5 сообщений
-            logger.info(f"📝 Суммаризирую {len(messages_to_summarize)} сообщений, оставляю последние 5")
-            
-            for role, content, _ in messages_to_summarize:
-                summary_prompt += f"{role}: {content}\n"
-                
-            try:
-                logger.info("🤖 Отправляю запрос на суммаризацию в Gemini")
-                response = vision_model.generate_content(summary_prompt)
-                summary = response.text
-                logger.info(f"✅ Получен ответ от Gemini, длина саммари: {len(summary)} символов")
-                
-                # Сохраняем саммари в базу данных
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO chat_summaries (user_id, summary, created_at)
-                        VALUES (?, ?, datetime('now'))
-                    """, (user_id, summary))
-                    conn.commit()
-                    logger.info("✅ Саммари успешно сохранено в базу данных")
-                    
-                    # Обновляем контекст: удаляем старые сообщения и добавляем саммари
-                    cursor.execute("DELETE FROM message_context WHERE user_id = ? AND timestamp < ?", 
-                                 (user_id, messages[-5][2]))  # Оставляем только последние 5 сообщений
-                    
-                    # Добавляем саммари как системное сообщение
-                    cursor.execute("""
-                        INSERT INTO message_context (user_id, role, content, timestamp)
-                        VALUES (?, 'system', ?, datetime('now'))
-                    """, (user_id, f"Краткое содержание предыдущего диалога:\n{summary}"))
-                    conn.commit()
-                    
-                logger.info("✅ Контекст успешно обновлен")
-                
-            except Exception as e:
-                logger.error(f"❌ Ошибка при суммаризации контекста: {str(e)}")
-                # В случае ошибки оставляем только последние 5 сообщений
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("DELETE FROM message_context WHERE user_id = ? AND timestamp < ?", 
-                                 (user_id, messages[-5][2]))
-                    conn.commit()
-                logger.info("⚠️ Оставлены только последние 5 сообщений из-за ошибки")
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка в методе _summarize_context: {str(e)}")
+        self.contexts = OrderedDict()  # user_id -> deque последних сообщений (LRU)
+        self.max_context_length = max_context_length
+        self.max_users = max_users
+
+    async def get_context(self, user_id: int) -> list:
+        """Получить последние сообщения пользователя (не более max_context_length)"""
+        cached = self.contexts.get(user_id)
+        if cached is None:
+            messages = await self.db.get_user_context(user_id, limit=self.max_context_length)
+            cached = deque(messages, maxlen=self.max_context_length)
+            self.contexts[user_id] = cached
+            while len(self.contexts) > self.max_users:
+                self.contexts.popitem(last=False)
+        else:
+            self.contexts.move_to_end(user_id)
+        return list(cached)
+
+    async def add_message(self, user_id: int, role: str, content: str) -> Optional[dict]:
+        """Сохранить сообщение в базе и дописать его в хвост кэша"""
+        message = await self.db.add_message_to_context(user_id, role, content)
+        if not message:
+            return None
+        cached = self.contexts.get(user_id)
+        if cached is not None:
+            cached.append(message)
+            self.contexts.move_to_end(user_id)
+        return message
+
+    async def clear_context(self, user_id: int):
+        """Сбросить кэш контекста пользователя"""
+        self.contexts.pop(user_id, None)
+
+class MemberRoster:
+    """Список участников сообщества для системного промпта.
+
+    Для каждого участника хранится готовая строка, поэтому сохранение профиля
+    меняет одну запись, а не пересобирает список целиком. Изменённые строки
+    копятся и записываются в базу одной пачкой после паузы (debounce).
+    В промпт попадают только строки участников, отобранных под сообщение.
+    """
+
+    # Заголовок, с которым прежние версии вшивали весь список в системный промпт
+    HEADER = "\n\nВ сообществе зарегистрированы:\n"
+
+    def __init__(self, db, flush_delay: float = 2.0):
+        self.db = db
+        self.flush_delay = flush_delay
+        self.lines: Dict[int, str] = {}  # user_id -> строка участника
+        self.dirty: Dict[int, Optional[str]] = {}  # Несохранённые изменения (None — удаление)
+        self.version = 0  # Растёт при каждом изменении списка
+        self._flush_task = None
+
+    @staticmethod
+    def render_line(profile: dict) -> str:
+        skills = ', '.join(profile.get('skills') or [])
+        line = f"• {profile.get('full_name')} — {profile.get('occupation')} ({skills})"
+        telegram_nick = profile.get('telegram_nick')
+        if telegram_nick:
+            if not telegram_nick.startswith('@'):
+                telegram_nick = '@' + telegram_nick
+            line += f" {telegram_nick}"
+        return line
+
+    async def load(self):
+        """Собирает список по профилям и сверяет его с сохранённым в базе.
+
+        Профили пишутся и в обход списка (add_or_update_user, демо-данные,
+        delete_all_users), поэтому источник истины — таблица users, а в
+        roster_entries записываются только расхождения.
+        """
+        stored = await self.db.get_roster_entries()
+        self.lines = {user['user_id']: self.render_line(user) for user in await self.db.get_all_users()}
+        changes = {uid: line for uid, line in self.lines.items() if stored.get(uid) != line}
+        changes.update({uid: None for uid in stored.keys() - self.lines.keys()})
+        if changes:
+            await self.db.save_roster_entries(changes)
+            logger.info(f"Список участников сверен с профилями: исправлено записей {len(changes)}")
+        logger.info(f"✅ Список участников загружен: {len(self.lines)}")
+
+    def update(self, user_id: int, profile: dict):
+        """Обновляет строку одного участника"""
+        line = self.render_line(profile)
+        if self.lines.get(user_id) == line:
             return
-    
-    async def get_context(self, user_id: int, days_back: int = None) -> list:
-        """Получить контекст пользователя с возможностью указать глубину поиска"""
-        await self.load_context(user_id)
-        
-        if not days_back:
-            return self.contexts.get(user_id, [])
-            
-        # Если указано количество дней, добавляем архивные сообщения
-        cutoff_date = datetime.now() - timedelta(days=days_back)
-        
-        # Получаем архивные записи
-        # archive_cursor = self.db.context_archive.find({
-        #     "user_id": user_id,
-        #     "archived_at": {"$gte": cutoff_date}
-        # }).sort("archived_at", -1)
-        
-        # archived_messages = []
-        # async for doc in archive_cursor:
-        #     archived_messages.extend(doc["messages"])
-        
-        # Объединяем с текущим контекстом
-        current_context = self.contexts.get(user_id, [])
-        all_messages = current_context  # Только локальный контекст
-        
-        # Фильтруем по дате
-        filtered_messages = [
-            msg for msg in all_messages
-            if datetime.fromisoformat(msg["timestamp"]) >= cutoff_date
+        self.lines[user_id] = line
+        self._mark_dirty(user_id, line)
+
+    def remove(self, user_id: int):
+        if self.lines.pop(user_id, None) is not None:
+            self._mark_dirty(user_id, None)
+
+    def clear(self):
+        """Сбрасывает список в памяти (строки в базе удаляются вместе с пользователями)"""
+        self.lines.clear()
+        self.dirty.clear()
+        self.version += 1
+
+    def render(self, user_ids: List[int]) -> str:
+        """Блок для системного промпта: размер сообщества и строки выбранных участников"""
+        if not self.lines:
+            return ""
+        block = f"\n\nВ сообществе зарегистрировано участников: {len(self.lines)}."
+        lines = [self.lines[uid] for uid in user_ids if uid in self.lines]
+        if lines:
+            block += "\nУчастники, подходящие к текущему сообщению:\n" + '\n'.join(lines)
+        return block
+
+    @classmethod
+    def strip(cls, prompt: str) -> str:
+        """Отрезает список участников, вшитый в промпт прежними версиями бота"""
+        return prompt.split(cls.HEADER, 1)[0]
+
+    def _mark_dirty(self, user_id: int, line: Optional[str]):
+        self.dirty[user_id] = line
+        self.version += 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def flush(self):
+        """Записывает накопленные изменения в базу"""
+        if not self.dirty:
+            return
+        changes, self.dirty = self.dirty, {}
+        if await self.db.save_roster_entries(changes):
+            logger.info(f"Список участников: сохранено изменений {len(changes)}")
+        else:
+            # Вернём изменения, если более свежие ещё не пришли
+            for user_id, line in changes.items():
+                self.dirty.setdefault(user_id, line)
+
+    async def stop(self):
+        """Отменяет отложенную запись и сохраняет остаток изменений"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+class SummaryWorker:
+    """Фоновая саммаризация диалогов, вынесенная из пути ответа пользователю.
+
+    Задачи ставятся в очередь после отправки ответа. Для каждого пользователя
+    в очереди не больше одной задачи, а число одновременных запросов
+    к модели ограничено количеством воркеров.
+    """
+
+    SUMMARY_PROMPT = (
+        "Прочитай диалог ниже и сделай краткое смысловое описание: \n"
+        "- О чём спрашивал пользователь?\n"
+        "- Какие задачи или вопросы поднимались?\n"
+        "- Какие ответы и советы дал ассистент?\n"
+        "- Не пересказывай всё подряд, выдели только суть и ключевые моменты, без лишних деталей.\n"
+        "- Не копируй текст сообщений, а именно опиши, что происходило.\n\n"
+    )
+
+    COMPACT_PROMPT = (
+        "Ниже несколько кратких описаний последовательных частей одного диалога. "
+        "Объедини их в одно связное краткое описание:\n"
+        "- Сохрани ключевые темы, вопросы пользователя, договорённости и важные факты о нём.\n"
+        "- Убери повторы и второстепенные детали.\n"
+        "- Итог должен быть не длиннее самого длинного из исходных описаний.\n\n"
+    )
+
+    # Сколько активных саммари каждого уровня допускается до сжатия:
+    # 0 — блоки сообщений, 1 — сессии; уровень 2 (вся история) всегда один
+    TIER_LIMITS = {0: 4, 1: 3}
+    TOP_TIER = 2
+
+    def __init__(self, db, block_size: int = 30, keep_recent: int = 10,
+                 max_concurrency: int = 2, max_blocks_per_run: int = 3):
+        self.db = db
+        self.block_size = block_size  # Сообщений в одном блоке саммари
+        self.keep_recent = keep_recent  # Последние сообщения, которые идут в промпт как есть
+        self.max_concurrency = max_concurrency
+        self.max_blocks_per_run = max_blocks_per_run
+        self.queue = asyncio.Queue()
+        self.pending = set()  # Пользователи, чьи задачи в очереди или выполняются
+        self.rescan = set()  # Пользователи, для которых пришли новые сообщения во время работы
+        self.workers = []
+
+    def start(self):
+        """Запускает воркеры (требует работающего event loop)"""
+        if self.workers:
+            return
+        self.workers = [
+            asyncio.create_task(self._worker(), name=f"summary-worker-{i}")
+            for i in range(self.max_concurrency)
         ]
-        
-        return filtered_messages
-    
-    async def clear_context(self, user_id: int):
-        """Очистить контекст пользователя"""
-        if user_id in self.contexts:
-            del self.contexts[user_id]
-        # await self.db.contexts.delete_one({"user_id": user_id})
-        
-    async def cleanup_old_contexts(self, days: int = 30):
-        """Очистить старые контексты"""
-        # cutoff_date = datetime.now() - timedelta(days=days)
-        # await self.db.contexts.delete_many({
-        #     "last_updated": {"$lt": cutoff_date}
-        # })
-        pass
+        logger.info(f"✅ Запущено воркеров саммаризации: {self.max_concurrency}")
+
+    async def stop(self):
+        """Останавливает воркеры"""
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def schedule(self, user_id: int):
+        """Ставит проверку необходимости саммари в очередь (без дублей)"""
+        if user_id in self.pending:
+            self.rescan.add(user_id)
+            return
+        self.pending.add(user_id)
+        self.queue.put_nowait(user_id)
+
+    async def _worker(self):
+        while True:
+            user_id = await self.queue.get()
+            try:
+                await self.summarize_user(user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ [SUMMARIZATION] Ошибка фоновой саммаризации для {user_id}: {e}")
+            finally:
+                self.pending.discard(user_id)
+                self.queue.task_done()
+                if user_id in self.rescan:
+                    self.rescan.discard(user_id)
+                    self.schedule(user_id)
+
+    async def summarize_user(self, user_id: int):
+        """Создаёт саммари для всех накопившихся полных блоков пользователя и сжимает старые"""
+        await self._summarize_blocks(user_id)
+        await self.compact_user(user_id)
+
+    async def _summarize_blocks(self, user_id: int):
+        for _ in range(self.max_blocks_per_run):
+            summaries = await self.db.get_all_summaries(user_id)
+            # Граница — id последнего сообщения блока: время хранится с точностью до секунды
+            # и не различает сообщения, пришедшие в одну секунду
+            last_id = max((s['end_message_id'] for s in summaries if s['end_message_id']), default=None)
+            messages = await self.db.get_messages_after(
+                user_id, last_id, limit=self.block_size + self.keep_recent
+            )
+            if len(messages) < self.block_size + self.keep_recent:
+                return
+            block = messages[:self.block_size]
+            logger.info(f"🟡 [SUMMARIZATION] Новый блок для саммаризации: {len(block)} сообщений (user_id={user_id})")
+            dialog = ""
+            for msg in block:
+                role = "Пользователь" if msg["role"] == "user" else "Ассистент"
+                dialog += f"{role}: {msg['content']}\n"
+            summary = await generate_response([{"role": "user", "content": dialog}], self.SUMMARY_PROMPT)
+            if not summary:
+                return
+            logger.info(f"[SUMMARIZATION] Саммари ({len(summary)} символов):\n{summary[:300]}...\n[...]")
+            await self.db.create_chat_summary(
+                user_id, summary, block[0]['timestamp'], block[-1]['timestamp'], block[-1]['id']
+            )
+
+    async def compact_user(self, user_id: int):
+        """Сжимает старые саммари в саммари более высокого уровня.
+
+        Блоки сверх лимита (самые старые) объединяются в сессию, сессии сверх
+        лимита — вместе с текущим саммари всей истории — в новое саммари всей
+        истории. Так число активных саммари пользователя ограничено сверху.
+        """
+        for tier, limit in self.TIER_LIMITS.items():
+            summaries = await self.db.get_all_summaries(user_id)
+            current = [s for s in summaries if s['tier'] == tier]
+            if len(current) <= limit:
+                continue
+            sources = current[:limit]
+            if tier + 1 == self.TOP_TIER:
+                # Саммари всей истории одно: новое включает предыдущее
+                sources = [s for s in summaries if s['tier'] == self.TOP_TIER] + sources
+            if len(sources) < 2:
+                continue
+            logger.info(f"🟡 [SUMMARIZATION] Сжатие {len(sources)} саммари уровня {tier} (user_id={user_id})")
+            text = "\n\n".join(f"Часть {i + 1}:\n{s['summary']}" for i, s in enumerate(sources))
+            summary = await generate_response([{"role": "user", "content": text}], self.COMPACT_PROMPT)
+            if not summary:
+                return
+            await self.db.compact_summaries(user_id, [s['id'] for s in sources], summary, tier + 1)
+
+class ImageJob:
+    """Задача генерации изображения в очереди ImageGenerator"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id: int, prompt: str, params: dict = None, cache_key: str = None):
+        self.id = next(self._ids)
+        self.user_id = user_id
+        self.prompt = prompt
+        self.params = params  # Параметры генерации; без них промпт переводится при старте задачи
+        self.cache_key = cache_key  # Ключ кэша file_id для промпта
+        self.status = 'queued'  # queued -> running -> done / failed / cancelled
+        self.result = asyncio.get_running_loop().create_future()  # URL изображения
+        self.on_start = None  # Корутина-колбэк, вызывается при старте генерации
+        self.task = None
 
 class ImageGenerator:
-    def __init__(self, api_token):
+    """Асинхронная генерация изображений через очередь задач.
+
+    Задачи выполняет ограниченный пул воркеров; генерация идёт через
+    асинхронные предсказания Replicate с опросом статуса, поэтому event loop
+    не блокируется. Задачу можно отменить как в очереди, так и во время работы.
+    """
+
+    QUALITY_MODIFIERS = (
+        "high quality, detailed, sharp focus, professional photography, cinematic lighting, masterpiece, best quality"
+    )
+
+    def __init__(self, api_token, db=None, max_workers: int = 2, max_queue: int = 20,
+                 max_per_user: int = 2, poll_interval: float = 1.0, timeout: float = 120,
+                 cache_size: int = 1000):
         self.client = replicate.Client(api_token=api_token)
+        self.db = db  # Хранилище file_id уже отправленных изображений
+        self.cache_size = cache_size
         self.model_version = "black-forest-labs/flux-schnell"
+        # Переводы промптов: нормализованный промпт -> английский промпт с модификаторами
+        self.translation_cache = TTLCache(maxsize=512, ttl=7 * 24 * 3600)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.queue = asyncio.Queue()
+        self.waiting: "OrderedDict[int, ImageJob]" = OrderedDict()  # Задачи в очереди по порядку
+        self.running: Dict[int, ImageJob] = {}
+        self.workers = []
+
+    def start(self):
+        """Запускает воркеры (требует работающего event loop)"""
+        if self.workers:
+            return
+        self.workers = [
+            asyncio.create_task(self._worker(), name=f"image-worker-{i}")
+            for i in range(self.max_workers)
+        ]
+        logger.info(f"✅ Запущено воркеров генерации изображений: {self.max_workers}")
+
+    async def stop(self):
+        """Отменяет все задачи и останавливает воркеры"""
+        for job in list(self.waiting.values()) + list(self.running.values()):
+            self.cancel(job.id)
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def user_jobs(self, user_id: int) -> int:
+        return sum(1 for job in itertools.chain(self.waiting.values(), self.running.values())
+                   if job.user_id == user_id)
+
+    def build_params(self, enhanced_prompt: str) -> dict:
+        """Параметры генерации для модели"""
+        return {
+            "prompt": enhanced_prompt,
+            "go_fast": True,
+            "megapixels": "1",
+            "num_outputs": 1,
+            "aspect_ratio": "1:1",
+            "output_format": "jpg",
+            "output_quality": 80,
+            "num_inference_steps": 4
+        }
+
+    @staticmethod
+    def normalize_prompt(prompt: str) -> str:
+        """Промпт без различий в регистре, пробелах и ё"""
+        return ' '.join(prompt.split()).lower().replace('ё', 'е')
+
+    def cache_key(self, prompt: str) -> str:
+        """Ключ кэша file_id по исходному промпту: переводить его для поиска в кэше не нужно"""
+        params = self.build_params(self.normalize_prompt(prompt))
+        payload = json.dumps({"model": self.model_version, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def prepare(self, prompt: str) -> Tuple[str, Optional[str]]:
+        """Ищет готовое изображение без перевода промпта: (cache_key, file_id или None)"""
+        key = self.cache_key(prompt)
+        file_id = await self.db.get_cached_image(key) if self.db else None
+        return key, file_id
+
+    async def remember(self, cache_key: str, params: dict, file_id: str):
+        """Запоминает file_id отправленного изображения для повторных запросов"""
+        if self.db:
+            await self.db.save_cached_image(cache_key, params["prompt"], params, file_id, self.cache_size)
+
+    async def forget(self, cache_key: str):
+        if self.db:
+            await self.db.delete_cached_image(cache_key)
+
+    def submit(self, user_id: int, prompt: str, params: dict = None, cache_key: str = None) -> ImageJob:
+        """Ставит задачу в очередь; ValueError — если очередь или лимит пользователя заполнены"""
+        if len(self.waiting) >= self.max_queue:
+            raise ValueError("Очередь генерации переполнена. Попробуйте чуть позже.")
+        if self.user_jobs(user_id) >= self.max_per_user:
+            raise ValueError(f"У вас уже есть {self.max_per_user} запроса в работе. Дождитесь их завершения.")
+        job = ImageJob(user_id, prompt, params, cache_key)
+        self.waiting[job.id] = job
+        self.queue.put_nowait(job)
+        logger.info(f"🎨 Задача генерации {job.id} от {user_id} в очереди (позиция {self.queue_position(job.id)})")
+        return job
+
+    def queue_position(self, job_id: int) -> int:
+        """Позиция задачи в очереди (1 — следующая), 0 — задача уже выполняется или завершена"""
+        for position, waiting_id in enumerate(self.waiting, start=1):
+            if waiting_id == job_id:
+                return position
+        return 0
+
+    def cancel(self, job_id: int, user_id: int = None) -> bool:
+        """Отменяет задачу; если указан user_id, отменить можно только свою"""
+        job = self.waiting.get(job_id) or self.running.get(job_id)
+        if job is None or (user_id is not None and job.user_id != user_id):
+            return False
+        job.status = 'cancelled'
+        if self.waiting.pop(job_id, None) is not None:
+            job.result.cancel()
+        elif job.task:
+            job.task.cancel()
+        logger.info(f"🛑 Задача генерации {job_id} отменена")
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if self.waiting.pop(job.id, None) is None:
+                    continue  # Отменена, пока ждала в очереди
+                job.status = 'running'
+                self.running[job.id] = job
+                if job.on_start:
+                    try:
+                        await job.on_start(job)
+                    except Exception as e:
+                        logger.warning(f"Ошибка колбэка старта генерации {job.id}: {e}")
+                if job.status == 'cancelled':
+                    continue  # Отменена во время колбэка старта, job.task ещё не было
+                job.task = asyncio.create_task(self._run(job))
+                try:
+                    url = await job.task
+                    job.status = 'done'
+                    job.result.set_result(url)
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        raise  # Останавливается сам воркер
+                    job.result.cancel()
+                except Exception as e:
+                    job.status = 'failed'
+                    job.result.set_exception(e)
+            finally:
+                if not job.result.done():
+                    job.result.cancel()
+                self.running.pop(job.id, None)
+                self.queue.task_done()
+
+    async def _run(self, job: ImageJob) -> str:
+        """Переводит промпт задачи (уже в воркере, отменяемо) и генерирует изображение"""
+        if job.params is None:
+            job.params = self.build_params(await self.translate_prompt(job.prompt))
+        return await self.generate_image(job.prompt, job.params)
+
+    @staticmethod
+    def is_english(text: str) -> bool:
+        """Дешёвая локальная проверка: в тексте только латиница (без кириллицы)"""
+        letters = [ch for ch in text if ch.isalpha()]
+        if not letters:
+            return False
+        latin = sum(1 for ch in letters if 'a' <= ch.lower() <= 'z')
+        return latin / len(letters) >= 0.9
 
     async def translate_prompt(self, prompt: str) -> str:
         """Переводит промпт на английский и добавляет улучшающие модификаторы через OpenAI только через прокси"""
+        prompt = ' '.join(prompt.split())
+        # Английский промпт не переводим: только добавляем модификаторы
+        if self.is_english(prompt):
+            logger.info("🔄 Промпт уже на английском, перевод не нужен")
+            return f"{prompt}, {self.QUALITY_MODIFIERS}"
+        cache_key = self.normalize_prompt(prompt)
+        cached = self.translation_cache.get(cache_key)
+        if cached:
+            logger.info(f"🔄 Перевод промпта из кэша: {cached}")
+            return cached
         try:
             system_prompt = (
                 "Переведи текст на английский и добавь модификаторы. Верни ТОЛЬКО финальный промпт без объяснений. "
-                "Добавь в конец: high quality, detailed, sharp focus, professional photography, cinematic lighting, masterpiece, best quality"
+                f"Добавь в конец: {self.QUALITY_MODIFIERS}"
             )
-            openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            response = openai_client.chat.completions.create(
+            response = await get_openai_client().chat.completions.create(
                 model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -530,55 +951,96 @@ class ImageGenerator:
             enhanced_prompt = re.sub(r'\s+', ' ', enhanced_prompt)
             enhanced_prompt = re.sub(r'[\*\[\]#]', '', enhanced_prompt)
             logger.info(f"🔄 Промпт переведен и улучшен (OpenAI): {enhanced_prompt}")
+            if enhanced_prompt:
+                self.translation_cache.set(cache_key, enhanced_prompt)
             return enhanced_prompt
         except Exception as e:
             logger.error(f"❌ Ошибка при переводе промпта через OpenAI: {e}")
-            return f"{prompt}, high quality, detailed, sharp focus, professional photography, cinematic lighting, masterpiece, best quality"
+            return f"{prompt}, {self.QUALITY_MODIFIERS}"
     
-    async def generate_image(self, prompt: str) -> str:
+    async def generate_image(self, prompt: str, params: dict = None) -> str:
         """Генерирует изображение используя Replicate API"""
         try:
-            # Переводим и улучшаем промпт
-            enhanced_prompt = await self.translate_prompt(prompt)
-            
-            # Параметры для генерации
-            params = {
-                "prompt": enhanced_prompt,
-                "go_fast": True,
-                "megapixels": "1",
-                "num_outputs": 1,
-                "aspect_ratio": "1:1",
-                "output_format": "jpg",
-                "output_quality": 80,
-                "num_inference_steps": 4
-            }
+            if params is None:
+                # Переводим и улучшаем промпт
+                params = self.build_params(await self.translate_prompt(prompt))
             
             logger.info(f"🎨 Отправляем запрос на генерацию с параметрами: {params}")
             
-            # Создаем предсказание используя replicate.run()
-            output = replicate.run(
-                self.model_version,
+            # Асинхронное предсказание: создаём и опрашиваем статус, не блокируя event loop
+            prediction = await self.client.models.predictions.async_create(
+                model=self.model_version,
                 input=params
             )
+            try:
+                deadline = time.monotonic() + self.timeout
+                while prediction.status not in ("succeeded", "failed", "canceled"):
+                    if time.monotonic() > deadline:
+                        raise asyncio.TimeoutError()
+                    await asyncio.sleep(self.poll_interval)
+                    prediction = await self.client.predictions.async_get(prediction.id)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                # Останавливаем генерацию на стороне Replicate, чтобы не тратить квоту
+                try:
+                    await asyncio.shield(self.client.predictions.async_cancel(prediction.id))
+                except Exception as cancel_error:
+                    logger.warning(f"Не удалось отменить предсказание {prediction.id}: {cancel_error}")
+                raise
+            
+            if prediction.status != "succeeded":
+                raise Exception(f"Генерация завершилась со статусом {prediction.status}: {prediction.error}")
             
             # Получаем URL изображения
+            output = prediction.output
             if output:
                 # Для flux-schnell output это список, берем первый элемент
-                image_data = next(iter(output))
-                image_url = str(image_data)
+                image_url = str(output[0] if isinstance(output, list) else output)
                 logger.info(f"✅ Изображение успешно сгенерировано: {image_url}")
                 return image_url
             else:
                 raise Exception("Пустой результат генерации")
                 
+        except asyncio.CancelledError:
+            logger.info("🛑 Генерация изображения отменена")
+            raise
         except Exception as e:
             logger.error(f"❌ Ошибка при генерации изображения: {e}")
             raise
 
 class FileHandler:
-    def __init__(self, model):
+    """Анализ файлов через Gemini File API.
+
+    Файл из Telegram скачивается потоково во временный файл (хэш считается
+    по ходу загрузки), затем отправляется в Gemini возобновляемой загрузкой.
+    Файл целиком в памяти не держится, а загрузки переиспользуются по SHA-256
+    содержимого, пока Gemini их хранит. Текст PDF, DOCX и TXT извлекается
+    локально и резюмируется по частям. Готовые результаты анализа хранятся
+    в БД по SHA-256 и нормализованному запросу.
+    """
+
+    UPLOAD_TTL = 46 * 3600  # Gemini хранит загруженные файлы 48 часов
+    CHUNK_SIZE = 1024 * 1024
+
+    MAP_PROMPT = (
+        "Ты получаешь фрагмент большого документа. Кратко изложи его содержание на русском языке: "
+        "ключевые мысли, факты, цифры, имена и выводы. Не добавляй ничего от себя и не пиши вступлений."
+    )
+    REDUCE_PROMPT = (
+        "Ты получаешь конспекты последовательных частей одного документа. "
+        "Объедини их в связный конспект на русском языке без повторов, сохранив факты, цифры и выводы."
+    )
+
+    def __init__(self, model, max_file_size: int = 20 * 1024 * 1024, db: Database = None,
+                 cache_size: int = 500, chunk_tokens: int = 6000, max_concurrency: int = 4,
+                 max_chunks: int = 100):
         self.model = model
-        self.max_file_size = 20 * 1024 * 1024  # 20 MB
+        self.db = db
+        self.cache_size = cache_size
+        self.chunk_tokens = chunk_tokens  # Размер чанка документа для одного запроса
+        self.max_concurrency = max_concurrency  # Одновременных запросов по чанкам одного документа
+        self.max_chunks = max_chunks  # Дальше документ не читается, чтобы не жечь квоту
+        # Bot API отдаёт ботам файлы до 20 МБ; с локальным Bot API сервером лимит можно поднять
+        self.max_file_size = max_file_size
         self.mime_types = {
             'application/pdf': 'PDF',
             'application/msword': 'DOC',
@@ -588,133 +1050,352 @@ class FileHandler:
             'image/png': 'PNG',
             'video/mp4': 'MP4',
             'audio/mpeg': 'MP3',
-            'audio/wav': 'WAV'
+            'audio/wav': 'WAV',
+            'audio/ogg': 'OGG'
         }
+        self.uploads: Dict[str, Tuple[Any, float]] = {}  # sha256 -> (файл Gemini, срок годности)
+        self.http = None
         self.logger = logging.getLogger(__name__)
 
-    async def process_file(self, file_data: bytes, file_name: str, mime_type: str, user_prompt: str = None) -> Tuple[bool, str]:
-        """Обработка файла через Gemini API"""
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    @staticmethod
+    def extract_file_info(message: Message) -> Optional[Dict[str, Any]]:
+        """Достаёт из сообщения описание вложенного файла (документ, фото, видео, аудио, голос)"""
+        if message is None:
+            return None
+        if message.document:
+            attachment = message.document
+            mime_type = attachment.mime_type or mimetypes.guess_type(attachment.file_name or '')[0]
+            file_name = attachment.file_name or 'document'
+        elif message.photo:
+            attachment = message.photo[-1]  # Самое большое разрешение
+            mime_type, file_name = 'image/jpeg', 'photo.jpg'
+        elif message.video:
+            attachment = message.video
+            mime_type, file_name = attachment.mime_type or 'video/mp4', attachment.file_name or 'video.mp4'
+        elif message.audio:
+            attachment = message.audio
+            mime_type, file_name = attachment.mime_type or 'audio/mpeg', attachment.file_name or 'audio.mp3'
+        elif message.voice:
+            attachment = message.voice
+            mime_type, file_name = attachment.mime_type or 'audio/ogg', 'voice.ogg'
+        else:
+            return None
+        return {
+            'file_id': attachment.file_id,
+            'file_unique_id': attachment.file_unique_id,
+            'file_size': attachment.file_size,
+            'file_name': file_name,
+            'mime_type': mime_type,
+        }
+
+    async def download_to_temp(self, bot, file_info: Dict[str, Any]) -> Tuple[str, str, int]:
+        """Потоково скачивает файл Telegram во временный файл: (путь, sha256, размер)"""
+        tg_file = await bot.get_file(file_info['file_id'])
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+        suffix = pathlib.Path(file_info['file_name']).suffix
+        fd, path = tempfile.mkstemp(prefix="brat_", suffix=suffix)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as spool:
+                async with self.http.stream("GET", tg_file.file_path) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_file_size:
+                            raise ValueError("Файл слишком большой")
+                        digest.update(chunk)
+                        await asyncio.to_thread(spool.write, chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        self.logger.info(f"📥 Файл {file_info['file_name']} скачан: {size} байт")
+        return path, digest.hexdigest(), size
+
+    async def upload(self, path: str, sha256: str, mime_type: str, display_name: str):
+        """Загружает файл в Gemini (или берёт уже загруженный с тем же содержимым)"""
+        uploaded = self.get_active_upload(sha256)
+        if uploaded is not None:
+            self.logger.info(f"♻️ Файл {display_name} уже загружен в Gemini: {uploaded.name}")
+            return uploaded
+        uploaded = await asyncio.to_thread(
+            genai.upload_file, path, mime_type=mime_type, display_name=display_name[:100], resumable=True
+        )
+        # Видео и аудио Gemini обрабатывает асинхронно — ждём готовности
+        while uploaded.state.name == "PROCESSING":
+            await asyncio.sleep(2)
+            uploaded = await asyncio.to_thread(genai.get_file, uploaded.name)
+        if uploaded.state.name == "FAILED":
+            raise Exception(f"Gemini не смог обработать файл {display_name}")
+        self.uploads[sha256] = (uploaded, time.monotonic() + self.UPLOAD_TTL)
+        self.logger.info(f"📤 Файл {display_name} загружен в Gemini: {uploaded.name}")
+        return uploaded
+
+    @staticmethod
+    def normalize_prompt(user_prompt: str = None) -> str:
+        """Ключ запроса для кэша: регистр, ё и пробелы/пунктуация по краям не важны"""
+        return normalize_text(user_prompt or '').strip(' .,!?;:')
+
+    def get_active_upload(self, sha256: str):
+        cached = self.uploads.get(sha256)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+        return None
+
+    @staticmethod
+    def build_prompt(mime_type: str, user_prompt: str = None) -> str:
+        if 'image' in mime_type:
+            return f"Опиши подробно, что изображено на этой картинке. {user_prompt if user_prompt else ''}"
+        elif 'video' in mime_type:
+            return f"Опиши подробно содержание этого видео. {user_prompt if user_prompt else ''}"
+        elif 'audio' in mime_type:
+            return f"Опиши подробно содержание этой аудиозаписи. {user_prompt if user_prompt else ''}"
+        return f"Проанализируй и сделай подробное резюме этого документа. {user_prompt if user_prompt else ''}"
+
+    async def process_file(self, file_path: str, file_name: str, mime_type: str, user_prompt: str = None,
+                           sha256: str = None) -> Tuple[bool, str]:
+        """Обработка файла с диска через Gemini File API"""
         try:
             self.logger.info(f"🔄 Начинаю обработку файла: {file_name} (тип: {mime_type})")
             
             # Проверяем размер файла
-            file_size = len(file_data)
-            if file_size > self.max_file_size:
-                return False, "Файл слишком большой. Максимальный размер: 20 МБ"
+            if os.path.getsize(file_path) > self.max_file_size:
+                return False, f"Файл слишком большой. Максимальный размер: {self.max_file_size // (1024 * 1024)} МБ"
 
             # Проверяем тип файла
             if mime_type not in self.mime_types:
                 return False, "Неподдерживаемый тип файла"
 
-            # Кодируем файл в base64
-            file_base64 = base64.b64encode(file_data).decode('utf-8')
+            if can_extract(mime_type):
+                summary = await self.summarize_document(file_path, mime_type, user_prompt)
+                if summary:
+                    return True, summary
+                # Текста нет (например, скан) — пусть модель посмотрит на сам файл
+                self.logger.info(f"📄 В файле {file_name} нет текстового слоя, отправляю файл целиком")
 
-            # Формируем промпт в зависимости от типа файла
-            if 'image' in mime_type:
-                prompt = f"Опиши подробно, что изображено на этой картинке. {user_prompt if user_prompt else ''}"
-            elif 'video' in mime_type:
-                prompt = f"Опиши подробно содержание этого видео. {user_prompt if user_prompt else ''}"
-            elif 'audio' in mime_type:
-                prompt = f"Опиши подробно содержание этой аудиозаписи. {user_prompt if user_prompt else ''}"
-            else:
-                prompt = f"Проанализируй и сделай подробное резюме этого документа. {user_prompt if user_prompt else ''}"
-
-            # Создаем запрос для Gemini
-            request = {
-                "contents": [{
-                    "parts": [
-                        {"text": prompt},
-                        {
-                            "inline_data": {
-                                "mime_type": mime_type,
-                                "data": file_base64
-                            }
-                        }
-                    ]
-                }]
-            }
-
-            # Отправляем запрос
-            response = self.model.generate_content(**request)
-            
-            if response and response.text:
-                return True, response.text
-            else:
-                return False, "Не удалось обработать файл"
+            if sha256 is None:
+                sha256 = await asyncio.to_thread(self._hash_file, file_path)
+            uploaded = await self.upload(file_path, sha256, mime_type, file_name)
+            return await self.analyze_upload(uploaded, mime_type, user_prompt)
 
         except Exception as e:
             self.logger.error(f"❌ Ошибка при обработке файла: {str(e)}", exc_info=True)
             return False, f"Произошла ошибка при обработке файла: {str(e)}"
 
+    async def summarize_document(self, file_path: str, mime_type: str, user_prompt: str = None) -> Optional[str]:
+        """Резюме документа по локально извлечённому тексту.
+
+        Текст читается потоково и режется на чанки; в памяти одновременно
+        не больше max_concurrency чанков — следующий читается, только когда
+        освобождается слот. Конспекты чанков затем сводятся в один ответ.
+        """
+        chunks = iter_chunks(iter_text(file_path, mime_type), self.chunk_tokens)
+        first = await asyncio.to_thread(next, chunks, None)
+        if first is None:
+            return None
+        second = await asyncio.to_thread(next, chunks, None)
+        if second is None:
+            # Документ влезает в один запрос
+            return await generate_response(
+                [{"role": "user", "content": first}], self.build_prompt(mime_type, user_prompt)
+            )
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = []
+        pending = [first, second]
+        try:
+            while len(tasks) < self.max_chunks:
+                await semaphore.acquire()
+                chunk = pending.pop(0) if pending else await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    semaphore.release()
+                    break
+                tasks.append(asyncio.create_task(self._summarize_chunk(chunk, semaphore)))
+            else:
+                # Лимит достигнут — предупреждаем, только если за ним действительно что-то осталось
+                if await asyncio.to_thread(next, chunks, None) is not None:
+                    self.logger.warning(f"⚠️ Документ длиннее {self.max_chunks} частей, остаток пропущен")
+            self.logger.info(f"📄 Документ разбит на {len(tasks)} частей")
+            partials = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            try:
+                chunks.close()
+            except ValueError:
+                pass  # Генератор ещё читается в потоке (запрос отменён) — закроется сборщиком мусора
+
+        partials = [p for p in partials if p]
+        # Если конспекты всё ещё не влезают в один запрос — сводим их группами
+        while len(partials) > 1 and estimate_tokens("\n\n".join(partials)) > self.chunk_tokens:
+            groups = list(iter_chunks((p + "\n\n" for p in partials), self.chunk_tokens))
+            if len(groups) >= len(partials):
+                break
+            partials = [p for p in await asyncio.gather(*(
+                self._reduce(group, semaphore) for group in groups
+            )) if p]
+
+        text = "\n\n".join(f"Часть {i + 1}:\n{p}" for i, p in enumerate(partials))
+        return await generate_response(
+            [{"role": "user", "content": text}],
+            f"{self.REDUCE_PROMPT} Составь по ним итоговый ответ. {user_prompt if user_prompt else ''}"
+        )
+
+    async def _summarize_chunk(self, chunk: str, semaphore: asyncio.Semaphore) -> str:
+        try:
+            return await generate_response([{"role": "user", "content": chunk}], self.MAP_PROMPT)
+        finally:
+            semaphore.release()
+
+    async def _reduce(self, text: str, semaphore: asyncio.Semaphore) -> str:
+        async with semaphore:
+            return await generate_response([{"role": "user", "content": text}], self.REDUCE_PROMPT)
+
+    async def analyze_upload(self, uploaded, mime_type: str, user_prompt: str = None) -> Tuple[bool, str]:
+        """Запрос к модели со ссылкой на загруженный файл вместо данных в теле запроса"""
+        response = await self.model.generate_content_async([uploaded, self.build_prompt(mime_type, user_prompt)])
+        if response and response.text:
+            return True, response.text
+        return False, "Не удалось обработать файл"
+
+    async def process_telegram_file(self, bot, file_info: Dict[str, Any], user_prompt: str = None) -> Tuple[bool, str]:
+        """Скачивает файл из Telegram во временный файл, анализирует и удаляет его"""
+        if file_info['mime_type'] not in self.mime_types:
+            return False, "Неподдерживаемый тип файла"
+        if file_info.get('file_size') and file_info['file_size'] > self.max_file_size:
+            return False, f"Файл слишком большой. Максимальный размер: {self.max_file_size // (1024 * 1024)} МБ"
+
+        prompt_key = self.normalize_prompt(user_prompt)
+        # Файл уже встречался — скачивать его не нужно
+        known_sha256 = await self.db.get_file_hash(file_info['file_unique_id']) if self.db else None
+        if known_sha256:
+            cached = await self.db.get_file_analysis(known_sha256, prompt_key)
+            if cached:
+                self.logger.info(f"💾 Анализ файла {file_info['file_name']} взят из кэша (file_unique_id)")
+                return True, cached
+            uploaded = self.get_active_upload(known_sha256)
+            if uploaded is not None:
+                try:
+                    success, result = await self.analyze_upload(uploaded, file_info['mime_type'], user_prompt)
+                except Exception as e:
+                    self.logger.warning(f"⚠️ Не удалось использовать загруженный файл {uploaded.name}: {e}")
+                    self.uploads.pop(known_sha256, None)
+                else:
+                    if success:
+                        await self.remember(file_info, known_sha256, prompt_key, result)
+                    return success, result
+
+        try:
+            path, sha256, _ = await self.download_to_temp(bot, file_info)
+        except ValueError:
+            return False, f"Файл слишком большой. Максимальный размер: {self.max_file_size // (1024 * 1024)} МБ"
+        except Exception as e:
+            self.logger.error(f"❌ Ошибка при скачивании файла: {e}")
+            return False, "Не удалось скачать файл из Telegram"
+        try:
+            # Тот же файл мог прийти с другим file_unique_id (например, загружен заново)
+            cached = await self.db.get_file_analysis(sha256, prompt_key) if self.db else None
+            if cached:
+                self.logger.info(f"💾 Анализ файла {file_info['file_name']} взят из кэша (SHA-256)")
+                await self.remember(file_info, sha256, prompt_key, cached)
+                return True, cached
+            success, result = await self.process_file(
+                path, file_info['file_name'], file_info['mime_type'], user_prompt, sha256
+            )
+            if success:
+                await self.remember(file_info, sha256, prompt_key, result)
+            return success, result
+        finally:
+            os.remove(path)
+
+    async def remember(self, file_info: Dict[str, Any], sha256: str, prompt_key: str, result: str):
+        if self.db:
+            await self.db.save_file_analysis(
+                file_info.get('file_unique_id'), sha256, prompt_key, file_info['mime_type'], result, self.cache_size
+            )
+
+    @classmethod
+    def _hash_file(cls, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
 class RateLimiter:
+    # Дорогие операции с отдельными лимитами на пользователя:
+    # операция -> (запросов в минуту, допустимый всплеск, название для сообщения)
+    OPERATION_LIMITS = {
+        'image': (2, 3, "генерация изображений"),
+        'search': (6, 3, "поиск в интернете"),
+        'file': (2, 3, "анализ файлов"),
+    }
+
     def __init__(self):
-        # Ограничения по количеству запросов в минуту для пользователя
-        self.user_limits = defaultdict(lambda: {
-            'requests': 0,
-            'last_reset': time.time(),
-            'blocked_until': None
-        })
-        
-        # Ограничения для группы
-        self.group_limits = defaultdict(lambda: {
-            'requests': 0,
-            'last_reset': time.time()
-        })
-        
         # Настройки лимитов
         self.MAX_REQUESTS_PER_MINUTE = 30  # Максимум запросов в минуту для пользователя
         self.GROUP_MAX_REQUESTS_PER_MINUTE = 100  # Максимум запросов в минуту для группы
         self.BLOCK_DURATION = 300  # Длительность блокировки в секундах (5 минут)
-        self.RESET_INTERVAL = 60  # Интервал сброса счетчиков в секундах
-        
-        # Список заблокированных пользователей
-        self.blocked_users = set()
-        
-    def _reset_counters(self, user_id: int, chat_id: int):
-        """Сброс счетчиков если прошел интервал"""
-        current_time = time.time()
-        
-        # Сброс пользовательских счетчиков
-        if current_time - self.user_limits[user_id]['last_reset'] >= self.RESET_INTERVAL:
-            self.user_limits[user_id]['requests'] = 0
-            self.user_limits[user_id]['last_reset'] = current_time
-            
-        # Сброс групповых счетчиков
-        if current_time - self.group_limits[chat_id]['last_reset'] >= self.RESET_INTERVAL:
-            self.group_limits[chat_id]['requests'] = 0
-            self.group_limits[chat_id]['last_reset'] = current_time
-            
+
+        # Ограничения по количеству запросов для пользователя и для группы
+        self.user_limits = TokenBucket(self.MAX_REQUESTS_PER_MINUTE / 60, self.MAX_REQUESTS_PER_MINUTE)
+        self.group_limits = TokenBucket(self.GROUP_MAX_REQUESTS_PER_MINUTE / 60, self.GROUP_MAX_REQUESTS_PER_MINUTE)
+        self.operation_limits = {
+            operation: TokenBucket(per_minute / 60, burst)
+            for operation, (per_minute, burst, _) in self.OPERATION_LIMITS.items()
+        }
+
+        # Заблокированные пользователи (запись сама истекает через BLOCK_DURATION)
+        self.blocked_users = TTLCache(maxsize=10000, ttl=self.BLOCK_DURATION)
+
     def is_allowed(self, user_id: int, chat_id: int) -> tuple[bool, str]:
         """Проверка возможности обработки запроса"""
-        self._reset_counters(user_id, chat_id)
-        
         # Проверка блокировки пользователя
-        if user_id in self.blocked_users:
-            blocked_until = self.user_limits[user_id]['blocked_until']
-            if blocked_until and time.time() < blocked_until:
-                remaining = int(blocked_until - time.time())
-                return False, f"Вы временно заблокированы. Осталось {remaining} секунд."
-            else:
-                self.blocked_users.remove(user_id)
-        
+        blocked_until = self.blocked_users.get(user_id)
+        if blocked_until:
+            remaining = int(blocked_until - time.time())
+            return False, f"Вы временно заблокированы. Осталось {remaining} секунд."
+
         # Проверка лимитов пользователя
-        user_requests = self.user_limits[user_id]['requests']
-        if user_requests >= self.MAX_REQUESTS_PER_MINUTE:
-            self.blocked_users.add(user_id)
-            self.user_limits[user_id]['blocked_until'] = time.time() + self.BLOCK_DURATION
+        if self.user_limits.retry_after(user_id):
+            self.blocked_users.set(user_id, time.time() + self.BLOCK_DURATION)
             return False, f"Превышен лимит запросов. Блокировка на {self.BLOCK_DURATION} секунд."
-            
+
         # Проверка лимитов группы
-        group_requests = self.group_limits[chat_id]['requests']
-        if group_requests >= self.GROUP_MAX_REQUESTS_PER_MINUTE:
+        if self.group_limits.retry_after(chat_id):
             return False, "Превышен групповой лимит запросов. Попробуйте позже."
-            
-        # Увеличение счетчиков
-        self.user_limits[user_id]['requests'] += 1
-        self.group_limits[chat_id]['requests'] += 1
-        
+
+        # Списание запроса
+        self.user_limits.consume(user_id)
+        self.group_limits.consume(chat_id)
+
         return True, ""
-        
+
+    def is_operation_allowed(self, user_id: int, operation: str) -> tuple[bool, str]:
+        """Отдельный лимит на дорогую операцию (изображения, поиск, файлы)"""
+        bucket = self.operation_limits.get(operation)
+        if bucket is None:
+            return True, ""
+        wait = bucket.consume(user_id)
+        if wait:
+            title = self.OPERATION_LIMITS[operation][2]
+            return False, f"⏱ Слишком часто: {title}. Попробуйте через {int(wait) + 1} сек."
+        return True, ""
+
+    def stats(self) -> dict:
+        """Пользователи и группы, отправлявшие запросы за последнюю минуту, и число блокировок"""
+        return {
+            'active_users': len(self.user_limits),
+            'active_groups': len(self.group_limits),
+            'blocked_users': self.blocked_users.purge_expired(),
+        }
+
     async def log_suspicious_activity(self, user_id: int, chat_id: int, message: str):
         """Логирование подозрительной активности"""
         logger.warning(
@@ -734,6 +1415,21 @@ class BratBot:
         self.image_generator = None
         self.file_handler = None
         self.rate_limiter = RateLimiter()
+        # Контроль нагрузки: у каждого типа операций свои слоты и бюджет в минуту
+        self.admission = AdmissionController()
+        self.admission.configure('chat', "ответы", concurrency=int(os.getenv('LLM_CONCURRENCY', '8')),
+                                 max_waiting=50, budget_per_minute=120)
+        self.admission.configure('search', "поиск в интернете", concurrency=int(os.getenv('SEARCH_CONCURRENCY', '3')),
+                                 max_waiting=10, budget_per_minute=30)
+        self.admission.configure('file', "анализ файлов", concurrency=int(os.getenv('FILE_CONCURRENCY', '2')),
+                                 max_waiting=5, budget_per_minute=20)
+        self.admission.configure('image', "генерация изображений", budget_per_minute=10)
+        self.conversation = ConversationContext(self.db)
+        self.summarizer = SummaryWorker(self.db, max_concurrency=int(os.getenv('SUMMARY_WORKERS', '2')))
+        self.member_index = MemberIndex()
+        self.roster = MemberRoster(self.db)
+        self.response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+        self.background_tasks = set()  # Фоновые задачи доставки (держим ссылки до завершения)
         self.waiting_for_profile = {}  # user_id: {'mode': 'register'/'update', 'msg_id': ...}
         
     async def setup(self, application: Application = None):
@@ -742,27 +1438,33 @@ class BratBot:
             logger.info("Начинаю инициализацию бота...")
             
             # Загружаем актуальный системный промпт
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT value FROM settings WHERE key = 'system_prompt'")
-                row = cursor.fetchone()
-                if row:
-                    self.system_prompt = row[0]
-                    logger.info("✅ Загружен актуальный системный промпт из базы данных")
-                else:
-                    # Сохраняем начальный системный промпт
-                    cursor.execute(
-                        "INSERT INTO settings (key, value) VALUES (?, ?)",
-                        ('system_prompt', self.system_prompt)
-                    )
-                    conn.commit()
-                    logger.info("✅ Создан начальный системный промпт")
+            # (в базе хранится только базовый промпт, список участников — отдельно)
+            stored_prompt = await self.db.get_system_prompt()
+            base_prompt = MemberRoster.strip(stored_prompt)
+            if base_prompt:
+                self.system_prompt = base_prompt
+                if base_prompt != stored_prompt:
+                    await self.db.update_system_prompt(base_prompt)
+                logger.info("✅ Загружен актуальный системный промпт из базы данных")
+            else:
+                # Сохраняем начальный системный промпт
+                await self.db.update_system_prompt(self.system_prompt)
+                logger.info("✅ Создан начальный системный промпт")
+            await self.roster.load()
+
+            # Индекс специализаций участников для поиска по категориям
+            await self.rebuild_member_index()
 
             # Инициализация Perplexity API
             perplexity_api_key = os.getenv('PERPLEXITY_API_KEY')
             if perplexity_api_key:
                 try:
-                    self.perplexity = PerplexityAPI(perplexity_api_key)
+                    self.perplexity = PerplexityAPI(
+                        perplexity_api_key,
+                        timeout=float(os.getenv('PERPLEXITY_TIMEOUT', '30')),
+                        cache_ttl=float(os.getenv('PERPLEXITY_CACHE_TTL', '300')),
+                    )
+                    await self.perplexity.start()
                     logger.info("Perplexity API успешно инициализирован")
                 except Exception as e:
                     logger.error(f"❌ Ошибка инициализации Perplexity API: {e}")
@@ -774,7 +1476,13 @@ class BratBot:
             # Инициализация Image Generator
             if REPLICATE_API_TOKEN:
                 try:
-                    self.image_generator = ImageGenerator(REPLICATE_API_TOKEN)
+                    self.image_generator = ImageGenerator(
+                        REPLICATE_API_TOKEN,
+                        db=self.db,
+                        max_workers=int(os.getenv('IMAGE_WORKERS', '2')),
+                        cache_size=int(os.getenv('IMAGE_CACHE_SIZE', '1000'))
+                    )
+                    self.image_generator.start()
                     logger.info("Image Generator успешно инициализирован")
                 except Exception as e:
                     logger.error(f"❌ Ошибка инициализации Image Generator: {e}")
@@ -785,12 +1493,22 @@ class BratBot:
 
             # Инициализация FileHandler
             try:
-                self.file_handler = FileHandler(vision_model)
+                self.file_handler = FileHandler(
+                    get_gemini_model(),
+                    max_file_size=int(os.getenv('FILE_MAX_SIZE_MB', '20')) * 1024 * 1024,
+                    db=self.db,
+                    cache_size=int(os.getenv('FILE_CACHE_SIZE', '500')),
+                    chunk_tokens=int(os.getenv('DOCUMENT_CHUNK_TOKENS', '6000')),
+                    max_concurrency=int(os.getenv('DOCUMENT_CONCURRENCY', '4'))
+                )
                 logger.info("✅ FileHandler успешно инициализирован")
             except Exception as e:
                 logger.error(f"❌ Ошибка инициализации FileHandler: {e}")
                 self.file_handler = None
 
+            # Фоновая саммаризация диалогов
+            self.summarizer.start()
+
             # Настройка команд бота если есть application
             if application:
                 await self.setup_commands(application)
@@ -907,61 +1625,66 @@ class BratBot:
         )
         await update.message.reply_text(info_text)
 
+    async def prepare_model_prompt(self, messages: list, user_id: int) -> Tuple[list, str]:
+        """Подготавливает последние сообщения и переменную часть промпта для модели.
+
+        Базовый системный промпт сюда не входит: он передаётся провайдеру отдельно
+        как стабильный префикс, который кэшируется между запросами.
+        Весь запрос укладывается в бюджет токенов провайдера: сначала резервируются
+        системный промпт, участники и последние сообщения, остаток заполняется
+        саммари от новых к старым — самые старые отбрасываются первыми.
+        """
+        logger.info(f"📝 Начинаю обработку контекста из {len(messages)} сообщений для user_id={user_id}")
+        budget = get_prompt_budget() - estimate_tokens(self.system_prompt)
+
+        current_text = messages[-1]['content'] if messages and messages[-1]['role'] == 'user' else ''
+        members_context = await self.get_members_context(current_text)
+        budget -= estimate_tokens(members_context)
+
+        # История передаётся провайдеру сообщениями; самое новое сообщение остаётся всегда
+        last_msgs = []
+        for msg in reversed(messages[-10:]):
+            cost = estimate_tokens(msg['content']) + 4
+            if last_msgs and cost > budget:
+                break
+            last_msgs.append(msg)
+            budget -= cost
+        last_msgs.reverse()
+
+        # Саммари создаются в фоне (SummaryWorker), здесь только читаем готовые
+        all_summaries = await self.db.get_all_summaries(user_id) if user_id else []
+        selected = []
+        for summ in reversed(all_summaries):
+            cost = estimate_tokens(summ['summary']) + 10
+            if cost > budget:
+                break
+            selected.append(summ)
+            budget -= cost
+        selected.reverse()
+        if len(selected) < len(all_summaries):
+            logger.info(f"[PROMPT] Бюджет токенов: отброшено старых саммари {len(all_summaries) - len(selected)}")
+        if selected:
+            logger.info(f"[PROMPT] Используются саммари: {len(selected)} из {len(all_summaries)}")
+        else:
+            logger.info(f"[PROMPT] Нет саммари, используется только история сообщений.")
+
+        parts = [members_context + "\n\n"] if members_context else []
+        first_block = len(all_summaries) - len(selected) + 1
+        for idx, summ in enumerate(selected, start=first_block):
+            title = SUMMARY_TIER_TITLES.get(summ.get('tier', 0), SUMMARY_TIER_TITLES[0])
+            parts.append(f"[{title} {idx}]\n{summ['summary']}\n\n")
+        prompt = "".join(parts).rstrip()
+        logger.info(
+            f"[LLM] Переменная часть промпта ({len(prompt)} символов, сообщений истории: {len(last_msgs)}, "
+            f"остаток бюджета: {budget} токенов)"
+        )
+        logger.debug(f"[LLM] Переменная часть промпта:\n{prompt}")
+        return last_msgs, prompt
+
     async def get_model_response(self, messages: list, user_id: int) -> str:
         try:
-            logger.info(f"📝 Начинаю обработку контекста из {len(messages)} сообщений для user_id={user_id}")
-            # Получаем все саммари пользователя
-            all_summaries = []
-            if user_id:
-                all_summaries = self.db.get_all_summaries(user_id)
-            # Определяем, нужно ли создать новое саммари
-            block_size = 30
-            last_summarized_idx = 0
-            last_end = None
-            if all_summaries:
-                last_end = all_summaries[-1]['end_timestamp']
-                # last_end может быть None, если в базе что-то не так
-                for i, msg in enumerate(messages):
-                    msg_ts = msg.get('timestamp')
-                    if last_end and msg_ts and msg_ts > last_end:
-                        last_summarized_idx = i
-                        break
-            unsummarized = messages[last_summarized_idx: -10 if len(messages) > 10 else None]
-            if len(unsummarized) >= block_size:
-                logger.info(f"🟡 Новый блок для саммаризации: {len(unsummarized)} сообщений")
-                # Новый смысловой промпт для саммари:
-                summary_prompt = (
-                    "Прочитай диалог ниже и сделай краткое смысловое описание: \n"
-                    "- О чём спрашивал пользователь?\n"
-                    "- Какие задачи или вопросы поднимались?\n"
-                    "- Какие ответы и советы дал ассистент?\n"
-                    "- Не пересказывай всё подряд, выдели только суть и ключевые моменты, без лишних деталей.\n"
-                    "- Не копируй текст сообщений, а именно опиши, что происходило.\n\n"
-                )
-                for msg in unsummarized:
-                    role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-                    summary_prompt += f"{role}: {msg['content']}\n"
-                logger.info(f"[SUMMARIZATION] Промпт для саммаризации ({len(summary_prompt)} символов):\n{summary_prompt[:300]}...\n[...]")
-                # Используем ту же модель, что и для обычных ответов:
-                summary = generate_response(unsummarized, summary_prompt)
-                logger.info(f"[SUMMARIZATION] Саммари ({len(summary)} символов):\n{summary[:300]}...\n[...]")
-                await self.db.create_chat_summary(user_id, summary)
-                all_summaries = self.db.get_all_summaries(user_id)
-            else:
-                if all_summaries:
-                    logger.info(f"[PROMPT] Нет новых блоков для саммаризации. Используются саммари: {[i+1 for i in range(len(all_summaries))]}")
-                else:
-                    logger.info(f"[PROMPT] Нет саммари, используется только история сообщений.")
-            prompt = self.system_prompt + "\n\n"
-            for idx, summ in enumerate(all_summaries):
-                prompt += f"[Краткое содержание блока {idx+1}]\n{summ['summary']}\n\n"
-            last_msgs = messages[-10:] if len(messages) > 10 else messages
-            prompt += "[Последние сообщения]\n"
-            for msg in last_msgs:
-                role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-                prompt += f"{role}: {msg['content']}\n"
-            logger.info(f"[LLM] Итоговый промпт ({len(prompt)} символов):\n{prompt}")
-            response = generate_response(last_msgs, prompt)
+            last_msgs, prompt = await self.prepare_model_prompt(messages, user_id)
+            response = await generate_response(last_msgs, self.system_prompt, context=prompt)
             formatted_response = format_response(response)
             logger.info(f"📥 Получен ответ от модели (длина: {len(formatted_response)} символов)")
             return formatted_response
@@ -969,6 +1692,95 @@ class BratBot:
             logger.error(f"❌ Ошибка при получении ответа от LLM: {str(e)}")
             raise
 
+    async def stream_model_response(self, messages: list, user_id: int):
+        """Потоковый вариант get_model_response: отдаёт фрагменты ответа по мере генерации"""
+        last_msgs, prompt = await self.prepare_model_prompt(messages, user_id)
+        async for chunk in stream_response(last_msgs, self.system_prompt, context=prompt):
+            yield chunk
+
+    def response_cache_key(self, text: str) -> Optional[tuple]:
+        """Ключ кэша ответов: нормализованный вопрос + версия промпта и списка участников.
+
+        Возвращает None для вопросов, которые нельзя кэшировать (личные,
+        зависящие от контекста диалога, слишком короткие). Сохраняются в кэш
+        только ответы, сгенерированные без истории и саммари пользователя.
+        """
+        if not text or len(text) > 300 or PERSONAL_QUESTION_PATTERN.search(text.replace('ё', 'е')):
+            return None
+        words = [normalize_search_term(w) for w in re.findall(r'\w+', text)]
+        words = [w for w in words if w not in QUESTION_FILLER_WORDS]
+        if len(words) < 2:
+            return None
+        prompt_version = hashlib.sha1(self.system_prompt.encode()).hexdigest()[:12]
+        return (prompt_version, self.roster.version, ' '.join(words))
+
+    async def reply_text_parts(self, message: Message, text: str):
+        """Отправляет текст, деля его на части по лимиту Telegram"""
+        for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+            await message.reply_text(text[i:i + TELEGRAM_MESSAGE_LIMIT])
+
+    async def reply_streaming(self, message: Message, chunks) -> Tuple[Optional[str], bool]:
+        """Отправляет заглушку и постепенно редактирует её по мере поступления ответа.
+
+        Возвращает (итоговый отформатированный ответ или None, ответ получен полностью).
+        При ошибке посреди потока уже полученный текст остаётся в сообщении.
+        """
+        placeholder = await message.reply_text("💭 Думаю...")
+        text = ""
+        shown = ""
+        next_edit_at = 0.0
+        complete = True
+        try:
+            async for chunk in chunks:
+                text += chunk
+                now = time.monotonic()
+                if now < next_edit_at or not text.strip():
+                    continue
+                preview = text[:TELEGRAM_MESSAGE_LIMIT - 2] + " ▌"
+                if preview != shown:
+                    delay = await self._edit_stream_message(placeholder, preview)
+                    shown = preview
+                    next_edit_at = time.monotonic() + max(STREAM_EDIT_INTERVAL, delay)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при потоковой генерации ответа: {str(e)}")
+            complete = False
+        response = format_response(text) if text.strip() else ""
+        if not response:
+            await self._edit_stream_message(
+                placeholder,
+                "Извините, не удалось сгенерировать ответ. Попробуйте переформулировать вопрос."
+            )
+            return None, False
+        shown_text = response if complete else f"{response}\n\n⚠️ Ответ оборвался из-за ошибки, попробуйте повторить вопрос."
+        # Финальный проход: отформатированный текст, длинные ответы делим на части
+        parts = [shown_text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(shown_text), TELEGRAM_MESSAGE_LIMIT)]
+        await self._edit_stream_message(placeholder, parts[0], final=True)
+        for part in parts[1:]:
+            await message.reply_text(part)
+        logger.info(
+            f"📥 Потоковый ответ доставлен (длина: {len(response)} символов"
+            f"{'' if complete else ', прерван ошибкой'})"
+        )
+        return response, complete
+
+    async def _edit_stream_message(self, placeholder: Message, text: str, final: bool = False) -> float:
+        """Редактирует сообщение с учётом лимитов Telegram. Возвращает рекомендуемую паузу в секундах"""
+        for _ in range(3 if final else 1):
+            try:
+                await placeholder.edit_text(text)
+                return 0.0
+            except telegram.error.RetryAfter as e:
+                logger.warning(f"⏳ Telegram ограничил частоту редактирования, пауза {e.retry_after} с")
+                if not final:
+                    return float(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except telegram.error.BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return 0.0
+                logger.error(f"❌ Ошибка при редактировании сообщения: {e}")
+                return 0.0
+        return 0.0
+
     async def register(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Инструкция по созданию профиля через 'брат профиль'"""
         # Удаляем приветственное сообщение, если оно есть
@@ -1053,93 +1865,90 @@ class BratBot:
                     profile_data[key] = user_info[key]
         # Сохраняем профиль
         try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-                exists = cursor.fetchone()
-                if exists:
-                    query = """
-                    UPDATE users SET 
-                        full_name = ?,
-                        telegram_nick = ?,
-                        occupation = ?,
-                        skills = ?,
-                        company_info = ?,
-                        links = ?,
-                        about = ?,
-                        last_active = CURRENT_TIMESTAMP,
-                        is_complete = TRUE
-                    WHERE user_id = ?
-                    """
-                    params = (
-                        profile_data.get('full_name'),
-                        profile_data.get('telegram_nick'),
-                        profile_data.get('occupation'),
-                        json.dumps(profile_data.get('skills', []), ensure_ascii=False),
-                        profile_data.get('company_info'),
-                        json.dumps(profile_data.get('links', {}), ensure_ascii=False),
-                        profile_data.get('about'),
-                        user_id
-                    )
-                else:
-                    query = """
-                    INSERT INTO users (
-                        user_id, full_name, telegram_nick, occupation,
-                        skills, company_info, links, about, last_active, is_complete
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, TRUE)
-                    """
-                    params = (
-                        user_id,
-                        profile_data.get('full_name'),
-                        profile_data.get('telegram_nick'),
-                        profile_data.get('occupation'),
-                        json.dumps(profile_data.get('skills', []), ensure_ascii=False),
-                        profile_data.get('company_info'),
-                        json.dumps(profile_data.get('links', {}), ensure_ascii=False),
-                        profile_data.get('about')
-                    )
-                cursor.execute(query, params)
-                conn.commit()
+            if not await self.db.save_user_profile(user_id, profile_data):
+                raise Exception("профиль не сохранён в базе данных")
+            self.on_profile_saved(user_id, profile_data)
             # Очищаем ожидание только после успешного сохранения
             if user_id in self.waiting_for_profile:
                 del self.waiting_for_profile[user_id]
-            # Обновляем системный промпт
-            await self.update_prompt_with_users()
             await update.message.reply_text("✅ Профиль успешно сохранён!")
         except Exception as e:
             logger.error(f"Ошибка при сохранении профиля: {e}")
             await update.message.reply_text("❌ Произошла ошибка при сохранении профиля. Попробуйте позже.")
 
-    async def update_prompt_with_users(self):
-        """Обновляет системный промпт с учётом всех пользователей"""
-        try:
-            user_lines = []
-            for full_name, occupation, skills_json, telegram_nick in [
-                (row[0], row[1], row[2], row[3])
-                for row in self.db.get_connection().cursor().execute(
-                    "SELECT full_name, occupation, skills, telegram_nick FROM users WHERE is_complete = TRUE"
-                )
-            ]:
-                skills = ', '.join(json.loads(skills_json)) if skills_json else ''
-                line = f"• {full_name} — {occupation} ({skills})"
-                if telegram_nick:
-                    if not telegram_nick.startswith('@'):
-                        telegram_nick = '@' + telegram_nick
-                    line += f" {telegram_nick}"
-                user_lines.append(line)
-            users_block = '\n'.join(user_lines)
-            new_prompt = SYSTEM_PROMPT + "\n\nВ сообществе зарегистрированы:\n" + users_block
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT OR REPLACE INTO settings (key, value, updated_at)
-                    VALUES ('system_prompt', ?, datetime('now'))
-                """, (new_prompt,))
-                conn.commit()
-            self.system_prompt = new_prompt
-            logger.info("Системный промпт обновлён с учётом пользователей")
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении промпта с пользователями: {e}")
+    def index_user_profile(self, user_id: int, profile: dict):
+        """Обновляет запись участника в индексе специализаций"""
+        skills = profile.get('skills') or []
+        self.member_index.update(user_id, [profile.get('occupation') or ''] + skills, skills)
+
+    async def rebuild_member_index(self):
+        """Полностью перестраивает индекс специализаций по профилям из базы"""
+        self.member_index.clear()
+        for user in await self.db.get_all_users():
+            self.index_user_profile(user['user_id'], user)
+        logger.info(f"🗂 Индекс специализаций построен: {len(self.member_index)} участников")
+
+    async def find_members(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Ищет участников: ранжированный полнотекстовый поиск + расширение по категории специализаций"""
+        found = await self.db.search_users(query, limit=limit)
+        seen = {member['user_id'] for member in found}
+        extra_ids = [uid for uid in self.member_index.lookup_category(query) if uid not in seen]
+        if extra_ids and len(found) < limit:
+            found += await self.db.get_users_by_ids(extra_ids[:limit - len(found)])
+        return found
+
+    def on_profile_saved(self, user_id: int, profile: dict):
+        """Точечно обновляет индекс специализаций и список участников после сохранения профиля"""
+        self.index_user_profile(user_id, profile)
+        self.roster.update(user_id, profile)
+
+    async def select_relevant_members(self, text: str, limit: int = ROSTER_TOP_K) -> List[int]:
+        """Отбирает не больше limit участников, относящихся к сообщению.
+
+        Учитывается намерение «брат ищу ...», категории специализаций
+        и совпадения по специализации и навыкам в полнотекстовом индексе.
+        """
+        query = text or ''
+        for pattern in SEARCH_PATTERNS:
+            match = re.search(pattern, query, re.IGNORECASE)
+            if match:
+                query = match.group(1).strip()
+                break
+        # Обращение к боту и стоп-слова есть почти в каждом сообщении — без значимых слов не ищем
+        if not significant_terms(query):
+            return []
+        selected = []
+        for member in await self.db.search_users(query, search_type='keyword', limit=limit):
+            selected.append(member['user_id'])
+        for user_id in self.member_index.lookup_category(query):
+            if len(selected) >= limit:
+                break
+            if user_id not in selected:
+                selected.append(user_id)
+        return selected[:limit]
+
+    async def get_members_context(self, text: str = '') -> str:
+        """Блок с участниками, подходящими к сообщению (переменная часть промпта)"""
+        member_ids = await self.select_relevant_members(text) if text else []
+        if member_ids:
+            logger.info(f"[PROMPT] Участников в промпте: {len(member_ids)}")
+        return self.roster.render(member_ids).lstrip()
+
+    def format_found_members(self, query: str, members: list) -> str:
+        """Форматирует результаты поиска участников для ответа в чат"""
+        lines = [f"🔍 Нашёл в сообществе по запросу «{query}»:\n"]
+        for member in members:
+            skills = ', '.join(member.get('skills') or [])
+            line = f"• {member.get('full_name') or '—'} — {member.get('occupation') or '—'}"
+            if skills:
+                line += f" ({skills})"
+            telegram_nick = member.get('telegram_nick')
+            if telegram_nick:
+                if not telegram_nick.startswith('@'):
+                    telegram_nick = '@' + telegram_nick
+                line += f" {telegram_nick}"
+            lines.append(line)
+        return '\n'.join(lines)
 
     async def members(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать список всех участников сообщества"""
@@ -1198,6 +2007,138 @@ class BratBot:
             logger.error(f"Ошибка при показе участников: {e}")
             await update.message.reply_text("Произошла ошибка при получении списка участников.")
 
+    @contextlib.asynccontextmanager
+    async def admitted(self, message: Message, operation: str, cost: float = 1.0):
+        """Допуск операции через AdmissionController со статусом «в очереди», пока ждём слот"""
+        status_msg = None
+
+        async def on_queued(position: int):
+            nonlocal status_msg
+            try:
+                status_msg = await message.reply_text(
+                    f"⏳ В очереди (позиция {position}). Отвечу, как только освободится место."
+                )
+            except Exception as e:
+                logger.warning(f"Не удалось отправить статус очереди: {e}")
+
+        try:
+            async with self.admission.admit(operation, cost, on_queued):
+                if status_msg:
+                    with contextlib.suppress(Exception):
+                        await status_msg.delete()
+                    status_msg = None
+                yield
+        finally:
+            if status_msg:
+                with contextlib.suppress(Exception):
+                    await status_msg.delete()
+
+    async def check_operation_limit(self, message: Message, user_id: int, operation: str) -> bool:
+        """Проверяет отдельный лимит дорогой операции и отвечает пользователю, если он исчерпан"""
+        is_allowed, error_message = self.rate_limiter.is_operation_allowed(user_id, operation)
+        if not is_allowed:
+            logger.info(f"⏱ Лимит операции {operation} исчерпан (user_id={user_id})")
+            await message.reply_text(error_message)
+        return is_allowed
+
+    async def analyze_file(self, message: Message, context: ContextTypes.DEFAULT_TYPE,
+                           file_info: Dict[str, Any], user_prompt: str):
+        """Анализирует файл и отправляет результат"""
+        # Большие файлы дороже: 1 единица бюджета + 1 за каждые 5 МБ
+        cost = 1 + (file_info.get('file_size') or 0) / (5 * 1024 * 1024)
+        try:
+            async with self.admitted(message, 'file', cost):
+                processing_msg = await message.reply_text("📄 Изучаю файл...")
+                success, result = await self.file_handler.process_telegram_file(context.bot, file_info, user_prompt)
+                try:
+                    await processing_msg.delete()
+                except Exception:
+                    pass
+        except AdmissionRejected as e:
+            await message.reply_text(f"⏳ {e}")
+            return
+        if success:
+            await self.reply_text_parts(message, format_response(result))
+        else:
+            await message.reply_text(f"❌ {result}")
+
+    async def queue_image(self, message: Message, user_id: int, prompt: str):
+        """Ставит генерацию в очередь и доставляет фото в фоне, не задерживая обработку апдейтов.
+
+        До постановки в очередь выполняются только дешёвые проверки (кэш file_id,
+        очередь, бюджет); перевод промпта идёт уже внутри задачи.
+        """
+        cache_key, file_id = await self.image_generator.prepare(prompt)
+        if file_id:
+            # Такое изображение уже отправлялось: Telegram отдаст его по file_id без загрузки
+            try:
+                await message.reply_photo(file_id, caption=f"🖼 Сгенерировано по запросу: {prompt}")
+                logger.info(f"⚡️ Изображение по запросу '{prompt}' отправлено из кэша")
+                return
+            except telegram.error.TelegramError as e:
+                logger.warning(f"file_id из кэша изображений недействителен: {e}")
+                await self.image_generator.forget(cache_key)
+        try:
+            job = self.image_generator.submit(user_id, prompt, cache_key=cache_key)
+        except ValueError as e:
+            await message.reply_text(f"⏳ {e}")
+            return
+        try:
+            # Параллельность генерации ограничена воркерами ImageGenerator, здесь — только бюджет.
+            # Списываем его после submit: отклонённый очередью запрос бюджет не тратит
+            self.admission.charge('image')
+        except AdmissionRejected as e:
+            # Воркер ещё не успел взять задачу: между submit и charge не было await
+            self.image_generator.cancel(job.id)
+            await message.reply_text(f"⏳ {e}")
+            return
+        position = self.image_generator.queue_position(job.id)
+        cancel_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_image:{job.id}")
+        ]])
+        status_text = (
+            f"⏳ Запрос в очереди на генерацию, позиция: {position}"
+            if job.status == 'queued' and position > self.image_generator.max_workers - len(self.image_generator.running)
+            else "🎨 Генерирую изображение..."
+        )
+        status_msg = await message.reply_text(status_text, reply_markup=cancel_markup)
+
+        async def on_start(job):
+            if status_msg.text != "🎨 Генерирую изображение...":
+                await status_msg.edit_text("🎨 Генерирую изображение...", reply_markup=cancel_markup)
+
+        job.on_start = on_start
+        if job.status == 'running':
+            # Генерация стартовала, пока отправлялось сообщение о статусе
+            await on_start(job)
+        task = asyncio.create_task(self._deliver_image(job, message, status_msg))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def _deliver_image(self, job: ImageJob, message: Message, status_msg: Message):
+        """Дожидается результата задачи генерации и отправляет фото"""
+        try:
+            image_url = await job.result
+            sent = await message.reply_photo(image_url, caption=f"🖼 Сгенерировано по запросу: {job.prompt}")
+            if job.cache_key and sent.photo:
+                # Самый большой размер фото — последний в списке
+                await self.image_generator.remember(job.cache_key, job.params, sent.photo[-1].file_id)
+            await status_msg.delete()
+        except asyncio.CancelledError:
+            if job.status != 'cancelled':
+                raise
+            try:
+                await status_msg.edit_text("🛑 Генерация отменена")
+            except Exception:
+                pass
+        except Exception as e:
+            logger.error(f"Ошибка при генерации изображения: {e}")
+            try:
+                await status_msg.delete()
+            except Exception:
+                pass
+            await message.reply_text("❌ Не удалось сгенерировать изображение. Попробуйте другой запрос.")
+
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик callback-запросов от inline-кнопок"""
         try:
@@ -1208,6 +2149,15 @@ class BratBot:
                 await query.answer("У вас нет доступа к этой функции")
                 return
                 
+            # Отмена генерации изображения
+            if query.data.startswith("cancel_image:"):
+                job_id = int(query.data.split(":", 1)[1])
+                if self.image_generator and self.image_generator.cancel(job_id, query.from_user.id):
+                    await query.answer("Генерация отменена")
+                else:
+                    await query.answer("Эту генерацию нельзя отменить")
+                return
+
             # Обработка запроса на загрузку файла
             if query.data.startswith("upload_file:"):
                 user_prompt = query.data.split(":", 1)[1]
@@ -1256,21 +2206,35 @@ class BratBot:
                 )
             )
             
+            # Файлы с подписью-обращением к боту («брат изучи файл»)
+            file_filters = (
+                (filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO | filters.VOICE)
+                & allowed_group_filter
+                & filters.CaptionRegex(r'(?i)^(брат|бро|@AiBratBot)\b')
+            )
+
             # Отдельный обработчик для ответов на сообщения бота
             reply_filters = (
-                (filters.TEXT | filters.Document.ALL | filters.PHOTO)
+                (filters.TEXT | filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO | filters.VOICE)
                 & ~filters.COMMAND 
                 & allowed_group_filter
                 & filters.REPLY
             )
             
-            # Добавляем оба обработчика
+            # Добавляем обработчики
             application.add_handler(
                 MessageHandler(
                     message_filters,
                     self.handle_message
                 )
             )
+
+            application.add_handler(
+                MessageHandler(
+                    file_filters,
+                    self.handle_message
+                )
+            )
             
             application.add_handler(
                 MessageHandler(
@@ -1293,6 +2257,9 @@ class BratBot:
             # Тестовая команда brat_privs (без фильтра)
             application.add_handler(CommandHandler("brat_privs", self.welcome))
 
+            # Inline-кнопки (отмена генерации изображения и т.п.)
+            application.add_handler(CallbackQueryHandler(self.handle_callback))
+
             # Добавляем обработчик новых участников
             application.add_handler(ChatMemberHandler(self.greet_new_member, ChatMemberHandler.CHAT_MEMBER))
 
@@ -1354,54 +2321,9 @@ class BratBot:
                                 profile_data[key] = user_info[key]
                     # Сохраняем профиль
                     try:
-                        with self.db.get_connection() as conn:
-                            cursor = conn.cursor()
-                            cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-                            exists = cursor.fetchone()
-                            if exists:
-                                query = """
-                                UPDATE users SET 
-                                    full_name = ?,
-                                    telegram_nick = ?,
-                                    occupation = ?,
-                                    skills = ?,
-                                    company_info = ?,
-                                    links = ?,
-                                    about = ?,
-                                    last_active = CURRENT_TIMESTAMP,
-                                    is_complete = TRUE
-                                WHERE user_id = ?
-                                """
-                                params = (
-                                    profile_data.get('full_name'),
-                                    profile_data.get('telegram_nick'),
-                                    profile_data.get('occupation'),
-                                    json.dumps(profile_data.get('skills', []), ensure_ascii=False),
-                                    profile_data.get('company_info'),
-                                    json.dumps(profile_data.get('links', {}), ensure_ascii=False),
-                                    profile_data.get('about'),
-                                    user_id
-                                )
-                            else:
-                                query = """
-                                INSERT INTO users (
-                                    user_id, full_name, telegram_nick, occupation,
-                                    skills, company_info, links, about, last_active, is_complete
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, TRUE)
-                                """
-                                params = (
-                                    user_id,
-                                    profile_data.get('full_name'),
-                                    profile_data.get('telegram_nick'),
-                                    profile_data.get('occupation'),
-                                    json.dumps(profile_data.get('skills', []), ensure_ascii=False),
-                                    profile_data.get('company_info'),
-                                    json.dumps(profile_data.get('links', {}), ensure_ascii=False),
-                                    profile_data.get('about')
-                                )
-                            cursor.execute(query, params)
-                            conn.commit()
-                        await self.update_prompt_with_users()
+                        if not await self.db.save_user_profile(user_id, profile_data):
+                            raise Exception("профиль не сохранён в базе данных")
+                        self.on_profile_saved(user_id, profile_data)
                         await message.reply_text("✅ Профиль успешно сохранён!")
                     except Exception as e:
                         logger.error(f"Ошибка при сохранении профиля: {e}")
@@ -1417,7 +2339,7 @@ class BratBot:
                 await self.rate_limiter.log_suspicious_activity(
                     user_id, 
                     chat_id,
-                    f"Превышение лимита запросов: {message.text[:100]}..."
+                    f"Превышение лимита запросов: {(message_text or '')[:100]}..."
                 )
                 return
                 
@@ -1457,18 +2379,17 @@ class BratBot:
                 logger.debug("Сообщение не содержит обращения к боту")
                 return
 
-            # Проверяем наличие файла
-            file_info = None
-            if message.document:
-                logger.info(f"📄 Получен документ, но обработка файлов временно отключена")
-            elif message.photo:
-                logger.info("🖼 Получено фото, но обработка файлов временно отключена")
-            elif message.video:
-                logger.info("🎥 Получено видео, но обработка файлов временно отключена")
-            elif message.audio:
-                logger.info("🎵 Получен аудиофайл, но обработка файлов временно отключена")
-            elif message.voice:
-                logger.info("🎤 Получено голосовое сообщение, но обработка файлов временно отключена")
+            # Анализ файла: «брат изучи файл» во вложении или в ответ на сообщение с файлом
+            file_match = re.search(FILE_PATTERN, message_text, re.IGNORECASE | re.DOTALL)
+            if file_match and self.file_handler:
+                file_info = (FileHandler.extract_file_info(message)
+                             or FileHandler.extract_file_info(message.reply_to_message))
+                if not file_info:
+                    await message.reply_text("📎 Пришлите файл с подписью «брат изучи файл» или ответьте так на сообщение с файлом")
+                    return
+                if await self.check_operation_limit(message, user_id, 'file'):
+                    await self.analyze_file(message, context, file_info, file_match.group(1).strip())
+                return
 
             # Обрабатываем текстовые команды
             try:
@@ -1476,34 +2397,42 @@ class BratBot:
                 photo_match = re.search(PHOTO_PATTERN, message_text, re.IGNORECASE)
                 if photo_match and self.image_generator:
                     prompt = photo_match.group(1).strip()
-                    processing_msg = await message.reply_text("🎨 Генерирую изображение...")
-                    try:
-                        image_url = await self.image_generator.generate_image(prompt)
-                        await message.reply_photo(image_url, caption=f"🖼 Сгенерировано по запросу: {prompt}")
-                        await processing_msg.delete()
-                        return
-                    except Exception as e:
-                        logger.error(f"Ошибка при генерации изображения: {e}")
-                        await processing_msg.delete()
-                        await message.reply_text("❌ Не удалось сгенерировать изображение. Попробуйте другой запрос.")
-                        return
+                    if await self.check_operation_limit(message, user_id, 'image'):
+                        await self.queue_image(message, user_id, prompt)
+                    return
 
                 # Проверяем запрос на поиск в интернете
                 for pattern in WEB_SEARCH_PATTERNS:
                     web_match = re.search(pattern, message_text, re.IGNORECASE)
                     if web_match and self.perplexity:
                         query = web_match.group(1).strip()
-                        processing_msg = await message.reply_text("🔍 Ищу информацию...")
-                        try:
-                            search_result = await self.perplexity.search(query)
-                            await message.reply_text(f"🌐 Результаты поиска:\n\n{search_result}")
-                            await processing_msg.delete()
+                        if not await self.check_operation_limit(message, user_id, 'search'):
                             return
-                        except Exception as e:
-                            logger.error(f"Ошибка при поиске: {e}")
-                            await processing_msg.delete()
-                            await message.reply_text("❌ Не удалось выполнить поиск. Попробуйте позже.")
+                        try:
+                            async with self.admitted(message, 'search'):
+                                processing_msg = await message.reply_text("🔍 Ищу информацию...")
+                                try:
+                                    search_result = await self.perplexity.search(query)
+                                    await message.reply_text(f"🌐 Результаты поиска:\n\n{search_result}")
+                                    await processing_msg.delete()
+                                except Exception as e:
+                                    logger.error(f"Ошибка при поиске: {e}")
+                                    await processing_msg.delete()
+                                    await message.reply_text("❌ Не удалось выполнить поиск. Попробуйте позже.")
+                        except AdmissionRejected as e:
+                            await message.reply_text(f"⏳ {e}")
+                        return
+
+                # Проверяем запрос на поиск участников сообщества
+                for pattern in SEARCH_PATTERNS:
+                    member_match = re.search(pattern, message_text, re.IGNORECASE)
+                    if member_match:
+                        query = member_match.group(1).strip()
+                        found_members = await self.find_members(query, limit=10)
+                        if found_members:
+                            await message.reply_text(self.format_found_members(query, found_members))
                             return
+                        # Никого не нашли — отвечает модель с учётом всего сообщества
 
                 # Формируем контекст сообщения с учетом топика
                 context_message = message_text
@@ -1514,50 +2443,63 @@ class BratBot:
                 logger.error(f"❌ Ошибка при обработке команды: {str(e)}")
                 await message.reply_text("Произошла ошибка при обработке команды. Попробуйте позже.")
 
-            # Получаем полный контекст из базы данных
-            logger.info("📚 Получаю полный контекст диалога из базы данных")
+            # Повторяющиеся вопросы отвечаем из кэша, без запроса к модели.
+            # Ключ строится по сообщению вместе с топиком: ответ привязан к тому, где его спросили
+            cache_key = self.response_cache_key(context_message)
+            cached_response = self.response_cache.get(cache_key) if cache_key else None
+            if cached_response:
+                logger.info(f"⚡️ Ответ из кэша FAQ для пользователя {user_id}")
+                await self.reply_text_parts(message, cached_response)
+                await self.conversation.add_message(user_id, 'user', context_message)
+                await self.conversation.add_message(user_id, 'assistant', cached_response)
+                self.summarizer.schedule(user_id)
+                return
+
+            # Получаем последние сообщения диалога (из кэша или базы данных)
+            logger.info("📚 Получаю контекст диалога")
             try:
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        SELECT role, content, timestamp 
-                        FROM message_context 
-                        WHERE user_id = ? 
-                        ORDER BY timestamp ASC
-                    """, (user_id,))
-                    rows = cursor.fetchall()
-                    full_context = [{"role": row[0], "content": row[1]} for row in rows]
+                # Ответы модели ограничены по параллельности отдельно от изображений, поиска и файлов
+                async with self.admitted(message, 'chat'):
+                    full_context = await self.conversation.get_context(user_id)
                     logger.info(f"📊 Получено {len(full_context)} сообщений из контекста")
-                    
+                    # В общий кэш попадают только ответы, не зависящие от личного контекста:
+                    # без истории диалога и саммари, иначе ответ другим раскрыл бы чужие данные
+                    if cache_key and (full_context or await self.db.get_all_summaries(user_id)):
+                        cache_key = None
+                
                     # Добавляем текущее сообщение в контекст
-                    cursor.execute("""
-                        INSERT INTO message_context (user_id, role, content)
-                        VALUES (?, 'user', ?)
-                    """, (user_id, context_message))
-                    conn.commit()
-                    
-                    # Обновляем полный контекст с новым сообщением
-                    full_context.append({"role": "user", "content": context_message})
-                    
+                    user_message = await self.conversation.add_message(user_id, 'user', context_message)
+                    full_context.append(user_message or {"role": "user", "content": context_message})
+                
                     # Получаем ответ от модели с полным контекстом
-                    response = await self.get_model_response(full_context, user_id)
-                    
+                    if STREAM_RESPONSES:
+                        # Оборванный ответ тоже сохраняется в контекст, но не в кэш FAQ
+                        response, complete = await self.reply_streaming(
+                            message, self.stream_model_response(full_context, user_id)
+                        )
+                    else:
+                        complete = True
+                        response = await self.get_model_response(full_context, user_id)
+                        if response:
+                            await message.reply_text(response)
+                        else:
+                            await message.reply_text(
+                                "Извините, не удалось сгенерировать ответ. Попробуйте переформулировать вопрос."
+                            )
+                
                     if response:
                         # Добавляем ответ бота в контекст
-                        cursor.execute("""
-                            INSERT INTO message_context (user_id, role, content)
-                            VALUES (?, 'assistant', ?)
-                        """, (user_id, response))
-                        conn.commit()
-                        
-                        await message.reply_text(response)
+                        await self.conversation.add_message(user_id, 'assistant', response)
+                        if cache_key and complete:
+                            self.response_cache.set(cache_key, response)
                         logger.info(f"✅ Ответ успешно отправлен пользователю {user_id}")
+                        # Саммари готовится в фоне к следующему ходу
+                        self.summarizer.schedule(user_id)
                     else:
-                        await message.reply_text(
-                            "Извините, не удалось сгенерировать ответ. Попробуйте переформулировать вопрос."
-                        )
                         logger.warning(f"⚠️ Не удалось сгенерировать ответ для пользователя {user_id}")
                         
+            except AdmissionRejected as e:
+                await message.reply_text(f"⏳ {e}")
             except Exception as e:
                 logger.error(f"❌ Ошибка при работе с базой данных: {str(e)}")
                 await message.reply_text(
@@ -1618,15 +2560,12 @@ class BratBot:
             if arg.startswith('@'):
                 # Поиск по username
                 username = arg.lstrip('@')
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT user_id FROM users WHERE telegram_nick = ?", (username,))
-                    row = cursor.fetchone()
-                    if row:
-                        target_user_id = row[0]
-                    else:
-                        await update.message.reply_text(f"Пользователь с ником @{username} не найден.")
-                        return
+                found_user_id = await self.db.get_user_id_by_nick(username)
+                if found_user_id:
+                    target_user_id = found_user_id
+                else:
+                    await update.message.reply_text(f"Пользователь с ником @{username} не найден.")
+                    return
             else:
                 # Поиск по user_id
                 try:
@@ -1638,11 +2577,9 @@ class BratBot:
             await update.message.reply_text("Эта функция доступна только администраторам.")
             return
         try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM message_context WHERE user_id = ?", (target_user_id,))
-                cursor.execute("DELETE FROM chat_summaries WHERE user_id = ?", (target_user_id,))
-                conn.commit()
+            if not await self.db.clear_user_context(target_user_id):
+                raise Exception("контекст не удалён из базы данных")
+            await self.conversation.clear_context(target_user_id)
             if target_user_id == user_id:
                 await update.message.reply_text("✅ Ваш контекст диалога очищен")
             else:
@@ -1664,72 +2601,18 @@ class BratBot:
             logger.info("🔄 Начинаю сбор статистики...")
             
             # Базовая статистика из rate_limiter
-            total_messages = len(self.rate_limiter.user_limits)
-            blocked_users = len(self.rate_limiter.blocked_users)
-            current_load = len(self.rate_limiter.group_limits)
+            limiter_stats = self.rate_limiter.stats()
+            active_users = limiter_stats['active_users']
+            blocked_users = limiter_stats['blocked_users']
+            current_load = limiter_stats['active_groups']
             
-            logger.info(f"📊 Rate Limiter статистика: messages={total_messages}, blocked={blocked_users}, load={current_load}")
+            logger.info(f"📊 Rate Limiter статистика: active={active_users}, blocked={blocked_users}, load={current_load}")
 
             # Получаем статистику по контекстам из базы данных
-            context_stats = {}
-            summary_count = 0
-            
-            try:
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    
-                    # Получаем количество сообщений для каждого пользователя
-                    cursor.execute("""
-                        SELECT user_id, COUNT(*) as msg_count 
-                        FROM message_context 
-                        GROUP BY user_id
-                    """)
-                    rows = cursor.fetchall()
-                    logger.info(f"📊 Найдено {len(rows)} пользователей с сообщениями")
-                    
-                    for user_id, msg_count in rows:
-                        context_stats[user_id] = msg_count
-                        # Получаем последние сообщения пользователя
-                        cursor.execute("""
-                            SELECT role, content, timestamp 
-                            FROM message_context 
-                            WHERE user_id = ? 
-                            ORDER BY timestamp DESC 
-                            LIMIT 5
-                        """, (user_id,))
-                        last_messages = cursor.fetchall()
-                        logger.info(f"👤 Пользователь {user_id}:")
-                        logger.info(f"   • Всего сообщений: {msg_count}")
-                        logger.info(f"   • Последние сообщения:")
-                        for role, content, timestamp in last_messages:
-                            logger.info(f"     - [{timestamp}] {role}: {content[:50]}...")
-
-                    # Получаем информацию о саммари
-                    cursor.execute("SELECT COUNT(*) FROM chat_summaries")
-                    summary_count = cursor.fetchone()[0]
-                    logger.info(f"📝 Количество саммари в базе: {summary_count}")
-                    
-                    # Получаем детали последних саммари
-                    cursor.execute("""
-                        SELECT user_id, summary, created_at 
-                        FROM chat_summaries 
-                        ORDER BY created_at DESC 
-                        LIMIT 5
-                    """)
-                    last_summaries = cursor.fetchall()
-                    logger.info("📝 Последние саммари:")
-                    for user_id, summary, created_at in last_summaries:
-                        logger.info(f"   • Пользователь {user_id} [{created_at}]:")
-                        logger.info(f"     {summary[:100]}...")
-                    
-                    # Проверяем пользователей с длинными контекстами
-                    long_contexts = [user_id for user_id, count in context_stats.items() if count > 20]
-                    logger.info(f"📊 Пользователи с длинными контекстами (>20): {long_contexts}")
-                    
-            except Exception as e:
-                logger.error(f"❌ Ошибка при получении данных из БД: {str(e)}")
-                context_stats = {}
-                summary_count = 0
+            overview = await self.db.get_context_overview()
+            context_stats = overview['context_stats']
+            summary_count = overview['summary_count']
+            compacted_count = overview['compacted_count']
 
             # Анализируем контексты
             total_context_messages = sum(context_stats.values())
@@ -1744,6 +2627,9 @@ class BratBot:
             logger.info(f"   • Максимальная длина: {max_context_length}")
             logger.info(f"   • Саммари: {summary_count}")
 
+            cache_stats = prompt_cache_stats.snapshot()
+            faq_stats = self.response_cache.stats()
+
             # Формируем подробный отчет
             stats_text = (
                 "🤖 Статистика бота Брат\n\n"
@@ -1755,16 +2641,35 @@ class BratBot:
                 f"• Пользователей с длинным контекстом (>20): {users_with_long_context}\n\n"
                 
                 "🔄 Саммаризация:\n"
-                f"• Количество сохраненных саммари: {summary_count}\n"
+                f"• Активных саммари (в контексте): {summary_count}\n"
+                f"• Сжатых в саммари более высокого уровня: {compacted_count}\n"
                 "• Активируется при: >20 сообщений\n"
                 "• Сохраняет: последние 10 сообщений\n"
                 "• Создает: краткое содержание предыдущего диалога\n\n"
                 
                 "⚡️ Текущее состояние:\n"
-                f"• Активных пользователей: {total_messages}\n"
+                f"• Активных пользователей (за минуту): {active_users}\n"
                 f"• Заблокированных пользователей: {blocked_users}\n"
-                f"• Текущая нагрузка: {current_load} групп\n"
+                f"• Текущая нагрузка: {current_load} групп\n\n"
+
+                "🧠 Кэш промпта у провайдера:\n"
+                f"• Запросов с учётом: {cache_stats['requests']}\n"
+                f"• Запросов с попаданием в кэш: {cache_stats['hits']} ({cache_stats['hit_ratio']:.0%})\n"
+                f"• Токенов промпта из кэша: {cache_stats['cached_tokens']} из {cache_stats['prompt_tokens']} "
+                f"({cache_stats['cached_ratio']:.0%})\n\n"
+
+                "⚡️ Кэш ответов FAQ:\n"
+                f"• Записей: {faq_stats['size']}\n"
+                f"• Попаданий: {faq_stats['hits']} ({faq_stats['hit_ratio']:.0%})\n\n"
+
+                "🚦 Нагрузка по операциям:\n"
             )
+            for gate in self.admission.stats().values():
+                slots = f"{gate['running']}/{gate['concurrency']}" if gate['concurrency'] else "—"
+                stats_text += (
+                    f"• {gate['title']}: выполняется {slots}, в очереди {gate['waiting']}, "
+                    f"принято {gate['admitted']}, отклонено {gate['rejected']}\n"
+                )
             
             logger.info("✅ Статистика собрана успешно")
             
@@ -1807,14 +2712,11 @@ class BratBot:
                 return
                 
             new_prompt = " ".join(context.args)
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT OR REPLACE INTO settings (key, value, updated_at)
-                    VALUES ('system_prompt', ?, datetime('now'))
-                """, (new_prompt,))
-                conn.commit()
+            if not await self.db.update_system_prompt(new_prompt):
+                raise Exception("промпт не сохранён в базе данных")
             self.system_prompt = new_prompt
+            # Ответы, полученные со старым промптом, больше не актуальны
+            self.response_cache.clear()
             
             await update.message.reply_text("✅ Системный промпт успешно обновлен")
         except Exception as e:
@@ -1838,47 +2740,11 @@ class BratBot:
             backup_file = backup_dir / f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
             
             # Получаем данные для бэкапа
-            backup_data = {}
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Получаем все сообщения
-                cursor.execute("SELECT user_id, role, content, timestamp FROM message_context")
-                backup_data['messages'] = [
-                    {
-                        'user_id': row[0],
-                        'role': row[1],
-                        'content': row[2],
-                        'timestamp': row[3]
-                    }
-                    for row in cursor.fetchall()
-                ]
-                
-                # Получаем все саммари
-                cursor.execute("SELECT user_id, summary, created_at FROM chat_summaries")
-                backup_data['summaries'] = [
-                    {
-                        'user_id': row[0],
-                        'summary': row[1],
-                        'created_at': row[2]
-                    }
-                    for row in cursor.fetchall()
-                ]
-                
-                # Получаем все настройки
-                cursor.execute("SELECT key, value, updated_at FROM settings")
-                backup_data['settings'] = [
-                    {
-                        'key': row[0],
-                        'value': row[1],
-                        'updated_at': row[2]
-                    }
-                    for row in cursor.fetchall()
-                ]
+            backup_data = await self.db.export_backup_data()
             
-            # Сохраняем бэкап
-            with open(backup_file, 'w', encoding='utf-8') as f:
-                json.dump(backup_data, f, ensure_ascii=False, indent=2)
+            # Сохраняем бэкап (запись файла — вне event loop)
+            backup_json = json.dumps(backup_data, ensure_ascii=False, indent=2)
+            await asyncio.to_thread(backup_file.write_text, backup_json, encoding='utf-8')
                 
             await update.message.reply_text(
                 f"✅ Резервная копия создана: {backup_file.name}"
@@ -1890,11 +2756,13 @@ class BratBot:
     def run(self):
         """Запуск бота"""
         try:
-            # Создаем приложение
-            application = Application.builder().token(TOKEN).build()
+            # Создаем приложение. Обновления обрабатываются параллельно,
+            # чтобы долгий ответ модели не задерживал другие чаты и callback'и
+            application = Application.builder().token(TOKEN).concurrent_updates(True).build()
 
             # Настраиваем и запускаем бота
             application.post_init = self.initialize
+            application.post_shutdown = self.shutdown
             application.run_polling(allowed_updates=Update.ALL_TYPES)
             
         except Exception as e:
@@ -1904,21 +2772,17 @@ class BratBot:
     async def shutdown(self, application: Application) -> None:
         """Корректное завершение работы бота"""
         logger.info("🔄 Завершение работы бота...")
-
-    async def convert_document(self, file_data: bytes, file_name: str) -> str:
-        """Конвертирует документ в Markdown используя MarkItDown"""
-        try:
-            # Создаем объект BytesIO из данных файла
-            file_stream = io.BytesIO(file_data)
-            file_stream.name = file_name  # Устанавливаем имя файла для определения типа
-
-            # Конвертируем документ
-            result = self.markitdown.convert_stream(file_stream)
-            return result.text_content
-
-        except Exception as e:
-            logger.error(f"❌ Ошибка при конвертации документа: {str(e)}")
-            raise
+        await self.summarizer.stop()
+        await self.roster.stop()
+        if self.image_generator:
+            await self.image_generator.stop()
+        if self.file_handler:
+            await self.file_handler.close()
+        if self.perplexity:
+            await self.perplexity.close()
+        await close_clients()
+        # Дожидаемся очереди запросов к БД, не блокируя event loop
+        await asyncio.to_thread(self.db.close)
 
     async def is_admin(self, update: Update) -> bool:
         """Проверка является ли пользователь администратором группы"""
@@ -1932,69 +2796,16 @@ class BratBot:
             logger.error(f"Ошибка при проверке прав администратора: {e}")
             return False
 
-    def setup_database(self):
-        """Настройка базы данных"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Создаем таблицу для контекста сообщений
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS message_context (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Создаем таблицу для саммари
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_summaries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    summary TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Создаем таблицу настроек
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key TEXT NOT NULL UNIQUE,
-                    value TEXT NOT NULL,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Добавляем индексы для оптимизации
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_context_user_id ON message_context(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_summaries_user_id ON chat_summaries(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_settings_key ON settings(key)")
-            
-            conn.commit()
-
-    def update_system_prompt(self, new_prompt: str):
-        """Обновить системный промпт"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO settings (key, value, updated_at)
-                VALUES ('system_prompt', ?, datetime('now'))
-            """, (new_prompt,))
-            conn.commit()
-
     async def clear_all_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Удаляет всех пользователей из базы (только для теста/админа)"""
         if not await self.is_admin(update):
             await update.message.reply_text("Только для администратора!")
             return
         try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM users")
-                conn.commit()
+            if not await self.db.delete_all_users():
+                raise Exception("пользователи не удалены из базы данных")
+            self.member_index.clear()
+            self.roster.clear()
             await update.message.reply_text("✅ Все пользователи удалены из базы!")
         except Exception as e:
             logger.error(f"Ошибка при удалении пользователей: {e}")
@@ -1,13 +1,17 @@
 from sqlalchemy import create_engine, Column, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-import aiosqlite
+import asyncio
+import functools
 import json
 import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, List, Dict, Any
-import os
+import re
+from member_index import MemberIndex, normalize_text, significant_terms
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -15,6 +19,20 @@ logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+def run_in_db_thread(func):
+    """Выполняет синхронный метод Database в выделенном потоке базы данных.
+
+    Метод превращается в корутину: event loop не блокируется дисковым вводом-выводом,
+    а все запросы идут последовательно через одно долгоживущее подключение.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, self, *args, **kwargs)
+        )
+    return wrapper
+
 class CommunityMember(Base):
     __tablename__ = 'community_members'
     
@@ -26,18 +44,255 @@ class CommunityMember(Base):
     interests = Column(Text)  # JSON строка с интересами
     contact_info = Column(Text)  # JSON строка с контактной информацией
 
+# Поля профиля, по которым строится полнотекстовый поиск (порядок важен для весов bm25)
+USERS_FTS_COLUMNS = ['full_name', 'occupation', 'skills', 'company_info', 'about']
+# Веса полей в ранжировании: специализация и навыки важнее описания
+USERS_FTS_WEIGHTS = [2.0, 5.0, 4.0, 1.0, 1.0]
+# Поля поиска для search_users по типу запроса
+SEARCH_TYPE_COLUMNS = {
+    'all': USERS_FTS_COLUMNS,
+    'skills': ['skills'],
+    'occupation': ['occupation'],
+    'name': ['full_name'],
+    'keyword': ['occupation', 'skills', 'company_info'],
+}
+
+def _sql_normalize_text(value):
+    return normalize_text(value) if isinstance(value, str) else value
+
+def _fold_yo(expression: str) -> str:
+    """SQL-выражение с заменой ё на е"""
+    return f"replace(replace({expression}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _recreate_users_fts(cursor):
+    """Пересоздаёт users_fts и его триггеры (например, после смены нормализации текста)"""
+    for trigger in ('users_fts_ai', 'users_fts_ad', 'users_fts_au'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS users_fts")
+    _create_users_fts(cursor)
+
+def _create_users_fts(cursor):
+    """Создаёт users_fts (FTS5, external content) с триггерами и заполняет его"""
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x, tokenize='trigram')")
+        cursor.execute("DROP TABLE temp.fts_probe")
+        tokenizer = 'trigram'
+    except sqlite3.OperationalError:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts_probe")
+        except sqlite3.OperationalError:
+            logger.warning("SQLite собран без FTS5 — поиск участников будет работать через LIKE")
+            return
+        tokenizer = 'unicode61 remove_diacritics 2'
+    
+    columns = ', '.join(USERS_FTS_COLUMNS)
+    # В индекс попадает текст с ё -> е, как и нормализованный запрос (normalize_text)
+    new_values = ', '.join(_fold_yo(f'new.{c}') for c in USERS_FTS_COLUMNS)
+    old_values = ', '.join(_fold_yo(f'old.{c}') for c in USERS_FTS_COLUMNS)
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            {columns}, content='users', content_rowid='user_id', tokenize='{tokenizer}'
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts(rowid, {columns}) VALUES (new.user_id, {new_values});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, {columns}) VALUES ('delete', old.user_id, {old_values});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF {columns} ON users BEGIN
+            INSERT INTO users_fts(users_fts, rowid, {columns}) VALUES ('delete', old.user_id, {old_values});
+            INSERT INTO users_fts(rowid, {columns}) VALUES (new.user_id, {new_values});
+        END
+    """)
+    # Заполняем индекс существующими профилями ('rebuild' взял бы текст без свёртки ё)
+    cursor.execute(f"""
+        INSERT INTO users_fts(rowid, {columns})
+        SELECT user_id, {', '.join(_fold_yo(c) for c in USERS_FTS_COLUMNS)} FROM users
+    """)
+    logger.info(f"Создан полнотекстовый индекс users_fts (токенизатор: {tokenizer})")
+
+# Версионированные миграции схемы: (версия, описание, шаги).
+# Шаг — SQL-выражение или функция, принимающая курсор.
+# Текущая версия хранится в settings под ключом 'schema_version'.
+MIGRATIONS = [
+    (1, "Составные индексы для выборки контекста и саммари по пользователю", [
+        "CREATE INDEX IF NOT EXISTS idx_context_user_ts ON message_context(user_id, timestamp, id)",
+        "CREATE INDEX IF NOT EXISTS idx_summaries_user_created ON chat_summaries(user_id, created_at, id)",
+        # Одноколоночные индексы покрываются составными
+        "DROP INDEX IF EXISTS idx_context_user_id",
+        "DROP INDEX IF EXISTS idx_summaries_user_id",
+        "ANALYZE",
+    ]),
+    (2, "Полнотекстовый индекс участников users_fts с синхронизацией триггерами", [
+        _create_users_fts,
+    ]),
+    (3, "Строки списка участников для системного промпта", [
+        """
+        CREATE TABLE IF NOT EXISTS roster_entries (
+            user_id INTEGER PRIMARY KEY,
+            line TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (4, "Уровни саммари и связи сжатых саммари с исходными", [
+        # tier: 0 — блок сообщений, 1 — сессия (несколько блоков), 2 — вся история
+        "ALTER TABLE chat_summaries ADD COLUMN tier INTEGER NOT NULL DEFAULT 0",
+        # JSON-список id саммари, из которых собрано сжатое саммари
+        "ALTER TABLE chat_summaries ADD COLUMN source_ids TEXT",
+        # id саммари, в которое вошло данное (NULL — саммари активно)
+        "ALTER TABLE chat_summaries ADD COLUMN compacted_into INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_summaries_user_active "
+        "ON chat_summaries(user_id, compacted_into, start_timestamp, id)",
+    ]),
+    (5, "Кэш сгенерированных изображений (file_id Telegram)", [
+        """
+        CREATE TABLE IF NOT EXISTS image_cache (
+            cache_key TEXT PRIMARY KEY,
+            prompt TEXT,
+            params TEXT,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_image_cache_last_used ON image_cache(last_used_at)",
+    ]),
+    (6, "Кэш результатов анализа файлов (по SHA-256 содержимого и file_unique_id)", [
+        """
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            file_unique_id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_file_hashes_sha256 ON file_hashes(sha256)",
+        """
+        CREATE TABLE IF NOT EXISTS file_analysis_cache (
+            sha256 TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            mime_type TEXT,
+            result TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sha256, prompt)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_file_analysis_last_used ON file_analysis_cache(last_used_at)",
+    ]),
+    (7, "users_fts: текст индексируется с заменой ё на е", [
+        _recreate_users_fts,
+    ]),
+    (8, "Граница саммари по id последнего сообщения блока", [
+        # Время сообщений хранится с точностью до секунды и не различает соседние сообщения
+        "ALTER TABLE chat_summaries ADD COLUMN end_message_id INTEGER",
+        """
+        UPDATE chat_summaries SET end_message_id = (
+            SELECT MAX(m.id) FROM message_context m
+            WHERE m.user_id = chat_summaries.user_id AND m.timestamp <= chat_summaries.end_timestamp
+        )
+        """,
+    ]),
+]
+
+class ConnectionManager:
+    """Долгоживущие подключения к SQLite: по одному на поток, в режиме WAL.
+
+    Подключение открывается один раз и переиспользуется всеми запросами потока,
+    поэтому кэш подготовленных выражений sqlite3 (cached_statements) работает
+    между запросами, а открытие файла и fsync на каждый запрос исчезают.
+    """
+
+    def __init__(self, db_path: str, busy_timeout: float = 5.0, cached_statements: int = 256):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Возвращает подключение текущего потока, создавая его при первом обращении"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.busy_timeout,
+                cached_statements=self.cached_statements,
+                check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+            # Встроенный lower() в SQLite не понимает кириллицу — для LIKE-поиска нужна своя нормализация
+            conn.create_function('normalize_text', 1, _sql_normalize_text, deterministic=True)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+            logger.info(f"Открыто подключение к базе данных {self.db_path} (WAL)")
+        return conn
+
+    def close_current(self):
+        """Закрывает подключение текущего потока (следующий запрос из потока откроет новое)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии подключения к базе данных: {e}")
+
+    def close_all(self):
+        """Закрывает все открытые подключения"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка при закрытии подключения к базе данных: {e}")
+        self._local = threading.local()
+
+
 class Database:
     def __init__(self, db_path: str = "bot_database.db"):
         self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
+        # Выделенный поток для всех запросов из асинхронного кода
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
         self.init_database()
         # Инициализация SQLAlchemy
         self.engine = create_engine(f'sqlite:///{db_path}')
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
+        # Инвертированный индекс специализаций community_members (строится лениво в потоке БД)
+        self.member_index = MemberIndex()
+        self._member_index_ready = False
 
     def get_connection(self):
-        """Создает подключение к базе данных"""
-        return sqlite3.connect(self.db_path)
+        """Возвращает долгоживущее подключение к базе данных"""
+        return self.connections.get_connection()
+
+    def close(self):
+        """Закрывает подключения к базе данных.
+
+        Ждёт завершения запросов в потоке БД, поэтому из асинхронного кода
+        вызывается через asyncio.to_thread.
+        """
+        self.executor.shutdown(wait=True)
+        self.connections.close_all()
+        self.engine.dispose()
 
     def init_database(self):
         """Инициализация базы данных и создание необходимых таблиц"""
@@ -99,9 +354,16 @@ class Database:
                 """)
                 
                 # Добавляем индексы для оптимизации
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_context_user_id ON message_context(user_id)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_summaries_user_id ON chat_summaries(user_id)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_settings_key ON settings(key)")
+                conn.commit()
+                
+                # Применяем версионированные миграции схемы
+                self.apply_migrations(conn)
+                cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'users_fts'")
+                row = cursor.fetchone()
+                self.fts_enabled = row is not None
+                # unicode61 ищет целые токены: основу («дизайн») надо искать как префикс («дизайн*»)
+                self.fts_prefix_terms = row is not None and 'trigram' not in (row[0] or '')
                 
                 # Проверяем создание таблиц
                 cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
@@ -114,8 +376,43 @@ class Database:
         except Exception as e:
             logger.error(f"Ошибка при инициализации базы данных: {e}")
             raise
+        finally:
+            # Дальше запросы идут из потока БД — подключение основного потока не нужно
+            self.connections.close_current()
+
+    def apply_migrations(self, conn: sqlite3.Connection):
+        """Применяет недостающие миграции из MIGRATIONS, каждую в отдельной транзакции"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM settings WHERE key = 'schema_version'")
+        row = cursor.fetchone()
+        current_version = int(row[0]) if row else 0
+        
+        for version, description, steps in MIGRATIONS:
+            if version <= current_version:
+                continue
+            logger.info(f"Применяю миграцию схемы {version}: {description}")
+            try:
+                cursor.execute("BEGIN")
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute("""
+                    INSERT OR REPLACE INTO settings (key, value, updated_at)
+                    VALUES ('schema_version', ?, CURRENT_TIMESTAMP)
+                """, (str(version),))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Ошибка при применении миграции {version}: {e}")
+                raise
+            current_version = version
+        
+        logger.info(f"Версия схемы базы данных: {current_version}")
 
-    async def add_or_update_user(self, user_id: int, data: dict) -> bool:
+    @run_in_db_thread
+    def add_or_update_user(self, user_id: int, data: dict) -> bool:
         """Добавляет или обновляет информацию о пользователе"""
         try:
             with self.get_connection() as conn:
@@ -177,7 +474,8 @@ class Database:
             logger.error(f"Ошибка при добавлении/обновлении пользователя {user_id}: {e}")
             return False
 
-    async def get_user_info(self, user_id: int) -> Optional[dict]:
+    @run_in_db_thread
+    def get_user_info(self, user_id: int) -> Optional[dict]:
         """Получает информацию о пользователе"""
         try:
             with self.get_connection() as conn:
@@ -207,103 +505,62 @@ class Database:
             logger.error(f"Ошибка при получении информации о пользователе {user_id}: {e}")
             return None
 
-    async def add_message_to_context(self, user_id: int, role: str, content: str) -> bool:
-        """Добавляет сообщение в контекст пользователя"""
-        try:
-            logger.info(f"Добавление сообщения в контекст для пользователя {user_id}")
-            logger.info(f"Роль: {role}")
-            logger.info(f"Содержание: {content[:100]}...")  # Логируем первые 100 символов
-            
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Проверяем количество сообщений пользователя
-                cursor.execute("SELECT COUNT(*) FROM message_context WHERE user_id = ?", (user_id,))
-                count = cursor.fetchone()[0]
-                logger.info(f"Текущее количество сообщений пользователя: {count}")
-                
-                cursor.execute("""
-                INSERT INTO message_context (user_id, role, content)
-                VALUES (?, ?, ?)
-                """, (user_id, role, content))
-                conn.commit()
-                
-                # Проверяем успешность добавления
-                cursor.execute("SELECT id FROM message_context WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,))
-                last_id = cursor.fetchone()
-                if last_id:
-                    logger.info(f"Сообщение успешно добавлено в контекст (id: {last_id[0]})")
-                else:
-                    logger.warning("Сообщение добавлено, но не удалось получить его ID")
-                
-                return True
-                
-        except Exception as e:
-            logger.error(f"Ошибка при добавлении сообщения в контекст для пользователя {user_id}: {e}")
-            return False
-
-    async def get_user_context(self, user_id: int, limit: int = 30) -> List[Dict[str, Any]]:
+    @run_in_db_thread
+    def get_user_context(self, user_id: int, limit: int = 30) -> List[Dict[str, Any]]:
         """Получает последние сообщения из контекста пользователя"""
         try:
-            logger.info(f"Получение контекста для пользователя {user_id} (лимит: {limit})")
-            
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                
-                # Получаем общее количество сообщений
-                cursor.execute("SELECT COUNT(*) FROM message_context WHERE user_id = ?", (user_id,))
-                total_messages = cursor.fetchone()[0]
-                logger.info(f"Всего сообщений в контексте: {total_messages}")
-                
                 cursor.execute("""
-                SELECT role, content, timestamp
+                SELECT id, role, content, timestamp
                 FROM message_context
                 WHERE user_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY timestamp DESC, id DESC
                 LIMIT ?
                 """, (user_id, limit))
                 
-                messages = []
-                for row in cursor.fetchall():
-                    message = {
-                        'role': row[0],
-                        'content': row[1],
-                        'timestamp': row[2]
+                messages = [
+                    {
+                        'id': row[0],
+                        'role': row[1],
+                        'content': row[2],
+                        'timestamp': row[3]
                     }
-                    messages.append(message)
-                    logger.info(f"Получено сообщение: роль={row[0]}, время={row[2]}, содержание={row[1][:50]}...")
-                
-                logger.info(f"Получено {len(messages)} сообщений из {total_messages}")
+                    for row in cursor.fetchall()
+                ]
+                logger.info(f"Получено {len(messages)} последних сообщений контекста пользователя {user_id}")
                 return messages[::-1]  # Возвращаем в хронологическом порядке
                 
         except Exception as e:
             logger.error(f"Ошибка при получении контекста пользователя {user_id}: {e}")
             return []
 
-    async def create_chat_summary(self, user_id: int, summary: str) -> bool:
-        """Создает новое саммари чата"""
+    @run_in_db_thread
+    def create_chat_summary(self, user_id: int, summary: str, start_timestamp: str = None,
+                            end_timestamp: str = None, end_message_id: int = None) -> bool:
+        """Создает новое саммари чата для блока сообщений (end_message_id — id последнего сообщения блока)"""
         try:
             logger.info(f"Создание нового саммари для пользователя {user_id}")
             
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
-                # Получаем временной диапазон для саммари
-                cursor.execute("""
-                SELECT MIN(timestamp), MAX(timestamp)
-                FROM message_context
-                WHERE user_id = ?
-                """, (user_id,))
-                
-                start_time, end_time = cursor.fetchone()
-                logger.info(f"Диапазон саммари: {start_time} - {end_time}")
+                if start_timestamp is None or end_timestamp is None:
+                    # Диапазон не передан — берём всю историю пользователя
+                    cursor.execute("""
+                    SELECT MIN(timestamp), MAX(timestamp), MAX(id)
+                    FROM message_context
+                    WHERE user_id = ?
+                    """, (user_id,))
+                    start_timestamp, end_timestamp, end_message_id = cursor.fetchone()
+                logger.info(f"Диапазон саммари: {start_timestamp} - {end_timestamp}")
                 
                 # Добавляем саммари
                 cursor.execute("""
                 INSERT INTO chat_summaries (
-                    user_id, summary, start_timestamp, end_timestamp
-                ) VALUES (?, ?, ?, ?)
-                """, (user_id, summary, start_time, end_time))
+                    user_id, summary, start_timestamp, end_timestamp, end_message_id
+                ) VALUES (?, ?, ?, ?, ?)
+                """, (user_id, summary, start_timestamp, end_timestamp, end_message_id))
                 
                 conn.commit()
                 logger.info("Саммари успешно создано")
@@ -313,7 +570,8 @@ class Database:
             logger.error(f"Ошибка при создании саммари для пользователя {user_id}: {e}")
             return False
 
-    async def get_latest_summary(self, user_id: int) -> Optional[str]:
+    @run_in_db_thread
+    def get_latest_summary(self, user_id: int) -> Optional[str]:
         """Получает последнее саммари чата для пользователя"""
         try:
             logger.info(f"Получение последнего саммари для пользователя {user_id}")
@@ -323,8 +581,8 @@ class Database:
                 cursor.execute("""
                 SELECT summary, created_at
                 FROM chat_summaries
-                WHERE user_id = ?
-                ORDER BY created_at DESC
+                WHERE user_id = ? AND compacted_into IS NULL
+                ORDER BY created_at DESC, id DESC
                 LIMIT 1
                 """, (user_id,))
                 
@@ -341,71 +599,18 @@ class Database:
             logger.error(f"Ошибка при получении саммари для пользователя {user_id}: {e}")
             return None
 
-    async def search_users_by_skills(self, skills: List[str]) -> List[Dict[str, Any]]:
-        """Поиск пользователей по навыкам"""
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Создаем условие для поиска по навыкам
-                skill_conditions = ' OR '.join(['skills LIKE ?' for _ in skills])
-                params = [f'%{skill}%' for skill in skills]
-                
-                query = f"""
-                SELECT user_id, username, full_name, telegram_nick, 
-                       occupation, skills, company_info
-                FROM users
-                WHERE {skill_conditions}
-                """
-                
-                cursor.execute(query, params)
-                users = []
-                for row in cursor.fetchall():
-                    users.append({
-                        'user_id': row[0],
-                        'username': row[1],
-                        'full_name': row[2],
-                        'telegram_nick': row[3],
-                        'occupation': row[4],
-                        'skills': json.loads(row[5]) if row[5] else [],
-                        'company_info': row[6]
-                    })
-                return users
-                
-        except Exception as e:
-            logger.error(f"Ошибка при поиске пользователей по навыкам: {e}")
-            return []
+    @run_in_db_thread
+    def search_users_by_skills(self, skills: List[str]) -> List[Dict[str, Any]]:
+        """Поиск пользователей по навыкам (достаточно любого из навыков)"""
+        return self._search_users(' '.join(skills), 'skills', match_all=False)
 
-    async def search_users_by_occupation(self, occupation: str) -> List[Dict[str, Any]]:
+    @run_in_db_thread
+    def search_users_by_occupation(self, occupation: str) -> List[Dict[str, Any]]:
         """Поиск пользователей по роду деятельности"""
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                SELECT user_id, username, full_name, telegram_nick, 
-                       occupation, skills, company_info
-                FROM users
-                WHERE occupation LIKE ?
-                """, (f'%{occupation}%',))
-                
-                users = []
-                for row in cursor.fetchall():
-                    users.append({
-                        'user_id': row[0],
-                        'username': row[1],
-                        'full_name': row[2],
-                        'telegram_nick': row[3],
-                        'occupation': row[4],
-                        'skills': json.loads(row[5]) if row[5] else [],
-                        'company_info': row[6]
-                    })
-                return users
-                
-        except Exception as e:
-            logger.error(f"Ошибка при поиске пользователей по роду деятельности: {e}")
-            return []
+        return self._search_users(occupation, 'occupation')
 
-    async def add_member(self, telegram_id, username, full_name, skills, interests, contact_info):
+    @run_in_db_thread
+    def add_member(self, telegram_id, username, full_name, skills, interests, contact_info):
         """Добавление нового участника"""
         session = self.Session()
         try:
@@ -430,6 +635,8 @@ class Database:
                 session.add(member)
             
             session.commit()
+            if self._member_index_ready:
+                self._index_member(existing_member or member)
             logger.info(f"Успешно сохранен пользователь: {full_name}")
             return True
         except Exception as e:
@@ -439,7 +646,8 @@ class Database:
         finally:
             session.close()
 
-    async def get_member(self, telegram_id):
+    @run_in_db_thread
+    def get_member(self, telegram_id):
         """Получение информации об участнике"""
         session = self.Session()
         try:
@@ -457,25 +665,26 @@ class Database:
         finally:
             session.close()
 
-    async def find_members_by_skill(self, skill):
+    @run_in_db_thread
+    def find_members_by_skill(self, skill):
         """Поиск участников по навыку"""
         session = self.Session()
         try:
-            members = session.query(CommunityMember).all()
-            matching_members = []
-            for member in members:
-                skills = json.loads(member.skills)
-                if skill.lower() in [s.lower() for s in skills]:
-                    matching_members.append({
-                        'username': member.username,
-                        'full_name': member.full_name,
-                        'contact_info': json.loads(member.contact_info)
-                    })
-            return matching_members
+            self._ensure_member_index(session)
+            member_ids = self.member_index.lookup_skill(skill)
+            if not member_ids:
+                return []
+            members = session.query(CommunityMember).filter(CommunityMember.id.in_(member_ids)).all()
+            return [{
+                'username': member.username,
+                'full_name': member.full_name,
+                'contact_info': json.loads(member.contact_info)
+            } for member in members]
         finally:
             session.close()
 
-    async def find_members_by_interest(self, interest):
+    @run_in_db_thread
+    def find_members_by_interest(self, interest):
         """Поиск участников по интересам"""
         session = self.Session()
         try:
@@ -493,7 +702,8 @@ class Database:
         finally:
             session.close()
 
-    async def update_member(self, telegram_id, **kwargs):
+    @run_in_db_thread
+    def update_member(self, telegram_id, **kwargs):
         """Обновление информации об участнике"""
         session = self.Session()
         try:
@@ -504,6 +714,8 @@ class Database:
                         value = json.dumps(value)
                     setattr(member, key, value)
                 session.commit()
+                if self._member_index_ready:
+                    self._index_member(member)
                 return True
             return False
         except Exception as e:
@@ -512,7 +724,8 @@ class Database:
         finally:
             session.close()
 
-    async def get_all_members(self):
+    @run_in_db_thread
+    def get_all_members(self):
         """Получение всех участников"""
         session = self.Session()
         try:
@@ -528,50 +741,40 @@ class Database:
         finally:
             session.close()
 
-    async def find_members_by_category(self, category):
+    @run_in_db_thread
+    def find_members_by_category(self, category):
         """Поиск участников по категории (например, 'разработчик', 'дизайнер' и т.д.)"""
         session = self.Session()
         try:
-            members = session.query(CommunityMember).all()
-            matching_members = []
-            
-            # Словарь категорий и связанных с ними ключевых слов
-            category_keywords = {
-                'разработчик': ['python', 'javascript', 'java', 'react', 'node', 'developer', 'web', 'backend', 'frontend'],
-                'дизайнер': ['design', 'ui', 'ux', 'figma', 'photoshop', 'prototype'],
-                'менеджер': ['manager', 'management', 'agile', 'scrum', 'team lead', 'product'],
-                'маркетолог': ['marketing', 'smm', 'content', 'analytics', 'brand']
-            }
-            
-            # Нормализуем категорию
-            category = category.lower()
-            
-            # Определяем ключевые слова для поиска
-            search_keywords = []
-            for cat, keywords in category_keywords.items():
-                if category in cat.lower() or any(category in keyword.lower() for keyword in keywords):
-                    search_keywords.extend(keywords)
-            
-            # Если нашли ключевые слова, ищем по ним
-            if search_keywords:
-                for member in members:
-                    skills = [s.lower() for s in json.loads(member.skills)]
-                    interests = [i.lower() for i in json.loads(member.interests)]
-                    
-                    # Проверяем совпадение по навыкам или интересам
-                    if any(keyword.lower() in skill for keyword in search_keywords for skill in skills) or \
-                       any(keyword.lower() in interest for keyword in search_keywords for interest in interests):
-                        matching_members.append({
-                            'username': member.username,
-                            'full_name': member.full_name,
-                            'skills': json.loads(member.skills),
-                            'contact_info': json.loads(member.contact_info)
-                        })
-            
-            return matching_members
+            self._ensure_member_index(session)
+            member_ids = self.member_index.lookup_category(category)
+            if not member_ids:
+                return []
+            members = session.query(CommunityMember).filter(CommunityMember.id.in_(member_ids)).all()
+            return [{
+                'username': member.username,
+                'full_name': member.full_name,
+                'skills': json.loads(member.skills),
+                'contact_info': json.loads(member.contact_info)
+            } for member in members]
         finally:
             session.close()
 
+    def _index_member(self, member):
+        """Переиндексирует участника по навыкам и интересам"""
+        skills = json.loads(member.skills or '[]')
+        interests = json.loads(member.interests or '[]')
+        self.member_index.update(member.id, skills + interests, skills)
+
+    def _ensure_member_index(self, session):
+        """Строит индекс специализаций при первом обращении (далее он обновляется инкрементально)"""
+        if self._member_index_ready:
+            return
+        for member in session.query(CommunityMember).all():
+            self._index_member(member)
+        self._member_index_ready = True
+        logger.info(f"🗂 Индекс специализаций построен: {len(self.member_index)} участников")
+
     async def format_user_info(self, user_info: dict) -> str:
         """Форматирует информацию о пользователе для вывода"""
         if not user_info:
@@ -599,41 +802,13 @@ class Database:
                 
         return '\n\n'.join(formatted)
 
-    async def search_users_by_keyword(self, keyword: str) -> List[Dict[str, Any]]:
-        """Поиск пользователей по ключевому слову в специализации, навыках или описании"""
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                SELECT user_id, username, full_name, telegram_nick, 
-                       occupation, skills, company_info, links
-                FROM users
-                WHERE occupation LIKE ? 
-                   OR skills LIKE ? 
-                   OR company_info LIKE ?
-                   AND is_complete = TRUE
-                """, (f'%{keyword}%', f'%{keyword}%', f'%{keyword}%'))
-                
-                users = []
-                for row in cursor.fetchall():
-                    user_info = {
-                        'user_id': row[0],
-                        'username': row[1],
-                        'full_name': row[2],
-                        'telegram_nick': row[3],
-                        'occupation': row[4],
-                        'skills': json.loads(row[5]) if row[5] else [],
-                        'company_info': row[6],
-                        'links': json.loads(row[7]) if row[7] else {}
-                    }
-                    users.append(user_info)
-                return users
-                
-        except Exception as e:
-            logger.error(f"Ошибка при поиске пользователей по ключевому слову: {e}")
-            return []
+    @run_in_db_thread
+    def search_users_by_keyword(self, keyword: str) -> List[Dict[str, Any]]:
+        """Поиск пользователей по ключевому слову в специализации, навыках или компании"""
+        return self._search_users(keyword, 'keyword')
 
-    async def clear_user_context(self, user_id: int) -> bool:
+    @run_in_db_thread
+    def clear_user_context(self, user_id: int) -> bool:
         """Очистка контекста диалога для конкретного пользователя"""
         try:
             with self.get_connection() as conn:
@@ -653,7 +828,8 @@ class Database:
             logger.error(f"❌ Ошибка при очистке контекста пользователя {user_id}: {e}")
             return False
 
-    async def get_context_stats(self, user_id: int) -> Dict[str, Any]:
+    @run_in_db_thread
+    def get_context_stats(self, user_id: int) -> Dict[str, Any]:
         """Получение статистики контекста для пользователя"""
         try:
             with self.get_connection() as conn:
@@ -710,7 +886,8 @@ class Database:
             logger.error(f"❌ Ошибка при получении статистики контекста для пользователя {user_id}: {e}")
             return None
 
-    async def save_user_profile(self, user_id: int, profile_data: dict) -> bool:
+    @run_in_db_thread
+    def save_user_profile(self, user_id: int, profile_data: dict) -> bool:
         """Сохранение профиля пользователя"""
         try:
             with self.get_connection() as conn:
@@ -773,52 +950,70 @@ class Database:
             logger.error(f"❌ Ошибка при сохранении профиля пользователя {user_id}: {e}")
             return False
 
-    async def search_users(self, query: str, search_type: str = 'all') -> List[Dict[str, Any]]:
+    @run_in_db_thread
+    def search_users(self, query: str, search_type: str = 'all', limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Поиск пользователей по различным критериям с ранжированием по релевантности
+        search_type может быть: 'all', 'skills', 'occupation', 'name', 'keyword'
         """
-        Поиск пользователей по различным критериям
-        search_type может быть: 'all', 'skills', 'occupation', 'name'
+        return self._search_users(query, search_type, limit)
+
+    def _search_users(self, query: str, search_type: str = 'all', limit: int = 20,
+                      match_all: bool = True) -> List[Dict[str, Any]]:
+        """Единая реализация поиска: FTS5 с bm25, при невозможности — LIKE.
+
+        Стоп-слова отбрасываются; при match_all участник должен подходить
+        под все значимые слова запроса, иначе — под любое.
         """
         try:
+            columns = SEARCH_TYPE_COLUMNS.get(search_type, USERS_FTS_COLUMNS)
+            # Триграммный индекс находит только подстроки от 3 символов
+            terms = significant_terms(query)
+            if not terms:
+                return []
+            operator = ' AND ' if match_all else ' OR '
+            
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                
-                base_query = """
-                SELECT user_id, full_name, telegram_nick, occupation,
-                       skills, company_info, links, about
-                FROM users
-                WHERE is_complete = TRUE AND
+                select = """
+                SELECT u.user_id, u.username, u.full_name, u.telegram_nick, u.occupation,
+                       u.skills, u.company_info, u.links, u.about
                 """
-                
-                if search_type == 'skills':
-                    where_clause = "skills LIKE ?"
-                    params = (f'%{query}%',)
-                elif search_type == 'occupation':
-                    where_clause = "occupation LIKE ?"
-                    params = (f'%{query}%',)
-                elif search_type == 'name':
-                    where_clause = "full_name LIKE ?"
-                    params = (f'%{query}%',)
+                if self.fts_enabled:
+                    suffix = '*' if self.fts_prefix_terms else ''
+                    match = '{' + ' '.join(columns) + '} : (' + operator.join(f'"{t}"{suffix}' for t in terms) + ')'
+                    weights = ', '.join(str(w) for w in USERS_FTS_WEIGHTS)
+                    cursor.execute(f"""
+                    {select}
+                    FROM users_fts
+                    JOIN users u ON u.user_id = users_fts.rowid
+                    WHERE users_fts MATCH ? AND u.is_complete = TRUE
+                    ORDER BY bm25(users_fts, {weights})
+                    LIMIT ?
+                    """, (match, limit))
                 else:
-                    # Поиск по всем полям
-                    where_clause = """
-                    (skills LIKE ? OR occupation LIKE ? OR 
-                     full_name LIKE ? OR company_info LIKE ? OR about LIKE ?)
-                    """
-                    params = (f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%')
-                
-                cursor.execute(f"{base_query} {where_clause}", params)
+                    term_clause = '(' + ' OR '.join(f'normalize_text(u.{c}) LIKE ?' for c in columns) + ')'
+                    where_clause = operator.join([term_clause] * len(terms))
+                    params = [f'%{t}%' for t in terms for _ in columns]
+                    cursor.execute(f"""
+                    {select}
+                    FROM users u
+                    WHERE u.is_complete = TRUE AND ({where_clause})
+                    LIMIT ?
+                    """, (*params, limit))
                 
                 users = []
                 for row in cursor.fetchall():
                     user_info = {
                         'user_id': row[0],
-                        'full_name': row[1],
-                        'telegram_nick': row[2],
-                        'occupation': row[3],
-                        'skills': json.loads(row[4]) if row[4] else [],
-                        'company_info': row[5],
-                        'links': json.loads(row[6]) if row[6] else {},
-                        'about': row[7]
+                        'username': row[1],
+                        'full_name': row[2],
+                        'telegram_nick': row[3],
+                        'occupation': row[4],
+                        'skills': json.loads(row[5]) if row[5] else [],
+                        'company_info': row[6],
+                        'links': json.loads(row[7]) if row[7] else {},
+                        'about': row[8]
                     }
                     users.append(user_info)
                 
@@ -869,7 +1064,8 @@ class Database:
             logger.error(f"❌ Ошибка при парсинге сообщения регистрации: {e}")
             return None
 
-    async def get_all_users(self) -> List[Dict[str, Any]]:
+    @run_in_db_thread
+    def get_all_users(self) -> List[Dict[str, Any]]:
         """Получить всех пользователей из базы данных"""
         try:
             with self.get_connection() as conn:
@@ -903,7 +1099,39 @@ class Database:
             logger.error(f"❌ Ошибка при получении списка пользователей: {e}")
             return []
 
-    async def search_users_by_specialization(self, query: str) -> List[Dict[str, Any]]:
+    @run_in_db_thread
+    def get_users_by_ids(self, user_ids: List[int]) -> List[Dict[str, Any]]:
+        """Получить заполненные профили пользователей по списку id"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return []
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(user_ids))
+                cursor.execute(f"""
+                SELECT user_id, username, full_name, telegram_nick,
+                       occupation, skills, company_info, links, about
+                FROM users
+                WHERE is_complete = TRUE AND user_id IN ({placeholders})
+                """, user_ids)
+                return [{
+                    'user_id': row[0],
+                    'username': row[1],
+                    'full_name': row[2],
+                    'telegram_nick': row[3],
+                    'occupation': row[4],
+                    'skills': json.loads(row[5]) if row[5] else [],
+                    'company_info': row[6],
+                    'links': json.loads(row[7]) if row[7] else {},
+                    'about': row[8]
+                } for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении пользователей по id: {e}")
+            return []
+
+    @run_in_db_thread
+    def search_users_by_specialization(self, query: str) -> List[Dict[str, Any]]:
         """Получение всех пользователей из базы данных"""
         try:
             with self.get_connection() as conn:
@@ -943,14 +1171,7 @@ class Database:
             logger.error(f"❌ Ошибка при получении пользователей: {e}")
             return []
 
-    async def update_system_prompt(self, prompt: str) -> bool:
-        """Обновление системного промпта в базе данных"""
-        return False
-
-    async def get_system_prompt(self) -> str:
-        """Получение актуального системного промпта из базы данных"""
-        return None
-
+    @run_in_db_thread
     def get_context(self, user_id: int) -> list:
         """Получает контекст сообщений пользователя"""
         try:
@@ -959,7 +1180,7 @@ class Database:
                 cursor.execute("""
                     SELECT role, content FROM message_context 
                     WHERE user_id = ? 
-                    ORDER BY timestamp ASC
+                    ORDER BY timestamp ASC, id ASC
                 """, (user_id,))
                 messages = cursor.fetchall()
                 return [{"role": msg[0], "content": msg[1]} for msg in messages]
@@ -967,21 +1188,50 @@ class Database:
             logger.error(f"Ошибка при получении контекста для пользователя {user_id}: {e}")
             return []
 
-    def add_message_to_context(self, user_id: int, role: str, content: str):
-        """Добавляет сообщение в контекст пользователя"""
+    @run_in_db_thread
+    def add_message_to_context(self, user_id: int, role: str, content: str) -> Optional[dict]:
+        """Добавляет сообщение в контекст пользователя и возвращает сохранённую запись"""
         try:
+            # Формат совпадает с CURRENT_TIMESTAMP, чтобы сортировка по времени была единой
+            timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
-                    INSERT INTO message_context (user_id, role, content)
-                    VALUES (?, ?, ?)
-                """, (user_id, role, content))
+                    INSERT INTO message_context (user_id, role, content, timestamp)
+                    VALUES (?, ?, ?, ?)
+                """, (user_id, role, content, timestamp))
                 conn.commit()
-                return True
+                return {
+                    'id': cursor.lastrowid,
+                    'role': role,
+                    'content': content,
+                    'timestamp': timestamp
+                }
         except Exception as e:
             logger.error(f"Ошибка при добавлении сообщения в контекст для пользователя {user_id}: {e}")
-            return False
+            return None
 
+    @run_in_db_thread
+    def get_messages_after(self, user_id: int, after_id: Optional[int], limit: int) -> list:
+        """Получает сообщения пользователя после сообщения after_id в порядке добавления"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, role, content, timestamp FROM message_context
+                    WHERE user_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                """, (user_id, after_id or 0, limit))
+                return [
+                    {'id': row[0], 'role': row[1], 'content': row[2], 'timestamp': row[3]}
+                    for row in cursor.fetchall()
+                ]
+        except Exception as e:
+            logger.error(f"Ошибка при получении новых сообщений пользователя {user_id}: {e}")
+            return []
+
+    @run_in_db_thread
     def clear_context(self, user_id: int):
         """Очищает контекст сообщений пользователя"""
         try:
@@ -994,6 +1244,7 @@ class Database:
             logger.error(f"Ошибка при очистке контекста для пользователя {user_id}: {e}")
             return False
 
+    @run_in_db_thread
     def get_system_prompt(self) -> str:
         """Получает системный промпт из базы данных"""
         try:
@@ -1006,6 +1257,7 @@ class Database:
             logger.error(f"Ошибка при получении системного промпта: {e}")
             return ""
 
+    @run_in_db_thread
     def update_system_prompt(self, new_prompt: str):
         """Обновляет системный промпт в базе данных"""
         try:
@@ -1021,29 +1273,376 @@ class Database:
             logger.error(f"Ошибка при обновлении системного промпта: {e}")
             return False
 
+    @run_in_db_thread
+    def get_cached_image(self, cache_key: str) -> Optional[str]:
+        """Возвращает file_id изображения из кэша и отмечает использование"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT file_id FROM image_cache WHERE cache_key = ?", (cache_key,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                cursor.execute(
+                    "UPDATE image_cache SET last_used_at = strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                    "WHERE cache_key = ?",
+                    (cache_key,)
+                )
+                conn.commit()
+                return row[0]
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша изображений: {e}")
+            return None
+
+    @run_in_db_thread
+    def save_cached_image(self, cache_key: str, prompt: str, params: dict, file_id: str,
+                          max_entries: int = 1000) -> bool:
+        """Сохраняет file_id изображения; при переполнении удаляет давно не использованные"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT OR REPLACE INTO image_cache (cache_key, prompt, params, file_id, last_used_at)
+                    VALUES (?, ?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))
+                """, (cache_key, prompt, json.dumps(params, ensure_ascii=False), file_id))
+                cursor.execute("""
+                    DELETE FROM image_cache WHERE cache_key IN (
+                        SELECT cache_key FROM image_cache
+                        ORDER BY last_used_at DESC, rowid DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                """, (max_entries,))
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении в кэш изображений: {e}")
+            return False
+
+    @run_in_db_thread
+    def delete_cached_image(self, cache_key: str) -> bool:
+        """Удаляет запись кэша изображений (например, если file_id стал недействителен)"""
+        try:
+            with self.get_connection() as conn:
+                conn.execute("DELETE FROM image_cache WHERE cache_key = ?", (cache_key,))
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при удалении из кэша изображений: {e}")
+            return False
+
+    @run_in_db_thread
+    def get_file_hash(self, file_unique_id: str) -> Optional[str]:
+        """SHA-256 содержимого уже скачанного ранее файла Telegram"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT sha256 FROM file_hashes WHERE file_unique_id = ?", (file_unique_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Ошибка при чтении хэша файла: {e}")
+            return None
+
+    @run_in_db_thread
+    def get_file_analysis(self, sha256: str, prompt: str) -> Optional[str]:
+        """Возвращает сохранённый результат анализа файла и отмечает использование"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT result FROM file_analysis_cache WHERE sha256 = ? AND prompt = ?",
+                    (sha256, prompt)
+                )
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                cursor.execute(
+                    "UPDATE file_analysis_cache SET last_used_at = strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                    "WHERE sha256 = ? AND prompt = ?",
+                    (sha256, prompt)
+                )
+                conn.commit()
+                return row[0]
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша анализа файлов: {e}")
+            return None
+
+    @run_in_db_thread
+    def save_file_analysis(self, file_unique_id: Optional[str], sha256: str, prompt: str, mime_type: str,
+                           result: str, max_entries: int = 500) -> bool:
+        """Сохраняет результат анализа файла; при переполнении удаляет давно не использованные"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if file_unique_id:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO file_hashes (file_unique_id, sha256) VALUES (?, ?)",
+                        (file_unique_id, sha256)
+                    )
+                cursor.execute("""
+                    INSERT OR REPLACE INTO file_analysis_cache (sha256, prompt, mime_type, result, last_used_at)
+                    VALUES (?, ?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))
+                """, (sha256, prompt, mime_type, result))
+                cursor.execute("""
+                    DELETE FROM file_analysis_cache WHERE rowid IN (
+                        SELECT rowid FROM file_analysis_cache
+                        ORDER BY last_used_at DESC, rowid DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                """, (max_entries,))
+                if cursor.rowcount:
+                    # Хэши файлов, для которых не осталось ни одного результата, больше не нужны
+                    cursor.execute("""
+                        DELETE FROM file_hashes
+                        WHERE sha256 NOT IN (SELECT sha256 FROM file_analysis_cache)
+                    """)
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении в кэш анализа файлов: {e}")
+            return False
+
+    @run_in_db_thread
+    def get_roster_entries(self) -> Dict[int, str]:
+        """Получает сохранённые строки списка участников"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT user_id, line FROM roster_entries ORDER BY user_id")
+                return {row[0]: row[1] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка участников: {e}")
+            return {}
+
+    @run_in_db_thread
+    def save_roster_entries(self, changes: Dict[int, Optional[str]]) -> bool:
+        """Сохраняет изменённые строки списка участников (None — удалить строку)"""
+        upserts = [(line, user_id) for user_id, line in changes.items() if line is not None]
+        deletes = [(user_id,) for user_id, line in changes.items() if line is None]
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    INSERT INTO roster_entries (line, user_id, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        line = excluded.line, updated_at = excluded.updated_at
+                """, upserts)
+                cursor.executemany("DELETE FROM roster_entries WHERE user_id = ?", deletes)
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении списка участников: {e}")
+            return False
+
+    @run_in_db_thread
     def get_all_summaries(self, user_id: int) -> list:
-        """Получает все саммари пользователя по user_id, отсортированные по времени создания."""
+        """Получает активные (ещё не сжатые) саммари пользователя в хронологическом порядке."""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     """
-                    SELECT summary, start_timestamp, end_timestamp, created_at
+                    SELECT id, summary, start_timestamp, end_timestamp, created_at, tier, end_message_id
                     FROM chat_summaries
-                    WHERE user_id = ?
-                    ORDER BY created_at ASC
+                    WHERE user_id = ? AND compacted_into IS NULL
+                    ORDER BY start_timestamp ASC, id ASC
                     """,
                     (user_id,)
                 )
                 return [
                     {
-                        'summary': row[0],
-                        'start_timestamp': row[1],
-                        'end_timestamp': row[2],
-                        'created_at': row[3]
+                        'id': row[0],
+                        'summary': row[1],
+                        'start_timestamp': row[2],
+                        'end_timestamp': row[3],
+                        'created_at': row[4],
+                        'tier': row[5],
+                        'end_message_id': row[6]
                     }
                     for row in cursor.fetchall()
                 ]
         except Exception as e:
             logger.error(f"Ошибка при получении всех саммари пользователя {user_id}: {e}")
-            return [] 
\ No newline at end of file
+            return []
+
+    @run_in_db_thread
+    def compact_summaries(self, user_id: int, source_ids: List[int], summary: str, tier: int) -> Optional[int]:
+        """Заменяет несколько активных саммари одним саммари уровня tier.
+
+        Исходные строки остаются в базе и помечаются ссылкой на новое саммари.
+        Если какая-то из них уже сжата (или удалена), ничего не меняется.
+        """
+        if not source_ids:
+            return None
+        placeholders = ','.join('?' * len(source_ids))
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN")
+                cursor.execute(f"""
+                    SELECT MIN(start_timestamp), MAX(end_timestamp), MAX(end_message_id), COUNT(*)
+                    FROM chat_summaries
+                    WHERE user_id = ? AND compacted_into IS NULL AND id IN ({placeholders})
+                """, (user_id, *source_ids))
+                start_timestamp, end_timestamp, end_message_id, count = cursor.fetchone()
+                if count != len(source_ids):
+                    conn.rollback()
+                    logger.warning(f"Саммари пользователя {user_id} уже изменились, сжатие пропущено")
+                    return None
+                cursor.execute("""
+                    INSERT INTO chat_summaries (
+                        user_id, summary, start_timestamp, end_timestamp, end_message_id, tier, source_ids
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (user_id, summary, start_timestamp, end_timestamp, end_message_id, tier, json.dumps(source_ids)))
+                new_id = cursor.lastrowid
+                cursor.execute(
+                    f"UPDATE chat_summaries SET compacted_into = ? WHERE id IN ({placeholders})",
+                    (new_id, *source_ids)
+                )
+                conn.commit()
+                logger.info(f"Саммари {source_ids} пользователя {user_id} сжаты в {new_id} (уровень {tier})")
+                return new_id
+        except Exception as e:
+            logger.error(f"Ошибка при сжатии саммари пользователя {user_id}: {e}")
+            return None
+
+    @run_in_db_thread
+    def get_user_id_by_nick(self, telegram_nick: str) -> Optional[int]:
+        """Находит user_id по нику в Telegram (без @)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT user_id FROM users WHERE telegram_nick = ?", (telegram_nick,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Ошибка при поиске пользователя по нику {telegram_nick}: {e}")
+            return None
+
+    @run_in_db_thread
+    def delete_all_users(self) -> bool:
+        """Удаляет всех пользователей"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM users")
+                cursor.execute("DELETE FROM roster_entries")
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка при удалении пользователей: {e}")
+            return False
+
+    @run_in_db_thread
+    def get_context_overview(self) -> Dict[str, Any]:
+        """Собирает статистику контекстов и саммари по всем пользователям"""
+        context_stats = {}
+        summary_count = 0
+        compacted_count = 0
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                # Получаем количество сообщений для каждого пользователя
+                cursor.execute("""
+                    SELECT user_id, COUNT(*) as msg_count 
+                    FROM message_context 
+                    GROUP BY user_id
+                """)
+                rows = cursor.fetchall()
+                logger.info(f"📊 Найдено {len(rows)} пользователей с сообщениями")
+                
+                for user_id, msg_count in rows:
+                    context_stats[user_id] = msg_count
+                    # Получаем последние сообщения пользователя
+                    cursor.execute("""
+                        SELECT role, content, timestamp 
+                        FROM message_context 
+                        WHERE user_id = ? 
+                        ORDER BY timestamp DESC 
+                        LIMIT 5
+                    """, (user_id,))
+                    last_messages = cursor.fetchall()
+                    logger.info(f"👤 Пользователь {user_id}:")
+                    logger.info(f"   • Всего сообщений: {msg_count}")
+                    logger.info(f"   • Последние сообщения:")
+                    for role, content, timestamp in last_messages:
+                        logger.info(f"     - [{timestamp}] {role}: {content[:50]}...")
+
+                # Получаем информацию о саммари: активные (попадают в промпт, как в get_all_summaries)
+                # и уже сжатые в саммари более высокого уровня
+                cursor.execute("""
+                    SELECT COUNT(*) FILTER (WHERE compacted_into IS NULL),
+                           COUNT(*) FILTER (WHERE compacted_into IS NOT NULL)
+                    FROM chat_summaries
+                """)
+                summary_count, compacted_count = cursor.fetchone()
+                logger.info(f"📝 Саммари в базе: активных {summary_count}, сжатых {compacted_count}")
+                
+                # Получаем детали последних саммари
+                cursor.execute("""
+                    SELECT user_id, summary, created_at 
+                    FROM chat_summaries 
+                    WHERE compacted_into IS NULL
+                    ORDER BY created_at DESC 
+                    LIMIT 5
+                """)
+                last_summaries = cursor.fetchall()
+                logger.info("📝 Последние саммари:")
+                for user_id, summary, created_at in last_summaries:
+                    logger.info(f"   • Пользователь {user_id} [{created_at}]:")
+                    logger.info(f"     {summary[:100]}...")
+                
+                # Проверяем пользователей с длинными контекстами
+                long_contexts = [user_id for user_id, count in context_stats.items() if count > 20]
+                logger.info(f"📊 Пользователи с длинными контекстами (>20): {long_contexts}")
+                
+        except Exception as e:
+            logger.error(f"❌ Ошибка при получении данных из БД: {str(e)}")
+            context_stats = {}
+            summary_count = 0
+            compacted_count = 0
+        return {'context_stats': context_stats, 'summary_count': summary_count, 'compacted_count': compacted_count}
+
+    @run_in_db_thread
+    def export_backup_data(self) -> Dict[str, Any]:
+        """Выгружает сообщения, саммари и настройки для резервной копии"""
+        backup_data = {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Получаем все сообщения
+            cursor.execute("SELECT user_id, role, content, timestamp FROM message_context")
+            backup_data['messages'] = [
+                {
+                    'user_id': row[0],
+                    'role': row[1],
+                    'content': row[2],
+                    'timestamp': row[3]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            # Получаем все саммари
+            cursor.execute("SELECT user_id, summary, created_at FROM chat_summaries")
+            backup_data['summaries'] = [
+                {
+                    'user_id': row[0],
+                    'summary': row[1],
+                    'created_at': row[2]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            # Получаем все настройки
+            cursor.execute("SELECT key, value, updated_at FROM settings")
+            backup_data['settings'] = [
+                {
+                    'key': row[0],
+                    'value': row[1],
+                    'updated_at': row[2]
+                }
+                for row in cursor.fetchall()
+            ]
+        return backup_data
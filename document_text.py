@@ -0,0 +1,121 @@
+import codecs
+import logging
+import re
+from typing import Iterable, Iterator
+
+from llm_provider import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Необязательные зависимости: без них PDF и DOCX уходят в Gemini File API целиком
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+try:
+    import docx
+except ImportError:
+    docx = None
+
+PDF_MIME_TYPE = 'application/pdf'
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+TEXT_MIME_TYPES = {'text/plain', 'text/markdown', 'text/csv'}
+
+TEXT_BLOCK_SIZE = 64 * 1024  # Сколько байт текстового файла читать за раз
+
+
+def can_extract(mime_type: str) -> bool:
+    """Можно ли извлечь текст документа локально"""
+    if mime_type == PDF_MIME_TYPE:
+        return PdfReader is not None
+    if mime_type == DOCX_MIME_TYPE:
+        return docx is not None
+    return mime_type in TEXT_MIME_TYPES
+
+
+def iter_pdf(path: str) -> Iterator[str]:
+    """Текст PDF постранично: страницы разбираются по мере чтения"""
+    reader = PdfReader(path)
+    for number, page in enumerate(reader.pages, 1):
+        try:
+            text = page.extract_text() or ''
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось извлечь текст со страницы {number}: {e}")
+            continue
+        if text.strip():
+            yield text
+
+
+def iter_docx(path: str) -> Iterator[str]:
+    """Текст DOCX по абзацам, затем таблицы построчно"""
+    document = docx.Document(path)
+    for paragraph in document.paragraphs:
+        if paragraph.text.strip():
+            yield paragraph.text
+    for table in document.tables:
+        for row in table.rows:
+            cells = [cell.text.strip() for cell in row.cells]
+            if any(cells):
+                yield ' | '.join(cells)
+
+
+def iter_txt(path: str) -> Iterator[str]:
+    """Текстовый файл блоками; кодировка UTF-8, при ошибке в начале файла — CP1251"""
+    with open(path, 'rb') as f:
+        head = f.read(TEXT_BLOCK_SIZE)
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(head)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'cp1251'
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        block = head
+        while block:
+            text = decoder.decode(block)
+            if text:
+                yield text
+            block = f.read(TEXT_BLOCK_SIZE)
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+
+def iter_text(path: str, mime_type: str) -> Iterator[str]:
+    """Потоково извлекает текст документа кусками (страницы, абзацы, блоки)"""
+    if mime_type == PDF_MIME_TYPE:
+        return iter_pdf(path)
+    if mime_type == DOCX_MIME_TYPE:
+        return iter_docx(path)
+    if mime_type in TEXT_MIME_TYPES:
+        return iter_txt(path)
+    raise ValueError(f"Локальное извлечение текста не поддерживается для {mime_type}")
+
+
+def _split_piece(piece: str, max_tokens: int) -> Iterator[str]:
+    """Делит слишком длинный кусок по строкам, а длинные строки — по символам"""
+    for line in re.split(r'(?<=\n)', piece):
+        if estimate_tokens(line) <= max_tokens:
+            yield line
+            continue
+        # 2.5 символа на токен — нижняя оценка, с ней кусок гарантированно влезает в лимит
+        # (estimate_tokens добавляет к оценке один токен)
+        step = max(1, int((max_tokens - 1) * 2.5))
+        for start in range(0, len(line), step):
+            yield line[start:start + step]
+
+
+def iter_chunks(pieces: Iterable[str], max_tokens: int) -> Iterator[str]:
+    """Собирает куски текста в чанки не больше max_tokens (по оценке estimate_tokens)"""
+    chunk, chunk_tokens = [], 0
+    for piece in pieces:
+        parts = [piece] if estimate_tokens(piece) <= max_tokens else _split_piece(piece, max_tokens)
+        for part in parts:
+            tokens = estimate_tokens(part)
+            if chunk and chunk_tokens + tokens > max_tokens:
+                yield ''.join(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(part if part.endswith('\n') else part + '\n')
+            chunk_tokens += tokens
+    if chunk:
+        yield ''.join(chunk)
@@ -1,54 +1,369 @@
 import os
+import time
+import asyncio
+import hashlib
 import logging
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
 MODEL_PROVIDER = os.getenv("MODEL_PROVIDER", "gemini")
 
+# Таймаут одного запроса к модели (в секундах)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
 if MODEL_PROVIDER == "openai":
     import openai
     openai.api_key = os.getenv("OPENAI_API_KEY")
     OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-nano-2025-04-14")
 
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Явный кэш системного промпта Gemini включается для длинных запросов: порог считается
+# по собранному запросу целиком (системный промпт + контекст + история), сам по себе
+# системный промпт намного короче. Если провайдер кэш не принял, попытка повторяется
+# не раньше чем через GEMINI_CACHE_RETRY секунд
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "4096"))
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "3600"))
+GEMINI_CACHE_RETRY = int(os.getenv("GEMINI_CACHE_RETRY", "600"))
+
+# Бюджет токенов на весь запрос к модели (системный промпт + контекст + история)
+PROMPT_TOKEN_BUDGETS = {
+    "gemini": 32000,
+    "openai": 16000,
+}
+
+def get_prompt_budget() -> int:
+    """Бюджет токенов промпта для текущего провайдера (PROMPT_TOKEN_BUDGET переопределяет)"""
+    override = os.getenv("PROMPT_TOKEN_BUDGET")
+    if override:
+        return int(override)
+    return PROMPT_TOKEN_BUDGETS.get(MODEL_PROVIDER, 16000)
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенизатора.
+
+    Кириллица у провайдеров кодируется плотнее латиницы: ~2.5 символа
+    на токен против ~4, поэтому символы считаются раздельно.
+    """
+    if not text:
+        return 0
+    cyrillic = sum(1 for ch in text if '\u0400' <= ch <= '\u04ff')
+    return int(cyrillic / 2.5 + (len(text) - cyrillic) / 4) + 1
+
+class PromptCacheStats:
+    """Статистика кэширования префикса промпта на стороне провайдера"""
+
+    def __init__(self):
+        self.requests = 0
+        self.hits = 0  # Запросы, в которых провайдер взял часть промпта из кэша
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, prompt_tokens: int, cached_tokens: int):
+        prompt_tokens = prompt_tokens or 0
+        cached_tokens = cached_tokens or 0
+        self.requests += 1
+        self.hits += 1 if cached_tokens else 0
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        logger.info(f"[LLM] {MODEL_PROVIDER}: токенов промпта {prompt_tokens}, из кэша {cached_tokens}")
+
+    def snapshot(self) -> dict:
+        return {
+            'requests': self.requests,
+            'hits': self.hits,
+            'hit_ratio': self.hits / self.requests if self.requests else 0.0,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'cached_ratio': self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
+
+prompt_cache_stats = PromptCacheStats()
+
+# Реестр долгоживущих клиентов провайдеров: создаются один раз на процесс
+# и переиспользуют пул HTTP-соединений (keep-alive) между запросами
+_clients = {}
+_gemini_configured = False
+# Модели Gemini по (имени модели, system_instruction): у чата, саммари и анализа файлов
+# свои системные промпты, и запросы чередуются — каждой нужна своя модель
+_gemini_models = OrderedDict()
+GEMINI_MODELS_CACHE_SIZE = 8
+# Создание явного кэша контекста: без блокировки два первых запроса создали бы по кэшу
+_gemini_cache_lock = asyncio.Lock()
+
 def get_openai_client():
-    return openai.OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY")
-    )
+    client = _clients.get("openai")
+    if client is None:
+        import openai
+        import httpx
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=120,
+            ),
+            timeout=LLM_TIMEOUT,
+        )
+        client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=http_client,
+        )
+        _clients["openai"] = client
+        logger.info("[LLM] Создан клиент OpenAI с пулом соединений")
+    return client
 
-def get_gemini_model():
+def _configure_gemini():
+    global _gemini_configured
     import google.generativeai as genai
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    return genai.GenerativeModel('gemini-2.0-flash')
+    if not _gemini_configured:
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        _gemini_configured = True
+    return genai
+
+def get_gemini_model(model_name: str = GEMINI_MODEL, system_instruction: str = None):
+    """Модель Gemini; стабильный префикс промпта передаётся как system_instruction"""
+    genai = _configure_gemini()
+    key = (model_name, hashlib.sha1((system_instruction or "").encode()).hexdigest())
+    model = _gemini_models.get(key)
+    if model is None:
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction or None)
+        _gemini_models[key] = model
+        while len(_gemini_models) > GEMINI_MODELS_CACHE_SIZE:
+            _gemini_models.popitem(last=False)
+        logger.info(f"[LLM] Создана модель Gemini {model_name}")
+    else:
+        _gemini_models.move_to_end(key)
+    return model
+
+async def _get_gemini_cached_model(system_prompt: str, prompt_tokens: int):
+    """Модель поверх явного кэша контекста Gemini (CachedContent) для длинного запроса.
+
+    Кэш создаётся один раз на версию системного промпта и пересоздаётся незадолго
+    до истечения TTL. Возвращает None, если запрос (prompt_tokens вместе с системным
+    промптом) слишком короткий или кэш недоступен.
+    """
+    if prompt_tokens < GEMINI_CACHE_MIN_TOKENS:
+        return None
+    digest = hashlib.sha1(system_prompt.encode()).hexdigest()
+    entry = _clients.get("gemini:cache")
+    if _is_cache_entry_fresh(entry, digest):
+        return entry['model']
+    async with _gemini_cache_lock:
+        # Пока ждали блокировку, кэш мог создать параллельный запрос
+        entry = _clients.get("gemini:cache")
+        if _is_cache_entry_fresh(entry, digest):
+            return entry['model']
+        return await _create_gemini_cache(system_prompt, digest, entry)
+
+def _is_cache_entry_fresh(entry: dict, digest: str) -> bool:
+    # Неудачная попытка тоже истекает: через GEMINI_CACHE_RETRY кэш создаётся заново
+    return bool(entry) and entry['digest'] == digest and time.monotonic() < entry['expires_at']
+
+async def _create_gemini_cache(system_prompt: str, digest: str, entry: dict):
+    genai = _configure_gemini()
+    from google.generativeai import caching
+    model = cache = None
+    try:
+        cache = await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=GEMINI_MODEL,
+            display_name=f"bratbot-{digest[:12]}",
+            system_instruction=system_prompt,
+            ttl=GEMINI_CACHE_TTL,
+        )
+        model = genai.GenerativeModel.from_cached_content(cache)
+        logger.info(f"[LLM] Gemini: создан кэш контекста {cache.name}")
+    except Exception as e:
+        # Запоминаем неудачу на время, чтобы не повторять попытку на каждом запросе
+        logger.warning(f"[LLM] Gemini: кэш контекста недоступен, используется system_instruction: {e}")
+    if entry and entry['cache'] is not None and entry['digest'] != digest:
+        # Префикс изменился — старый кэш больше не понадобится
+        try:
+            await asyncio.to_thread(entry['cache'].delete)
+        except Exception as e:
+            logger.warning(f"[LLM] Gemini: не удалось удалить устаревший кэш контекста: {e}")
+    _clients["gemini:cache"] = {
+        'digest': digest,
+        'model': model,
+        'cache': cache,
+        'expires_at': time.monotonic() + (GEMINI_CACHE_TTL - 60 if model else GEMINI_CACHE_RETRY),
+    }
+    return model
 
-def generate_response(messages: list, system_prompt: str) -> str:
+async def _get_gemini_model_for(system_prompt: str, prompt: str):
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(prompt)
+    return (await _get_gemini_cached_model(system_prompt, prompt_tokens)
+            or get_gemini_model(system_instruction=system_prompt))
+
+async def close_clients():
+    """Закрывает соединения всех созданных клиентов провайдеров"""
+    client = _clients.pop("openai", None)
+    if client is not None:
+        try:
+            await client.close()
+        except Exception as e:
+            logger.error(f"[LLM] Ошибка при закрытии клиента OpenAI: {e}")
+    entry = _clients.pop("gemini:cache", None)
+    if entry and entry['cache'] is not None:
+        try:
+            await asyncio.to_thread(entry['cache'].delete)
+        except Exception as e:
+            logger.error(f"[LLM] Ошибка при удалении кэша контекста Gemini: {e}")
+    _clients.clear()
+    _gemini_models.clear()
+    logger.info("[LLM] Клиенты провайдеров закрыты")
+
+def _build_gemini_prompt(messages: list, context: str = None) -> str:
+    # Системный промпт передаётся модели отдельно (system_instruction), здесь — только переменная часть
+    parts = [context + "\n\n" if context else "", "История диалога:\n"]
+    for msg in messages:
+        role = "Пользователь" if msg["role"] == "user" else "Ассистент"
+        parts.append(f"{role}: {msg['content']}\n")
+    prompt = "".join(parts)
+    logger.info(f"[LLM] Gemini: длина промпта: {len(prompt)} символов")
+    logger.debug(f"[LLM] Gemini: полный промпт:\n{prompt}")
+    return prompt
+
+def _build_openai_messages(messages: list, system_prompt: str, context: str = None) -> list:
+    # Стабильный системный промпт всегда первым сообщением: OpenAI автоматически
+    # кэширует совпадающий префикс запроса, переменная часть идёт после него
+    openai_messages = [
+        {"role": "system", "content": system_prompt}
+    ] + (
+        [{"role": "system", "content": context}] if context else []
+    ) + [
+        {"role": msg["role"], "content": msg["content"]} for msg in messages
+    ]
+    logger.info(f"[LLM] OpenAI: сообщений в контексте: {len(openai_messages)}")
+    logger.debug(f"[LLM] OpenAI: system_prompt: {system_prompt}")
+    return openai_messages
+
+def _record_gemini_usage(response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        prompt_cache_stats.record(usage.prompt_token_count, usage.cached_content_token_count)
+
+def _record_openai_usage(usage):
+    if usage:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        prompt_cache_stats.record(usage.prompt_tokens, getattr(details, 'cached_tokens', 0) if details else 0)
+
+async def _generate_gemini(messages: list, system_prompt: str, context: str) -> str:
+    prompt = _build_gemini_prompt(messages, context)
+    model = await _get_gemini_model_for(system_prompt, prompt)
+    response = await model.generate_content_async(prompt)
+    _record_gemini_usage(response)
+    logger.info(f"[LLM] Gemini: длина ответа: {len(response.text) if response and response.text else 0} символов")
+    return response.text
+
+async def _generate_openai(messages: list, system_prompt: str, context: str, timeout: float) -> str:
+    openai_client = get_openai_client()
+    response = await openai_client.chat.completions.create(
+        model=os.getenv("OPENAI_MODEL", "gpt-4.1-nano-2025-04-14"),
+        messages=_build_openai_messages(messages, system_prompt, context),
+        temperature=0.7,
+        max_tokens=20024,
+        timeout=timeout,
+    )
+    _record_openai_usage(response.usage)
+    answer = response.choices[0].message.content
+    logger.info(f"[LLM] OpenAI: длина ответа: {len(answer) if answer else 0} символов")
+    return answer
+
+async def generate_response(messages: list, system_prompt: str, timeout: float = None,
+                            context: str = None) -> str:
+    """Асинхронно получает ответ модели, не блокируя event loop.
+
+    system_prompt — стабильный префикс, который провайдер может кэшировать,
+    context — переменная часть запроса (участники, саммари).
+    Запрос ограничен таймаутом и отменяется вместе с вызывающей задачей.
+    """
+    timeout = timeout or LLM_TIMEOUT
     if MODEL_PROVIDER == "gemini":
-        model = get_gemini_model()
-        prompt = system_prompt + "\n\nИстория диалога:\n"
-        for msg in messages:
-            role = "Пользователь" if msg["role"] == "user" else "Ассистент"
-            prompt += f"{role}: {msg['content']}\n"
-        logger.info(f"[LLM] Gemini: длина промпта: {len(prompt)} символов")
-        logger.debug(f"[LLM] Gemini: полный промпт:\n{prompt}")
-        response = model.generate_content(prompt)
-        logger.info(f"[LLM] Gemini: длина ответа: {len(response.text) if response and response.text else 0} символов")
-        return response.text
+        request = _generate_gemini(messages, system_prompt, context)
     elif MODEL_PROVIDER == "openai":
-        openai_client = get_openai_client()
-        openai_messages = [
-            {"role": "system", "content": system_prompt}
-        ] + [
-            {"role": msg["role"], "content": msg["content"]} for msg in messages
-        ]
-        logger.info(f"[LLM] OpenAI: сообщений в контексте: {len(openai_messages)}")
-        logger.debug(f"[LLM] OpenAI: system_prompt: {system_prompt}")
-        response = openai_client.chat.completions.create(
-            model=os.getenv("OPENAI_MODEL", "gpt-4.1-nano-2025-04-14"),
-            messages=openai_messages,
-            temperature=0.7,
-            max_tokens=20024,
-        )
-        answer = response.choices[0].message.content
-        logger.info(f"[LLM] OpenAI: длина ответа: {len(answer) if answer else 0} символов")
-        return answer
+        request = _generate_openai(messages, system_prompt, context, timeout)
+    else:
+        raise ValueError("Неизвестный провайдер модели")
+    try:
+        return await asyncio.wait_for(request, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"[LLM] {MODEL_PROVIDER}: превышен таймаут ответа ({timeout} с)")
+        raise
+
+async def _next_chunk(iterator, timeout: float):
+    try:
+        return await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"[LLM] {MODEL_PROVIDER}: нет данных от модели дольше {timeout} с")
+        raise
+
+async def _stream_gemini(messages: list, system_prompt: str, context: str, timeout: float):
+    prompt = _build_gemini_prompt(messages, context)
+    model = await _get_gemini_model_for(system_prompt, prompt)
+    response = await asyncio.wait_for(
+        model.generate_content_async(prompt, stream=True), timeout=timeout
+    )
+    iterator = response.__aiter__()
+    while True:
+        try:
+            chunk = await _next_chunk(iterator, timeout)
+        except StopAsyncIteration:
+            break
+        try:
+            text = chunk.text
+        except ValueError:
+            # Пустой или заблокированный фрагмент
+            continue
+        if text:
+            yield text
+    _record_gemini_usage(response)
+
+async def _stream_openai(messages: list, system_prompt: str, context: str, timeout: float):
+    openai_client = get_openai_client()
+    stream = await openai_client.chat.completions.create(
+        model=os.getenv("OPENAI_MODEL", "gpt-4.1-nano-2025-04-14"),
+        messages=_build_openai_messages(messages, system_prompt, context),
+        temperature=0.7,
+        max_tokens=20024,
+        timeout=timeout,
+        stream=True,
+        # Последний фрагмент потока несёт usage со статистикой кэша
+        stream_options={"include_usage": True},
+    )
+    try:
+        iterator = stream.__aiter__()
+        while True:
+            try:
+                chunk = await _next_chunk(iterator, timeout)
+            except StopAsyncIteration:
+                break
+            if chunk.usage:
+                _record_openai_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+
+async def stream_response(messages: list, system_prompt: str, timeout: float = None,
+                          context: str = None):
+    """Потоковая генерация ответа: отдаёт фрагменты текста по мере их поступления.
+
+    Разделение на system_prompt и context — как в generate_response.
+    Таймаут применяется к ожиданию каждого следующего фрагмента.
+    """
+    timeout = timeout or LLM_TIMEOUT
+    if MODEL_PROVIDER == "gemini":
+        chunks = _stream_gemini(messages, system_prompt, context, timeout)
+    elif MODEL_PROVIDER == "openai":
+        chunks = _stream_openai(messages, system_prompt, context, timeout)
     else:
-        raise ValueError("Неизвестный провайдер модели") 
\ No newline at end of file
+        raise ValueError("Неизвестный провайдер модели")
+    total = 0
+    try:
+        async for text in chunks:
+            total += len(text)
+            yield text
+    finally:
+        await chunks.aclose()
+    logger.info(f"[LLM] {MODEL_PROVIDER}: потоковый ответ завершён, {total} символов")
@@ -0,0 +1,175 @@
+import re
+import logging
+from typing import Dict, Iterable, List, Set
+
+logger = logging.getLogger(__name__)
+
+# Словарь соответствия различных вариаций специализаций: категория -> синонимы
+SPECIALIZATION_MAPPING = {
+    'маркетинг': ['маркетинг', 'маркетолог', 'marketing', 'smm', 'контент', 'content', 'таргет', 'реклама',
+                  'analytics', 'brand'],
+    'разработка': ['разработчик', 'программист', 'developer', 'кодер', 'backend', 'frontend', 'python',
+                   'javascript', 'java', 'react', 'node', 'web'],
+    'дизайн': ['дизайнер', 'designer', 'design', 'ui/ux', 'ui', 'ux', 'графический', 'веб-дизайн', 'figma',
+               'photoshop', 'prototype'],
+    'продакт': ['продакт', 'product manager', 'product owner', 'менеджер продукта', 'product'],
+    'проджект': ['project manager', 'проджект', 'менеджер проекта', 'пм'],
+    'менеджмент': ['менеджер', 'manager', 'management', 'agile', 'scrum', 'team lead'],
+}
+
+# Минимальная длина основы слова, которую можно сравнивать с синонимами по префиксу:
+# короче — слишком много случайных совпадений («менее» -> «мене» -> «менеджер»)
+MIN_PREFIX_STEM = 5
+
+# Слова, которые не ищутся в профилях участников: обращения к боту и стоп-слова
+QUERY_STOP_WORDS = frozenset({
+    'брат', 'бро', 'aibratbot', 'пожалуйста', 'плиз', 'подскажи', 'скажи', 'расскажи', 'слушай', 'привет',
+    'ищу', 'найди', 'нужен', 'нужна', 'нужны', 'как', 'что', 'кто', 'где', 'когда', 'зачем', 'почему',
+    'какой', 'какая', 'какие', 'это', 'этот', 'эта', 'эти', 'для', 'про', 'или', 'его', 'она', 'они', 'так',
+    'уже', 'еще', 'есть', 'был', 'была', 'были', 'быть', 'все', 'вот', 'тут', 'там', 'нам', 'мне', 'меня',
+    'тебя', 'тебе', 'нас', 'вас', 'чем', 'чтобы', 'если', 'только', 'можно', 'нужно', 'надо', 'хочу', 'может',
+    'the', 'and', 'for', 'with', 'what', 'who', 'how',
+})
+
+# Частые окончания русских слов (от длинных к коротким) для лёгкого стемминга запроса
+_RU_ENDINGS = (
+    'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ах', 'ях', 'ов', 'ев', 'ей',
+    'ам', 'ям', 'ом', 'ем', 'ой', 'ый', 'ий', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие',
+    'а', 'я', 'ы', 'и', 'у', 'ю', 'е', 'о', 'ь'
+)
+
+def normalize_text(text: str) -> str:
+    """Нижний регистр, ё -> е, схлопывание пробелов"""
+    return re.sub(r'\s+', ' ', (text or '').lower().replace('ё', 'е')).strip()
+
+def normalize_search_term(word: str) -> str:
+    """Приводит слово запроса к нижнему регистру и отрезает типичное окончание"""
+    word = normalize_text(word)
+    if re.search('[а-я]', word):
+        for ending in _RU_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 4:
+                return word[:-len(ending)]
+    elif len(word) > 4 and word.endswith('s'):
+        return word[:-1]
+    return word
+
+def significant_terms(query: str, min_length: int = 3) -> List[str]:
+    """Основы значимых слов запроса: без стоп-слов и слишком коротких слов"""
+    words = re.findall(r'\w+', normalize_text(query))
+    terms = [normalize_search_term(w) for w in words if w not in QUERY_STOP_WORDS]
+    return list(dict.fromkeys(t for t in terms if len(t) >= min_length))
+
+
+class MemberIndex:
+    """Инвертированный индекс: нормализованный синоним специализации -> id участников.
+
+    Индекс обновляется инкрементально при сохранении профиля, поэтому поиск
+    по категории стоит O(совпадений), а не O(участников × ключевых слов).
+    """
+
+    def __init__(self, mapping: Dict[str, List[str]] = None):
+        mapping = mapping or SPECIALIZATION_MAPPING
+        # синоним -> категории, к которым он относится
+        self.synonym_categories: Dict[str, Set[str]] = {}
+        for category, synonyms in mapping.items():
+            for synonym in [category] + synonyms:
+                self.synonym_categories.setdefault(normalize_text(synonym), set()).add(category)
+        self.category_synonyms: Dict[str, Set[str]] = {}
+        for synonym, categories in self.synonym_categories.items():
+            for category in categories:
+                self.category_synonyms.setdefault(category, set()).add(synonym)
+        # Синоним ищется целым словом (или фразой); словоформы ловит сравнение основ
+        alternation = '|'.join(
+            re.escape(s) for s in sorted(self.synonym_categories, key=len, reverse=True)
+        )
+        self._synonym_re = re.compile(rf'(?<!\w)({alternation})(?!\w)')
+        # Многословные синонимы по основам слов: «менеджера продукта» -> «менеджер продукта»
+        self._phrase_synonyms: Dict[tuple, str] = {}
+        for synonym in self.synonym_categories:
+            words = re.findall(r'\w+', synonym)
+            if len(words) > 1:
+                self._phrase_synonyms[tuple(normalize_search_term(w) for w in words)] = synonym
+        self._phrase_lengths = sorted({len(stems) for stems in self._phrase_synonyms})
+
+        self.synonym_members: Dict[str, Set[int]] = {}
+        self.skill_members: Dict[str, Set[int]] = {}
+        self.member_synonyms: Dict[int, Set[str]] = {}
+        self.member_skills: Dict[int, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.member_synonyms)
+
+    def update(self, member_id: int, texts: Iterable[str], skills: Iterable[str] = ()):
+        """Добавляет или переиндексирует участника по его текстам (специализация, навыки, интересы)"""
+        self.remove(member_id)
+        text = normalize_text(' | '.join(t for t in texts if t))
+        synonyms = self.match_synonyms(text)
+        skill_keys = {normalize_text(s) for s in skills if s and str(s).strip()}
+        for synonym in synonyms:
+            self.synonym_members.setdefault(synonym, set()).add(member_id)
+        for skill in skill_keys:
+            self.skill_members.setdefault(skill, set()).add(member_id)
+        self.member_synonyms[member_id] = synonyms
+        self.member_skills[member_id] = skill_keys
+
+    def remove(self, member_id: int):
+        """Удаляет участника из индекса"""
+        for synonym in self.member_synonyms.pop(member_id, ()):
+            members = self.synonym_members.get(synonym)
+            if members:
+                members.discard(member_id)
+                if not members:
+                    del self.synonym_members[synonym]
+        for skill in self.member_skills.pop(member_id, ()):
+            members = self.skill_members.get(skill)
+            if members:
+                members.discard(member_id)
+                if not members:
+                    del self.skill_members[skill]
+
+    def clear(self):
+        self.synonym_members.clear()
+        self.skill_members.clear()
+        self.member_synonyms.clear()
+        self.member_skills.clear()
+
+    def match_synonyms(self, text: str) -> Set[str]:
+        """Синонимы специализаций, встречающиеся в нормализованном тексте"""
+        synonyms = set(self._synonym_re.findall(text))
+        stems = [normalize_search_term(word) for word in re.findall(r'\w+', text)]
+        for length in self._phrase_lengths:
+            for start in range(len(stems) - length + 1):
+                synonym = self._phrase_synonyms.get(tuple(stems[start:start + length]))
+                if synonym:
+                    synonyms.add(synonym)
+        for stem in stems:
+            if stem in self.synonym_categories:
+                # Словоформа синонима («разработчика» -> «разработчик»)
+                synonyms.add(stem)
+            elif len(stem) >= MIN_PREFIX_STEM:
+                # Основа короче синонима и совпадает с его началом («дизайн» -> «дизайнер»);
+                # перебор идёт по словарю синонимов (константа), а не по участникам
+                synonyms.update(s for s in self.synonym_categories if len(s) > len(stem) and s.startswith(stem))
+        return synonyms
+
+    def resolve_categories(self, query: str) -> Set[str]:
+        """Определяет категории специализаций, к которым относится запрос"""
+        query = normalize_text(query)
+        if not query:
+            return set()
+        categories = set(self.synonym_categories.get(query, ()))
+        for synonym in self.match_synonyms(query):
+            categories |= self.synonym_categories[synonym]
+        return categories
+
+    def lookup_category(self, query: str) -> Set[int]:
+        """Участники, подходящие под категорию из запроса"""
+        result: Set[int] = set()
+        for category in self.resolve_categories(query):
+            for synonym in self.category_synonyms.get(category, ()):
+                result |= self.synonym_members.get(synonym, set())
+        return result
+
+    def lookup_skill(self, skill: str) -> Set[int]:
+        """Участники с указанным навыком (без учёта регистра)"""
+        return set(self.skill_members.get(normalize_text(skill), ()))
@@ -0,0 +1,169 @@
+import time
+import asyncio
+import logging
+import contextlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Набор token bucket'ов по ключам (пользователь, чат) с вытеснением неактивных.
+
+    Ведро вмещает capacity токенов и пополняется со скоростью rate токенов
+    в секунду, поэтому на границе минуты нельзя сделать двойной всплеск,
+    как при сбросе счётчика раз в минуту. Ведро, к которому не обращались
+    дольше времени полного пополнения, всё равно полное — его можно забыть
+    без изменения поведения. Ключи хранятся в порядке последнего обращения,
+    и такие вёдра удаляются с начала при каждом вызове: проверка стоит O(1)
+    амортизированно, а память ограничена числом ключей, активных за это окно
+    (и сверху — max_entries).
+    """
+
+    def __init__(self, rate: float, capacity: float, max_entries: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_entries = max_entries
+        self.idle_ttl = capacity / rate  # За это время пустое ведро наполняется целиком
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    def __len__(self) -> int:
+        """Число ключей, активных за последнее окно пополнения"""
+        self._evict(time.monotonic())
+        return len(self._buckets)
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < self.idle_ttl and len(self._buckets) <= self.max_entries:
+                break
+            del self._buckets[key]
+
+    def _tokens(self, key: Hashable, now: float) -> float:
+        entry = self._buckets.get(key)
+        if entry is None:
+            return self.capacity
+        tokens, updated_at = entry
+        return min(self.capacity, tokens + (now - updated_at) * self.rate)
+
+    def retry_after(self, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Через сколько секунд хватит токенов на запрос (0 — можно сейчас), без списания"""
+        now = time.monotonic() if now is None else now
+        missing = cost - self._tokens(key, now)
+        return max(0.0, missing / self.rate)
+
+    def consume(self, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Списывает cost токенов, если их хватает; возвращает время ожидания (0 — списано)"""
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(key, now)
+        if tokens < cost:
+            return (cost - tokens) / self.rate
+        self._buckets[key] = (tokens - cost, now)
+        self._buckets.move_to_end(key)
+        self._evict(now)
+        return 0.0
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class AdmissionRejected(Exception):
+    """Запрос отклонён контролем нагрузки; текст исключения можно показать пользователю"""
+
+
+class OperationGate:
+    """Бюджет и ограничение параллельности для одного типа операций"""
+
+    def __init__(self, title: str, concurrency: Optional[int], max_waiting: int,
+                 budget_per_minute: float, weight: float = 1.0):
+        self.title = title
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self.max_waiting = max_waiting
+        self.weight = weight  # Стоимость одного запроса в единицах бюджета
+        self.budget = TokenBucket(budget_per_minute / 60, budget_per_minute)
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+
+class AdmissionController:
+    """Контроль нагрузки по типам операций (ответы модели, поиск, изображения, файлы).
+
+    У каждого типа свой бюджет в минуту (запрос стоит weight × cost единиц)
+    и свой семафор параллельности, поэтому всплеск дорогих операций не
+    занимает слоты и бюджет обычных ответов. Когда все слоты заняты, запрос
+    ждёт в очереди (вызывающий получает on_queued с позицией), а при
+    переполнении очереди или исчерпании бюджета сразу отклоняется.
+    """
+
+    def __init__(self):
+        self.gates: Dict[str, OperationGate] = {}
+
+    def configure(self, operation: str, title: str, concurrency: Optional[int] = None,
+                  max_waiting: int = 0, budget_per_minute: float = 60, weight: float = 1.0):
+        """concurrency=None — только бюджет (очередь у операции своя, как у генерации изображений)"""
+        self.gates[operation] = OperationGate(title, concurrency, max_waiting, budget_per_minute, weight)
+
+    def charge(self, operation: str, cost: float = 1.0):
+        """Списывает стоимость запроса из бюджета операции или бросает AdmissionRejected"""
+        gate = self.gates[operation]
+        # Запрос дороже всего бюджета иначе не прошёл бы никогда
+        units = min(cost * gate.weight, gate.budget.capacity)
+        wait = gate.budget.consume(operation, units)
+        if wait:
+            gate.rejected += 1
+            logger.warning(f"🚦 Бюджет операции {operation} исчерпан, запрос отклонён")
+            raise AdmissionRejected(
+                f"Сейчас слишком много запросов: {gate.title}. Попробуйте через {int(wait) + 1} сек."
+            )
+        if gate.semaphore is None:
+            gate.admitted += 1
+
+    @contextlib.asynccontextmanager
+    async def admit(self, operation: str, cost: float = 1.0,
+                    on_queued: Optional[Callable[[int], Awaitable[None]]] = None):
+        """Допускает запрос к выполнению: списывает бюджет и занимает слот операции"""
+        gate = self.gates[operation]
+        if gate.semaphore is None:
+            raise ValueError(f"Для операции {operation} не задан лимит параллельности")
+        if gate.semaphore.locked() and gate.waiting >= gate.max_waiting:
+            gate.rejected += 1
+            logger.warning(f"🚦 Очередь операции {operation} переполнена ({gate.waiting}), запрос отклонён")
+            raise AdmissionRejected(f"Сейчас слишком много запросов: {gate.title}. Попробуйте чуть позже.")
+        self.charge(operation, cost)
+
+        if gate.semaphore.locked():
+            gate.waiting += 1
+            try:
+                logger.info(f"⏳ Операция {operation} ждёт в очереди: позиция {gate.waiting}")
+                if on_queued:
+                    await on_queued(gate.waiting)
+                await gate.semaphore.acquire()
+            finally:
+                gate.waiting -= 1
+        else:
+            await gate.semaphore.acquire()
+
+        gate.running += 1
+        gate.admitted += 1
+        try:
+            yield
+        finally:
+            gate.running -= 1
+            gate.semaphore.release()
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            operation: {
+                'title': gate.title,
+                'running': gate.running,
+                'concurrency': gate.concurrency,
+                'waiting': gate.waiting,
+                'admitted': gate.admitted,
+                'rejected': gate.rejected,
+            }
+            for operation, gate in self.gates.items()
+        }
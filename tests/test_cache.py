@@ -0,0 +1,49 @@
+import cache
+from cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    c = TTLCache(maxsize=10, ttl=60)
+    c.set('a', 1)
+    c.set('b', 2, ttl=5)
+    clock.now += 10
+    assert c.get('a') == 1
+    assert c.get('b') is None
+    clock.now += 60
+    assert c.get('a') is None
+    assert len(c) == 0
+
+
+def test_evicts_least_recently_used():
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set('a', 1)
+    c.set('b', 2)
+    assert c.get('a') == 1  # 'a' становится самым свежим
+    c.set('c', 3)
+    assert 'b' not in c
+    assert c.get('a') == 1 and c.get('c') == 3
+
+
+def test_stats_and_purge_expired(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    c = TTLCache(maxsize=10, ttl=60)
+    c.set('a', 1)
+    c.set('b', 2, ttl=120)
+    c.get('a')
+    c.get('missing')
+    stats = c.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+    clock.now += 90
+    assert c.purge_expired() == 1
+    assert c.pop('b') == 2
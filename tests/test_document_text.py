@@ -0,0 +1,35 @@
+from document_text import iter_chunks, iter_txt
+from llm_provider import estimate_tokens
+
+
+def test_chunks_respect_token_limit():
+    pieces = [f"Строка номер {i} про важные вещи.\n" for i in range(500)]
+    chunks = list(iter_chunks(pieces, 100))
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 100 for chunk in chunks)
+    assert ''.join(chunks) == ''.join(pieces)
+
+
+def test_piece_exactly_at_limit_is_one_chunk():
+    piece = "a" * (99 * 4) + "\n"
+    assert estimate_tokens(piece) == 100
+    assert list(iter_chunks([piece], 100)) == [piece]
+    assert list(iter_chunks([piece, piece], 100)) == [piece, piece]
+
+
+def test_oversized_piece_is_split():
+    piece = "б" * 10000
+    chunks = list(iter_chunks([piece], 100))
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk.rstrip('\n')) <= 100 for chunk in chunks)
+    assert ''.join(c.rstrip('\n') for c in chunks) == piece
+
+
+def test_empty_input_gives_no_chunks():
+    assert list(iter_chunks([], 100)) == []
+
+
+def test_iter_txt_detects_cp1251(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_bytes("Привет, мир\n".encode('cp1251'))
+    assert ''.join(iter_txt(str(path))) == "Привет, мир\n"
@@ -0,0 +1,23 @@
+from member_index import MemberIndex
+
+
+def test_multi_word_synonym_matches_word_forms():
+    index = MemberIndex()
+    assert index.resolve_categories("менеджера продукта") == {'продакт', 'менеджмент'}
+    assert 'продакт' in index.resolve_categories("ищу product managers")
+
+
+def test_single_words_match_whole_words_and_word_forms():
+    index = MemberIndex()
+    assert index.resolve_categories("нужен разработчика") == {'разработка'}
+    assert index.resolve_categories("менее") == set()
+    assert index.resolve_categories("build") == set()
+
+
+def test_lookup_category_finds_members_by_phrase():
+    index = MemberIndex()
+    index.update(1, ["Менеджер продукта в финтехе"])
+    index.update(2, ["Бухгалтер"])
+    assert index.lookup_category("менеджеров продукта") == {1}
+    index.remove(1)
+    assert index.lookup_category("менеджеров продукта") == set()
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from database import Database
+from member_index import significant_terms
+
+MEMBERS = [
+    (1, {'full_name': 'Анна', 'occupation': 'Дизайнер', 'about': 'Делаю дизайн сайтов и лендингов',
+         'skills': ['figma'], 'is_complete': True}),
+    (2, {'full_name': 'Олег', 'occupation': 'Бухгалтер', 'about': 'Веду учёт для малого бизнеса',
+         'skills': ['1с'], 'is_complete': True}),
+]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "bot.db"))
+    for user_id, data in MEMBERS:
+        asyncio.run(db.add_or_update_user(user_id, data))
+    yield db
+    db.close()
+
+
+def _ids(users):
+    return sorted(u['user_id'] for u in users)
+
+
+def test_significant_terms_drop_stop_words():
+    assert significant_terms("брат ищу дизайнера для сайта") == ['дизайнер', 'сайт']
+    assert significant_terms("брат, подскажи кто") == []
+
+
+def test_search_requires_all_significant_terms(db):
+    assert _ids(asyncio.run(db.search_users("брат ищу дизайнера для сайта"))) == [1]
+    assert asyncio.run(db.search_users("ищу для")) == []
+
+
+def test_search_folds_yo(db):
+    assert _ids(asyncio.run(db.search_users("учет"))) == [2]
+    assert _ids(asyncio.run(db.search_users("учёт"))) == [2]
+
+
+def test_like_fallback_uses_same_rules(db):
+    db.fts_enabled = False
+    assert _ids(asyncio.run(db.search_users("брат ищу дизайнера для сайта"))) == [1]
+    assert _ids(asyncio.run(db.search_users("учёт"))) == [2]
+
+
+def test_skills_search_matches_any_skill(db):
+    assert _ids(asyncio.run(db.search_users_by_skills(['figma', '1с']))) == [1]
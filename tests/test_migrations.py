@@ -0,0 +1,122 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from database import MIGRATIONS, Database
+
+# Схема базы до появления версионированных миграций (версия 0)
+LEGACY_SCHEMA = """
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    full_name TEXT,
+    telegram_nick TEXT,
+    occupation TEXT,
+    skills TEXT,
+    company_info TEXT,
+    links TEXT,
+    about TEXT,
+    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_active TIMESTAMP,
+    is_complete BOOLEAN DEFAULT FALSE
+);
+CREATE TABLE message_context (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    role TEXT,
+    content TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE chat_summaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    summary TEXT,
+    start_timestamp TIMESTAMP,
+    end_timestamp TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE settings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    value TEXT NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_context_user_id ON message_context(user_id);
+CREATE INDEX idx_summaries_user_id ON chat_summaries(user_id);
+CREATE INDEX idx_settings_key ON settings(key);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = str(tmp_path / "bot.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.execute(
+        "INSERT INTO users (user_id, full_name, occupation, skills, is_complete) VALUES (?, ?, ?, ?, ?)",
+        (1, "Иван", "Дизайнер интерфейсов", '["figma"]', True)
+    )
+    conn.execute(
+        "INSERT INTO chat_summaries (user_id, summary, start_timestamp, end_timestamp) VALUES (?, ?, ?, ?)",
+        (1, "Старое саммари", "2024-01-01 10:00:00", "2024-01-01 11:00:00")
+    )
+    conn.executemany(
+        "INSERT INTO message_context (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+        [(1, "user", "Вошло в саммари", "2024-01-01 11:00:00"),
+         (1, "user", "Новее саммари", "2024-01-01 12:00:00")]
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def _schema(path):
+    conn = sqlite3.connect(path)
+    try:
+        version = conn.execute("SELECT value FROM settings WHERE key = 'schema_version'").fetchone()[0]
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+        summary_columns = {row[1] for row in conn.execute("PRAGMA table_info(chat_summaries)")}
+        return int(version), names, summary_columns
+    finally:
+        conn.close()
+
+
+def test_upgrade_from_v0_to_latest(legacy_db):
+    db = Database(legacy_db)
+    try:
+        version, names, summary_columns = _schema(legacy_db)
+        assert version == MIGRATIONS[-1][0]
+        assert {'idx_context_user_ts', 'idx_summaries_user_created', 'roster_entries', 'image_cache',
+                'file_hashes', 'file_analysis_cache', 'idx_summaries_user_active'} <= names
+        assert not {'idx_context_user_id', 'idx_summaries_user_id'} & names
+        assert {'tier', 'source_ids', 'compacted_into'} <= summary_columns
+
+        # Старые данные доступны через новые методы
+        summaries = asyncio.run(db.get_all_summaries(1))
+        assert [(s['summary'], s['tier']) for s in summaries] == [("Старое саммари", 0)]
+        # Граница старого саммари перенесена с времени на id сообщения
+        assert summaries[0]['end_message_id'] == 1
+        if db.fts_enabled:
+            found = asyncio.run(db.search_users("дизайнер", search_type='keyword'))
+            assert [u['user_id'] for u in found] == [1]
+    finally:
+        db.close()
+
+
+def test_migrations_are_applied_once(legacy_db):
+    Database(legacy_db).close()
+    db = Database(legacy_db)
+    try:
+        version, _, _ = _schema(legacy_db)
+        assert version == MIGRATIONS[-1][0]
+        assert len(asyncio.run(db.get_all_summaries(1))) == 1
+    finally:
+        db.close()
+
+
+def test_fresh_database_gets_latest_version(tmp_path):
+    path = str(tmp_path / "fresh.db")
+    Database(path).close()
+    version, _, _ = _schema(path)
+    assert version == MIGRATIONS[-1][0]
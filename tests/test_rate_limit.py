@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from rate_limit import AdmissionController, AdmissionRejected, TokenBucket
+
+
+def test_bucket_allows_burst_up_to_capacity():
+    bucket = TokenBucket(rate=1.0, capacity=3)
+    assert [bucket.consume('u', now=0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.consume('u', now=0) == pytest.approx(1.0)
+
+
+def test_bucket_refills_with_rate_and_caps_at_capacity():
+    bucket = TokenBucket(rate=0.5, capacity=2)
+    bucket.consume('u', now=0)
+    bucket.consume('u', now=0)
+    assert bucket.retry_after('u', now=1) == pytest.approx(1.0)
+    assert bucket.consume('u', now=2) == 0.0
+    # Долгий простой не копит больше capacity
+    assert [bucket.consume('u', now=100) for _ in range(3)] == [0.0, 0.0, pytest.approx(2.0)]
+
+
+def test_bucket_no_double_burst_at_window_edge():
+    bucket = TokenBucket(rate=30 / 60, capacity=30)
+    allowed = sum(bucket.consume('u', now=59.9) == 0.0 for _ in range(60))
+    allowed += sum(bucket.consume('u', now=60.1) == 0.0 for _ in range(60))
+    assert allowed == 30
+
+
+def test_bucket_retry_after_does_not_consume():
+    bucket = TokenBucket(rate=1.0, capacity=1)
+    assert bucket.retry_after('u', now=0) == 0.0
+    assert bucket.consume('u', now=0) == 0.0
+
+
+def test_bucket_evicts_idle_keys_and_respects_max_entries():
+    bucket = TokenBucket(rate=1.0, capacity=2, max_entries=5)
+    for i in range(100):
+        bucket.consume(i, now=0)
+    assert len(bucket._buckets) == 5
+    # Через время полного пополнения старые вёдра вытесняются при следующем обращении
+    bucket.consume('new', now=10)
+    assert list(bucket._buckets) == ['new']
+
+
+def _controller(concurrency=2, max_waiting=2, budget=100):
+    controller = AdmissionController()
+    controller.configure('chat', "ответы", concurrency=concurrency, max_waiting=max_waiting,
+                         budget_per_minute=budget)
+    return controller
+
+
+def test_admission_caps_concurrency_and_reports_queue_position():
+    controller = _controller(concurrency=2, max_waiting=10)
+    running = peak = 0
+    positions = []
+
+    async def job():
+        nonlocal running, peak
+
+        async def on_queued(position):
+            positions.append(position)
+
+        async with controller.admit('chat', on_queued=on_queued):
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    async def main():
+        await asyncio.gather(*(job() for _ in range(5)))
+
+    asyncio.run(main())
+    assert peak == 2
+    assert positions == [1, 2, 3]
+    stats = controller.stats()['chat']
+    assert stats['admitted'] == 5 and stats['running'] == 0 and stats['waiting'] == 0
+
+
+def test_admission_sheds_load_when_queue_is_full():
+    controller = _controller(concurrency=1, max_waiting=1, budget=4)
+
+    async def job():
+        try:
+            async with controller.admit('chat'):
+                await asyncio.sleep(0.01)
+            return 'ok'
+        except AdmissionRejected:
+            return 'rejected'
+
+    async def main():
+        return await asyncio.gather(*(job() for _ in range(4)))
+
+    assert asyncio.run(main()) == ['ok', 'ok', 'rejected', 'rejected']
+    assert controller.stats()['chat']['rejected'] == 2
+    # Отклонённые очередью запросы бюджет не тратят
+    assert controller.gates['chat'].budget.retry_after('chat', cost=2) == 0
+
+
+def test_admission_rejects_when_budget_is_exhausted():
+    controller = _controller(concurrency=5, budget=2)
+
+    async def main():
+        for _ in range(2):
+            async with controller.admit('chat'):
+                pass
+        with pytest.raises(AdmissionRejected):
+            async with controller.admit('chat'):
+                pass
+
+    asyncio.run(main())
+
+
+def test_charge_uses_weighted_cost_and_caps_it_at_budget():
+    controller = AdmissionController()
+    controller.configure('file', "анализ файлов", budget_per_minute=10, weight=2)
+    controller.charge('file', cost=3)  # 6 единиц из 10
+    with pytest.raises(AdmissionRejected):
+        controller.charge('file', cost=3)
+    # Запрос дороже всего бюджета не должен быть невыполнимым навсегда
+    controller.configure('image', "изображения", budget_per_minute=5)
+    controller.charge('image', cost=100)
+    assert controller.stats()['image']['admitted'] == 1
+
+
+def test_operation_gates_are_independent():
+    controller = _controller(concurrency=1, max_waiting=0, budget=1)
+    controller.configure('image', "изображения", budget_per_minute=1)
+    controller.charge('image')
+    with pytest.raises(AdmissionRejected):
+        controller.charge('image')
+
+    async def main():
+        async with controller.admit('chat'):
+            pass
+
+    asyncio.run(main())
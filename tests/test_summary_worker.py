@@ -0,0 +1,26 @@
+import asyncio
+
+import bot
+from bot import SummaryWorker
+from database import Database
+
+
+def test_block_boundary_uses_message_ids(tmp_path, monkeypatch):
+    async def fake_generate_response(messages, system_prompt):
+        return "саммари"
+
+    monkeypatch.setattr(bot, 'generate_response', fake_generate_response)
+    db = Database(str(tmp_path / "bot.db"))
+    try:
+        with db.get_connection() as conn:
+            # Все сообщения пришли в одну секунду: по времени границу блока не провести
+            conn.executemany(
+                "INSERT INTO message_context (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                [(1, "user", f"сообщение {i}", "2024-01-01 10:00:00") for i in range(7)]
+            )
+        worker = SummaryWorker(db, block_size=3, keep_recent=1)
+        asyncio.run(worker._summarize_blocks(1))
+        summaries = asyncio.run(db.get_all_summaries(1))
+        assert [s['end_message_id'] for s in summaries] == [3, 6]
+    finally:
+        db.close()